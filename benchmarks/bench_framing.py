@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#
+# PyKMM - KMM and keyloading for Python
+# GPLv2 Open Source. Use is subject to license terms.
+# DO NOT ALTER OR REMOVE COPYRIGHT NOTICES OR THIS FILE HEADER.
+#
+# @package PyKMM
+#
+###############################################################################
+#   Copyright (C) 2022 Natalie Moore <natalie@natnat.xyz>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+###############################################################################
+
+'''Micro-benchmark of the keyloader frame codec against the original per-byte loops
+
+Run with `python benchmarks/bench_framing.py`.
+'''
+
+import os
+import timeit
+
+from pykmm.framing import encode_frame
+from pykmm.deviceprotocol import KFDAVR
+
+FMT = KFDAVR.FRAME_FORMAT
+
+def legacyEncode(command):
+    '''The per-byte escape loop KFDAVR.writeToSerial used before the frame codec'''
+    toSend = bytearray()
+    toSend.append(KFDAVR.SERIAL_HEADER)
+    for b in command:
+        if (b == KFDAVR.SERIAL_ESC):
+            toSend.append(KFDAVR.SERIAL_ESC)
+            toSend.append(KFDAVR.SERIAL_ESC_PLACEHOLDER)
+        elif (b == KFDAVR.SERIAL_HEADER):
+            toSend.append(KFDAVR.SERIAL_ESC)
+            toSend.append(KFDAVR.SERIAL_HEADER_PLACEHOLDER)
+        elif (b == KFDAVR.SERIAL_FOOTER):
+            toSend.append(KFDAVR.SERIAL_ESC)
+            toSend.append(KFDAVR.SERIAL_FOOTER_PLACEHOLDER)
+        else:
+            toSend.append(b)
+    toSend.append(KFDAVR.SERIAL_FOOTER)
+    return toSend
+
+def legacyDecode(data):
+    '''A linear per-byte unescape loop, standing in for the old list-deleting one (which is O(n^2) and faults on most payloads)'''
+    out = []
+    escaped = False
+    for b in data:
+        if (escaped):
+            if (b == KFDAVR.SERIAL_ESC_PLACEHOLDER):
+                out.append(KFDAVR.SERIAL_ESC)
+            elif (b == KFDAVR.SERIAL_HEADER_PLACEHOLDER):
+                out.append(KFDAVR.SERIAL_HEADER)
+            elif (b == KFDAVR.SERIAL_FOOTER_PLACEHOLDER):
+                out.append(KFDAVR.SERIAL_FOOTER)
+            else:
+                raise ValueError("Invalid character after escape")
+            escaped = False
+        elif (b == KFDAVR.SERIAL_ESC):
+            escaped = True
+        else:
+            out.append(b)
+    return out
+
+def bench(name, func, arg, number):
+    seconds = min(timeit.repeat(lambda: func(arg), number=number, repeat=5)) / number
+    print("{:<32} {:>10.2f} us  {:>8.1f} MB/s".format(name, seconds * 1e6, len(arg) / seconds / 1e6))
+    return seconds
+
+def main():
+    payloads = {
+        "random 4 KiB": os.urandom(4096),
+        "random 64 KiB": os.urandom(65536),
+        "all escapes 64 KiB": bytes([KFDAVR.SERIAL_HEADER, KFDAVR.SERIAL_FOOTER, KFDAVR.SERIAL_ESC, 0x00]) * 16384,
+    }
+    for name, payload in payloads.items():
+        number = max(1, 262144 // len(payload))
+        body = FMT.escapeBytes(payload)
+        print(name)
+        old = bench("  legacy encode", legacyEncode, list(payload), number)
+        new = bench("  encode_frame", lambda p: encode_frame(p, FMT), payload, number)
+        print("  encode speedup: {:.1f}x".format(old / new))
+        old = bench("  legacy decode", legacyDecode, body, number)
+        new = bench("  unescapeBytes", FMT.unescapeBytes, body, number)
+        print("  decode speedup: {:.1f}x".format(old / new))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+#
+# PyKMM - KMM and keyloading for Python
+# GPLv2 Open Source. Use is subject to license terms.
+# DO NOT ALTER OR REMOVE COPYRIGHT NOTICES OR THIS FILE HEADER.
+#
+# @package PyKMM
+#
+###############################################################################
+#   Copyright (C) 2022 Natalie Moore <natalie@natnat.xyz>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+###############################################################################
+
+
+'''Throughput benchmarks for the byte-level hot paths, with machine-readable output
+
+Run with `python benchmarks/bench_suite.py --output results.json` (add --quick for a CI-sized run), then
+check for regressions with `python benchmarks/compare.py benchmarks/baseline.json results.json`.
+Every result is the best-of-repeat time for one operation, in seconds.
+'''
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+
+from pykmm.deviceprotocol import OPKFD, KFDAVR
+from pykmm.serialsession import SerialSession
+from pykmm.kmm.items import KeyItem
+from pykmm import utility
+
+def bench(func, number, repeat=5):
+    '''Best time per call of func over repeat runs of number calls'''
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+def loopbackKFDAVR():
+    '''A KFDAVR on loop://, so every frame written is read straight back'''
+    session = SerialSession("loop://", timeout=0.1)
+    kfd = KFDAVR.__new__(KFDAVR)
+    OPKFD.__init__(kfd, "loop://", session)
+    kfd._rxBuffer = bytearray()
+    kfd._installedKeys = None
+    return kfd
+
+def benchFraming(results, quick):
+    kfd = loopbackKFDAVR()
+    payloads = {
+        "random_256": list(os.urandom(256)),
+        "escapes_256": [KFDAVR.SERIAL_HEADER, KFDAVR.SERIAL_FOOTER, KFDAVR.SERIAL_ESC, 0x00] * 64,
+        # loop:// blocks writes past its 4 KiB queue, so keep the escaped frame under that
+        "escapes_1024": [KFDAVR.SERIAL_HEADER, KFDAVR.SERIAL_FOOTER, KFDAVR.SERIAL_ESC, 0x00] * 256,
+    }
+    for name, payload in payloads.items():
+        def roundTrip():
+            kfd.writeToSerial(payload)
+            kfd.readFromSerial()
+        number = 20 if quick else 200
+        results["framing.kfdavr_roundtrip.{}".format(name)] = bench(roundTrip, number)
+    kfd.session.close()
+
+    number = 2000 if quick else 20000
+    selfTest = [OPKFD.CMD_SELF_TEST]
+    results["framing.encode_constant"] = bench(lambda: KFDAVR._encodeCommand(selfTest), number)
+    keyItem = makeKeyItems(1)[0]
+    results["framing.write_key_frame"] = bench(lambda: KFDAVR._writeKeyFrame(3, keyItem), number)
+
+def makeKeyItems(count):
+    items = []
+    for i in range(0, count):
+        keyItem = KeyItem()
+        keyItem.sln = (i % 0xFFFE) + 1
+        keyItem.kid = (i % 0xFFFE) + 1
+        keyItem.key = bytes([i & 0xFF]) * 32
+        items.append(keyItem)
+    return items
+
+def benchKeyItems(results, quick):
+    batchSizes = (1, 100, 10000) if quick else (1, 10, 100, 1000, 10000, 100000)
+    for batch in batchSizes:
+        items = makeKeyItems(batch)
+        number = max(1, 10000 // batch) if quick else max(1, 100000 // batch)
+
+        def encode():
+            for keyItem in items:
+                keyItem.to_bytes()
+        results["keyitem.to_bytes.{}".format(batch)] = bench(encode, number) / batch
+
+        length = items[0].encoded_length()
+        buffer = bytearray(length * batch)
+        offset = 0
+        for keyItem in items:
+            offset = keyItem.pack_into(buffer, offset)
+
+        def parse():
+            parsed = KeyItem()
+            offset = 0
+            for i in range(0, batch):
+                offset = parsed.parse(buffer, 32, offset)
+        results["keyitem.parse.{}".format(batch)] = bench(parse, number) / batch
+
+def benchUtility(results, quick):
+    keys = [os.urandom(32) for i in range(0, 1000)]
+    hexKeys = [utility.bytesToHex(key) for key in keys]
+    number = 5 if quick else 50
+
+    def toHex():
+        for key in keys:
+            utility.bytesToHex(key)
+    results["utility.bytesToHex.32"] = bench(toHex, number) / len(keys)
+
+    def fromHex():
+        for hexKey in hexKeys:
+            utility.hexToBytes(hexKey)
+    results["utility.hexToBytes.32"] = bench(fromHex, number) / len(keys)
+
+    results["utility.hexListToBuffer.1000x32"] = bench(lambda: utility.hexListToBuffer(hexKeys, 32), number)
+
+def benchEmulated(results, quick):
+    if (not hasattr(os, "openpty")):
+        return
+    from pykmm.emulator import KFDEmulator
+
+    items = makeKeyItems(KFDAVR.MAX_INSTALLED_KEYS)
+    with KFDEmulator() as emulator:
+        kfd = KFDAVR(emulator.port)
+        def rekey():
+            kfd.zeroizeInstalledKeys()
+            kfd.writeInstalledKeys(enumerate(items))
+            kfd.getInstalledKeyInfo(refresh=True)
+        results["emulated.rekey_15_slots"] = bench(rekey, 2 if quick else 10, repeat=3)
+        results["emulated.self_test"] = bench(kfd.selfTest, 20 if quick else 200, repeat=3)
+        kfd.close()
+
+SUITES = {
+    "framing": benchFraming,
+    "keyitem": benchKeyItems,
+    "utility": benchUtility,
+    "emulated": benchEmulated,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the pykmm throughput benchmarks")
+    parser.add_argument("--output", help="write JSON results here instead of stdout")
+    parser.add_argument("--quick", action="store_true", help="smaller batches and fewer runs, for CI")
+    parser.add_argument("--only", choices=sorted(SUITES), action="append", help="run only these suites")
+    args = parser.parse_args()
+
+    results = {}
+    for name in (args.only or SUITES):
+        start = time.perf_counter()
+        SUITES[name](results, args.quick)
+        print("{:<10} {:>6.1f} s".format(name, time.perf_counter() - start), file=sys.stderr)
+
+    report = {
+        "meta": {
+            "quick": args.quick,
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "machine": platform.machine(),
+            "system": platform.system(),
+        },
+        "results": results,
+    }
+    if (args.output):
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+if __name__ == "__main__":
+    main()
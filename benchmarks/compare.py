@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+#
+# PyKMM - KMM and keyloading for Python
+# GPLv2 Open Source. Use is subject to license terms.
+# DO NOT ALTER OR REMOVE COPYRIGHT NOTICES OR THIS FILE HEADER.
+#
+# @package PyKMM
+#
+###############################################################################
+#   Copyright (C) 2022 Natalie Moore <natalie@natnat.xyz>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+###############################################################################
+
+
+'''Compare bench_suite.py results against a stored baseline
+
+Exits with status 1 if any benchmark is slower than the baseline by more than --tolerance
+(a fraction, 0.25 = 25% slower). Benchmarks that go through the OS (the loop:// round trips and the
+pty emulator) swing far more between runs, so they are held to the looser --io-tolerance instead.
+Benchmarks missing from either side are listed but not failed. The baseline is recorded with --quick
+on the interpreter CI runs (see .github/workflows).
+'''
+
+import argparse
+import json
+import sys
+
+# benchmarks timed through serial/pty I/O rather than pure Python work
+IO_BOUND = ("framing.kfdavr_roundtrip.", "emulated.")
+
+def compare(baseline, current, tolerance, ioTolerance=None):
+    '''Return (rows, regressions); each row is (name, baseline seconds, current seconds, ratio)'''
+    if (ioTolerance is None):
+        ioTolerance = tolerance
+    rows = []
+    regressions = []
+    for name in sorted(set(baseline) | set(current)):
+        old = baseline.get(name)
+        new = current.get(name)
+        ratio = new / old if (old and new is not None) else None
+        rows.append((name, old, new, ratio))
+        limit = ioTolerance if name.startswith(IO_BOUND) else tolerance
+        if (ratio is not None and ratio > 1 + limit):
+            regressions.append(name)
+    return rows, regressions
+
+def formatTime(seconds):
+    if (seconds is None):
+        return "-"
+    return "{:.3f} us".format(seconds * 1e6)
+
+def main():
+    parser = argparse.ArgumentParser(description="Check benchmark results against a baseline")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--io-tolerance", type=float, default=1.0, help="tolerance for the I/O-bound benchmarks")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    if (baseline["meta"].get("quick") != current["meta"].get("quick")):
+        print("warning: comparing a --quick run against a full run", file=sys.stderr)
+
+    if (baseline["meta"].get("python") != current["meta"].get("python")):
+        print("warning: baseline is from Python {}, this run is {}".format(baseline["meta"].get("python"), current["meta"].get("python")), file=sys.stderr)
+
+    rows, regressions = compare(baseline["results"], current["results"], args.tolerance, args.io_tolerance)
+    for name, old, new, ratio in rows:
+        flag = "REGRESSED" if name in regressions else ""
+        ratioText = "{:.2f}x".format(ratio) if ratio is not None else "-"
+        print("{:<40} {:>14} {:>14} {:>8} {}".format(name, formatTime(old), formatTime(new), ratioText, flag))
+
+    if (regressions):
+        print("{} benchmark(s) regressed by more than {:.0%} ({:.0%} for I/O-bound ones)".format(len(regressions), args.tolerance, args.io_tolerance))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -24,14 +24,277 @@
 #   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 ###############################################################################
 
+import asyncio
+import json
 import logging
+import os
+import random
+
+from pykmm.journal import RekeyJournal
+from pykmm.kmm.commands import ModifyKeyCommand, RekeyCommand, RekeyAcknowledgment, NegativeAcknowledgment
+
+class RekeyFailed(Exception):
+    '''A radio answered a rekey with a negative acknowledgment or a non-zero key status'''
+    pass
 
 class RekeyApplication():
-    def __init__(self):
+    '''Rekeys one radio at a time over a DLI transport
+
+    keyset is a pykmm.kmm.keyset.KeySet; one Rekey-Command is sent per algorithm in it. addresses maps
+    each radio's unit ID to its (ip, port). With a RekeyJournal, every command sent and acknowledged is
+    recorded and commands a radio already acknowledged are skipped. Progress is tied to campaignHash,
+    the keyset's content hash, so it is never applied to a different set of keys with the same keyset ID.
+
+    Keys go out wrapped under a KEK: kekAlgId/kekKid name it and wrapKeys(rsi, command) is called on every
+    Rekey-Command to encrypt its key items under that radio's KEK, setting command.decryptionFormat and
+    command.encryptedBody. Sending keys in the clear is refused unless allowClear is set, which is only
+    meant for bench testing against radios and emulators that hold no real keys.
+    '''
+    def __init__(self, transport=None, keyset=None, addresses=None, srcRsi=0, journal=None,
+                 kekAlgId=ModifyKeyCommand.ALGID_CLEAR, kekKid=0, wrapKeys=None, allowClear=False):
         self.keyitem = None
+        self.transport = transport
+        self.journal = journal
+        self.addresses = addresses if addresses is not None else {}
+        self.srcRsi = srcRsi
+        self.kekAlgId = kekAlgId
+        self.kekKid = kekKid
+        self.wrapKeys = wrapKeys
+        self.allowClear = allowClear
+        self.keysetId = None
+        self.campaignHash = None
+        self._byAlgId = {}
+        if (keyset is not None):
+            self._checkKek()
+            self.setKeyset(keyset)
+
+    def _checkKek(self):
+        if (self.kekAlgId == ModifyKeyCommand.ALGID_CLEAR):
+            if (not self.allowClear):
+                raise ValueError("Refusing to send keys in the clear; give a KEK and wrapKeys, or allowClear=True on the bench")
+        elif (self.wrapKeys is None):
+            raise ValueError("KEK algorithm 0x{:02X} needs wrapKeys to encrypt the key items".format(self.kekAlgId))
+
+    def setKeyset(self, keyset):
+        '''Group the keyset's keys by algorithm once, so every radio reuses the same KeyItems'''
+        self.keysetId = keyset.keysetId
+        self.campaignHash = keyset.contentHash()
+        self._byAlgId = {}
+        for i in range(0, len(keyset)):
+            self._byAlgId.setdefault(keyset.algId(i), []).append(keyset.item(i))
+
+    def rekeyCommands(self, rsi):
+        self._checkKek()
+        for algId, keyItems in self._byAlgId.items():
+            command = RekeyCommand()
+            command.dstRsi = rsi
+            command.srcRsi = self.srcRsi
+            command.kekAlgId = self.kekAlgId
+            command.kekKid = self.kekKid
+            command.keysetId = self.keysetId
+            command.algId = algId
+            command.keys = keyItems
+            if (self.wrapKeys is not None):
+                self.wrapKeys(rsi, command)
+            yield command
+
+    async def rekey(self, rsi):
+        '''Send every Rekey-Command to a radio and check its acknowledgments'''
+        addr = self.addresses[rsi]
+        state = self.journalState()
+        for command in self.rekeyCommands(rsi):
+            if (state is not None and state.stepDone(rsi, command.algId)):
+                continue
+            self.recordJournal(RekeyJournal.SENT, rsi, command.algId)
+            reply = await self.transport.request(command, addr)
+            self._checkReply(rsi, reply)
+            self.recordJournal(RekeyJournal.ACKED, rsi, command.algId)
+
+    def journalState(self):
+        if (self.journal is None):
+            return None
+        return self.journal.state(self.keysetId, self.campaignHash)
+
+    def recordJournal(self, recordType, rsi, algId=0, status=0):
+        if (self.journal is not None):
+            self.journal.record(recordType, rsi, self.keysetId, self.campaignHash, algId, status=status)
+
+    @staticmethod
+    def _checkReply(rsi, reply):
+        if (isinstance(reply, NegativeAcknowledgment)):
+            raise RekeyFailed("Radio {} sent a negative acknowledgment with status 0x{:02X}".format(rsi, reply.status))
+        if (not isinstance(reply, RekeyAcknowledgment)):
+            raise RekeyFailed("Radio {} answered with unexpected message 0x{:02X}".format(rsi, reply.MESSAGE_ID))
+        for keyStatus in reply.statuses:
+            if (keyStatus.status != 0):
+                raise RekeyFailed("Radio {} rejected key 0x{:04X} with status 0x{:02X}".format(rsi, keyStatus.kid, keyStatus.status))
 
 class ManualRekeyApplication(RekeyApplication):
     def __init__(self):
-        super()
+        super().__init__()
         self._mfid = 0x00
-        self._usePreamble = False
\ No newline at end of file
+        self._usePreamble = False
+
+class TokenBucket():
+    '''Global send rate limit: rate tokens per second, up to burst at once'''
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate)
+        self._tokens = self.burst
+        self._lock = asyncio.Lock()
+        self._last = None
+
+    async def acquire(self):
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            while True:
+                now = loop.time()
+                if (self._last is not None):
+                    self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if (self._tokens >= 1):
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class RekeyCampaign():
+    '''Rekeys a list of radios concurrently
+
+    At most window radios are in flight at once and rekeys start no faster than rateLimit per second.
+    A radio that times out or is refused is retried after an exponential backoff (backoffBase * 2^n,
+    capped at backoffMax, with jitter) up to maxAttempts times; any other error fails that radio straight
+    away without affecting the rest. Acknowledged radios are checkpointed to checkpointPath so a restarted
+    campaign skips them; the checkpoint is written off the event loop, at most every checkpointInterval
+    seconds. When the application has a journal, radios it records as done are skipped too and the
+    checkpoint is only written at the end of the run.
+    '''
+    def __init__(self, application, targets, window=16, rateLimit=50, maxAttempts=5,
+                 backoffBase=1.0, backoffMax=60.0, checkpointPath=None, checkpointInterval=1.0):
+        self.application = application
+        self.targets = list(targets)
+        self.window = window
+        self.rateLimit = rateLimit
+        self.maxAttempts = maxAttempts
+        self.backoffBase = backoffBase
+        self.backoffMax = backoffMax
+        self.checkpointPath = checkpointPath
+        self.checkpointInterval = checkpointInterval
+
+        self.acked = set()
+        self.failed = {}
+        self.attempts = {}
+        self._checkpointWrite = None
+        self._lastCheckpoint = None
+        self._loadCheckpoint()
+        state = self.application.journalState()
+        if (state is not None):
+            self.acked |= state.done
+
+    def _loadCheckpoint(self):
+        if (self.checkpointPath is None or not os.path.exists(self.checkpointPath)):
+            return
+        with open(self.checkpointPath) as f:
+            checkpoint = json.load(f)
+        if (checkpoint.get("campaign") != self._campaignId()):
+            raise ValueError("Checkpoint {} is for a different keyset than keyset {}".format(self.checkpointPath, self.application.keysetId))
+        self.acked = set(checkpoint["acked"])
+
+    def _campaignId(self):
+        campaignHash = self.application.campaignHash
+        return campaignHash.hex() if campaignHash is not None else None
+
+    def checkpoint(self):
+        '''Atomically replace the checkpoint file with the current progress'''
+        if (self.checkpointPath is not None):
+            self._writeCheckpoint(self._checkpointData())
+
+    def _checkpointData(self):
+        # taken on the event loop so the writer thread never sees the sets change under it
+        return json.dumps({
+            "keysetId": self.application.keysetId,
+            "campaign": self._campaignId(),
+            "acked": sorted(self.acked),
+            "failed": {str(rsi): error for rsi, error in self.failed.items()},
+        })
+
+    def _writeCheckpoint(self, data):
+        tmpPath = self.checkpointPath + ".tmp"
+        with open(tmpPath, "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpPath, self.checkpointPath)
+
+    def _checkpointSoon(self):
+        '''Write the checkpoint in an executor, unless one is being written or was written too recently'''
+        if (self.checkpointPath is None or (self._checkpointWrite is not None and not self._checkpointWrite.done())):
+            return
+        loop = asyncio.get_running_loop()
+        if (self._lastCheckpoint is not None and loop.time() - self._lastCheckpoint < self.checkpointInterval):
+            return
+        self._lastCheckpoint = loop.time()
+        self._checkpointWrite = loop.run_in_executor(None, self._writeCheckpoint, self._checkpointData())
+
+    def backoff(self, attempt):
+        delay = min(self.backoffMax, self.backoffBase * (2 ** (attempt - 1)))
+        return delay * random.uniform(0.5, 1.0)
+
+    @property
+    def pending(self):
+        return [rsi for rsi in self.targets if rsi not in self.acked and rsi not in self.failed]
+
+    async def run(self):
+        '''Rekey every radio not already acknowledged; returns (acked, failed)'''
+        self._window = asyncio.Semaphore(self.window)
+        self._bucket = TokenBucket(self.rateLimit)
+        pending = self.pending
+        results = await asyncio.gather(*(self._rekeyRadio(rsi) for rsi in pending), return_exceptions=True)
+        for rsi, result in zip(pending, results):
+            # _rekeyRadio records its own failures, so this only catches what escaped it
+            if (isinstance(result, BaseException)):
+                self.failed.setdefault(rsi, str(result) or type(result).__name__)
+        if (self.application.journal is not None):
+            self.application.journal.sync()
+        if (self.checkpointPath is not None):
+            if (self._checkpointWrite is not None):
+                await self._checkpointWrite
+            await asyncio.get_running_loop().run_in_executor(None, self._writeCheckpoint, self._checkpointData())
+        return self.acked, self.failed
+
+    async def _rekeyRadio(self, rsi):
+        while True:
+            attempt = self.attempts[rsi] = self.attempts.get(rsi, 0) + 1
+            try:
+                # the window is only held for the exchange, not while backing off
+                async with self._window:
+                    await self._bucket.acquire()
+                    await self.application.rekey(rsi)
+            except Exception as e:
+                # a timeout, a refusal or a network error may clear up; anything else won't
+                retry = isinstance(e, (TimeoutError, asyncio.TimeoutError, RekeyFailed, OSError))
+                if (not retry or attempt >= self.maxAttempts):
+                    logging.warning("Giving up on radio {} after {} attempts: {!r}".format(rsi, attempt, e))
+                    self.failed[rsi] = str(e) or type(e).__name__
+                    self._progress(RekeyJournal.FAILED, rsi)
+                    return
+                delay = self.backoff(attempt)
+                logging.info("Radio {} attempt {} failed ({}), retrying in {:.1f}s".format(rsi, attempt, e, delay))
+                await asyncio.sleep(delay)
+            else:
+                self.acked.add(rsi)
+                self._progress(RekeyJournal.DONE, rsi)
+                return
+
+    def _progress(self, recordType, rsi):
+        if (self.application.journal is not None):
+            self.application.recordJournal(recordType, rsi)
+        else:
+            self._checkpointSoon()
+
+    def report(self):
+        return {
+            "targets": len(self.targets),
+            "acked": len(self.acked),
+            "failed": len(self.failed),
+            "attempts": sum(self.attempts.values()),
+        }
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+#
+# PyKMM - KMM and keyloading for Python
+# GPLv2 Open Source. Use is subject to license terms.
+# DO NOT ALTER OR REMOVE COPYRIGHT NOTICES OR THIS FILE HEADER.
+#
+# @package PyKMM
+#
+###############################################################################
+#   Copyright (C) 2022 Natalie Moore <natalie@natnat.xyz>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+###############################################################################
+
+import asyncio
+import os
+
+import serial
+
+from pykmm.deviceprotocol import OPKFD, KFDAVR
+from pykmm.multiplexer import ReplyMultiplexer
+
+class AsyncSerialTransport():
+    '''Non-blocking serial port driven by the asyncio event loop
+
+    The port's file descriptor is registered with the loop, so any number of keyloaders can be serviced
+    from one thread. Only available where the port exposes a selectable file descriptor (POSIX ttys).
+    If the port hangs up (adapter unplugged) the reader is removed and every read from then on raises
+    ConnectionError, so one dead adapter can't spin the loop for the others.
+    '''
+    def __init__(self, port, **serialArgs):
+        serialArgs["timeout"] = 0
+        self._serialPort = serial.serial_for_url(port, **serialArgs)
+        self._fd = self._serialPort.fileno()
+        os.set_blocking(self._fd, False)
+        self._loop = asyncio.get_running_loop()
+        self._rxBuffer = bytearray()
+        self._rxEvent = asyncio.Event()
+        self._error = None
+        self._reading = True
+        self._loop.add_reader(self._fd, self._onReadable)
+
+    def _onReadable(self):
+        try:
+            data = os.read(self._fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._hangUp(ConnectionError("Serial port read failed: {}".format(e)))
+            return
+        if (not data):
+            self._hangUp(ConnectionError("Serial port hung up"))
+            return
+        self._rxBuffer += data
+        self._rxEvent.set()
+
+    def _hangUp(self, error):
+        '''Stop watching the port and fail current and future reads with error'''
+        if (self._reading):
+            self._loop.remove_reader(self._fd)
+            self._reading = False
+        self._error = error
+        self._rxEvent.set()
+
+    async def write(self, data):
+        if (self._error is not None):
+            raise self._error
+        view = memoryview(data)
+        while view:
+            try:
+                written = os.write(self._fd, view)
+                view = view[written:]
+            except BlockingIOError:
+                written = 0
+            except OSError as e:
+                self._hangUp(ConnectionError("Serial port write failed: {}".format(e)))
+                raise self._error
+            if (view and written == 0):
+                ready = self._loop.create_future()
+                self._loop.add_writer(self._fd, ready.set_result, None)
+                try:
+                    await ready
+                finally:
+                    self._loop.remove_writer(self._fd)
+
+    async def readFrame(self, frameFormat):
+        '''Wait for the next complete frame and return its un-escaped payload'''
+        buf = self._rxBuffer
+        while True:
+            footer = buf.find(frameFormat.footer)
+            if (footer >= 0):
+                # a header restarts the frame, so only keep what follows the last one before the footer
+                header = buf.rfind(frameFormat.header, 0, footer)
+                frame = buf[header + 1:footer]
+                del buf[:footer + 1]
+                return frameFormat.unescapeBytes(frame)
+            if (self._error is not None):
+                raise self._error
+            self._rxEvent.clear()
+            await self._rxEvent.wait()
+
+    def close(self):
+        if (self._reading):
+            self._loop.remove_reader(self._fd)
+            self._reading = False
+        self._serialPort.close()
+
+class AsyncOPKFD():
+    '''asyncio counterpart of the OPKFD keyloader commands
+
+    deviceClass supplies the framing and command encoding (e.g. KFDAVR). Every exchange is bounded by
+    timeout seconds and can be cancelled; commands to the same keyloader are serialised with a lock.
+    Replies are matched to commands the same way the blocking class does, so a late reply to a command
+    that timed out is discarded instead of being taken as the answer to the next one.
+    '''
+    def __init__(self, transport, deviceClass=KFDAVR, timeout=2):
+        self._transport = transport
+        self._device = deviceClass
+        self.timeout = timeout
+        self._lock = asyncio.Lock()
+        # frames are read asynchronously in _awaitReply, so the multiplexer only does the matching
+        self._mux = ReplyMultiplexer(None, deviceClass._replyKey)
+
+    @classmethod
+    async def open(cls, port, deviceClass=KFDAVR, timeout=2):
+        '''Open port for deviceClass with the same serial settings the blocking class uses'''
+        serialArgs = {"baudrate": 115200}
+        if (deviceClass is KFDAVR):
+            # set DSR/DTR to prevent a reset upon connection
+            serialArgs["dsrdtr"] = True
+        return cls(AsyncSerialTransport(port, **serialArgs), deviceClass, timeout)
+
+    def close(self):
+        self._transport.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, excType, excValue, traceback):
+        self.close()
+
+    async def _transact(self, command):
+        '''Send one command and wait for the reply frame'''
+        async with self._lock:
+            pending = self._mux.expect(self._device._commandKey(command))
+            try:
+                await self._transport.write(self._device._encodeCommand(command))
+                await asyncio.wait_for(self._awaitReply(pending), self.timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError("KFD failed to reply in a timely manner.")
+            finally:
+                self._mux.cancel(pending)
+            return pending.reply
+
+    async def _awaitReply(self, pending):
+        '''Read frames until pending has its reply, discarding any that answer nothing outstanding'''
+        while not pending.done:
+            self._mux.dispatch(await self._transport.readFrame(self._device.FRAME_FORMAT))
+
+    async def selfTest(self):
+        resp = await self._transact([OPKFD.CMD_SELF_TEST])
+        return self._device._parseSelfTestReply(resp)
+
+    async def _readInfo(self, infoToRead):
+        '''Method to request data from keyloader'''
+        resp = await self._transact([OPKFD.CMD_READ_REQ, infoToRead])
+        subop, value = self._device._parseInfoReply(resp)
+        return value
+
+    async def getInstalledKeyInfo(self):
+        '''Return a list of KeyInfo for all keys installed on the keyloader'''
+        installedKeys = []
+        for i in range(0, self._device.MAX_INSTALLED_KEYS):
+            resp = await self._transact(self._device._keyInfoCommand(i))
+            info = self._device._parseKeyInfoReply(resp, i)
+            if (info is not None):
+                installedKeys.append(info)
+        return installedKeys
+
+    async def writeInstalledKey(self, slot, keyToInstall):
+        resp = await self._transact(self._device._writeKeyCommand(slot, keyToInstall))
+        self._device._parseWriteReply(resp)
+
+    async def zeroizeInstalledKeys(self):
+        resp = await self._transact(self._device.ZEROIZE_COMMAND)
+        self._device._parseWriteReply(resp)
@@ -25,16 +25,35 @@
 ###############################################################################
 
 from struct import unpack
+import collections
 import serial
 from enum import Enum
 import time
+import weakref
 
-from pykmm.kmm.items import KeyItem
+from pykmm.kmm.items import KeyItem, KeyInfo
+from pykmm.framing import FrameFormat, FrameTemplate, encode_frame
+from pykmm.instrumentation import Instrumentation
+from pykmm.multiplexer import ReplyMultiplexer
+from pykmm.serialsession import SerialSession
+
+class KFDWriteFailed(Exception):
+    '''Raised when the keyloader rejects a write request'''
+    pass
 
 class DLI():
-    def __init__(self):
-        self.ip = "0.0.0.0"
-        self.port = 1234
+    '''Local UDP endpoint for KMMs over DLI; open() binds it and returns a pykmm.dli.DLITransport'''
+    def __init__(self, ip="0.0.0.0", port=1234):
+        self.ip = ip
+        self.port = port
+
+    @property
+    def address(self):
+        return (self.ip, self.port)
+
+    async def open(self, **transportArgs):
+        from pykmm.dli import DLITransport
+        return await DLITransport.open(self.address, **transportArgs)
 
 class OPKFD():
     '''A generic class for communication with open source hardware keyloaders'''
@@ -83,7 +102,74 @@ class OPKFD():
     "SENSE_DATA_SHORT",
     ]
 
-    def __init__(self, port):
+    # reads issued by _getInfo, in the order the results are reported
+    INFO_READS = (READ_ADAPTER_VER, READ_FW_VER, READ_UID, READ_MODEL, READ_HW_REV, READ_SN)
+
+    # commands kept in flight by _pipeline; small enough not to overrun the adapter's receive buffer
+    PIPELINE_WINDOW = 4
+
+    # read sub-opcodes whose request and reply carry a slot number after the sub-opcode
+    SLOT_READS = ()
+
+    # set by each keyloader class; its constant commands are framed once when the class is defined
+    FRAME_FORMAT = None
+    # command tuple -> framed bytes
+    _frameCache = {}
+
+    # session -> (opens, reconnects, adapter metadata), so keyloaders borrowing a session don't each re-query
+    # the keyloader; reopening or reconnecting the port (possibly to a swapped adapter) invalidates the entry
+    _infoCache = weakref.WeakKeyDictionary()
+
+    # Instrumentation collecting traffic statistics, or None to skip all bookkeeping
+    _instr = None
+
+    # seconds to wait for a reply until the adapter's latency for that command has been measured
+    REPLY_TIMEOUT = 2.0
+    # floor of the measured per-command timeout, to ride out OS scheduling and USB hiccups
+    MIN_REPLY_TIMEOUT = 0.25
+    # replies to a command that must be timed before its timeout adapts
+    LATENCY_WARMUP = 4
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if (cls.FRAME_FORMAT is not None):
+            cls._buildFrames()
+
+    @classmethod
+    def _constantCommands(cls):
+        '''Commands whose bytes never change, so they can be framed ahead of time'''
+        commands = [[OPKFD.CMD_READ_REQ, i] for i in OPKFD.INFO_READS]
+        commands.append([OPKFD.CMD_SELF_TEST])
+        return commands
+
+    @classmethod
+    def _buildFrames(cls):
+        '''Frame every constant command with this class's FRAME_FORMAT; runs once per class, at definition'''
+        cls._frameCache = {tuple(command): encode_frame(command, cls.FRAME_FORMAT) for command in cls._constantCommands()}
+
+    @classmethod
+    def _encodeCommand(cls, command):
+        '''Framed bytes for command, straight from the cache when it is a constant one'''
+        frame = cls._frameCache.get(tuple(command))
+        if (frame is None):
+            frame = encode_frame(command, cls.FRAME_FORMAT)
+        return frame
+
+    def __init__(self, port, session=None, **serialArgs):
+        '''Borrow the port handle from session if one is given, otherwise open a private session on port with serialArgs'''
+        self._port = port
+        # a borrowed session is left open when this keyloader is closed
+        self._ownsSession = (session is None)
+        if (session is None):
+            session = SerialSession(port, **serialArgs)
+        self._session = session
+        # (command key, time sent) for every command still waiting on its reply, oldest first
+        self._awaiting = collections.deque()
+        # command key -> [replies timed, smoothed latency, latency deviation]
+        self._latency = {}
+        self._lastReplyAt = 0.0
+        # pairs replies with the requests waiting on them
+        self._mux = ReplyMultiplexer(self.readFromSerial, self._replyKey)
         self.AdapterProtocolVersion = None
         self.FirmwareVersion = None
         self.UID = None
@@ -91,58 +177,165 @@ class OPKFD():
         self.HardwareRevision = None
         self.SerialNumber = None
 
-    def _getInfo(self):
-        '''Method to collect all applicable metadata (adapter protocol, firmware version, etc) from the keyloader and update the object'''
+    def _getInfo(self, refresh=False):
+        '''Method to collect all applicable metadata (adapter protocol, firmware version, etc) from the keyloader and update the object
+
+        Results are cached per session until its port is reopened; pass refresh=True (or call refresh()) to query
+        the keyloader again.
+        '''
         self._openSerial()
-        self.AdapterProtocolVersion = self._readInfo(OPKFD.READ_ADAPTER_VER)
-        self.FirmwareVersion = self._readInfo(OPKFD.READ_FW_VER)
-        self.UID = self._readInfo(OPKFD.READ_UID)
-        self.ModelNumber = self._readInfo(OPKFD.READ_MODEL)
-        self.HardwareRevision = self._readInfo(OPKFD.READ_HW_REV)
-        self.SerialNumber = self._readInfo(OPKFD.READ_SN)
-        self._closeSerial()
+        session = self._session
+        cached = None if refresh else OPKFD._infoCache.get(session)
+        if (cached is not None and cached[:2] == (session.opens, session.reconnects)):
+            info = cached[2]
+        else:
+            info = self._readInfoPipelined(OPKFD.INFO_READS)
+            # read the counters afterwards, in case the reads themselves forced a reconnect
+            OPKFD._infoCache[session] = (session.opens, session.reconnects, info)
+
+        self.AdapterProtocolVersion = info[OPKFD.READ_ADAPTER_VER]
+        self.FirmwareVersion = info[OPKFD.READ_FW_VER]
+        self.UID = info[OPKFD.READ_UID]
+        self.ModelNumber = info[OPKFD.READ_MODEL]
+        self.HardwareRevision = info[OPKFD.READ_HW_REV]
+        self.SerialNumber = info[OPKFD.READ_SN]
+
+    def refresh(self):
+        '''Re-read the keyloader metadata, replacing any cached copy'''
+        self._getInfo(refresh=True)
 
     def _readInfo(self, infoToRead):
         '''Method to request data from keyloader'''
         command = [OPKFD.CMD_READ_REQ, infoToRead]
-        self.writeToSerial(command)
-        resp = self.readFromSerial()
-        
+        resp = self._transact(command)
+        subop, value = self._parseInfoReply(resp)
+        return value
+
+    def _readInfoPipelined(self, infoToRead):
+        '''Stream the read requests through _pipeline and let the multiplexer pair the replies back up by sub-opcode
+
+        Returns a dict of sub-opcode to value.
+        '''
+        commands = [[OPKFD.CMD_READ_REQ, i] for i in infoToRead]
+        info = {}
+        for resp in self._pipeline(commands):
+            subop, value = self._parseInfoReply(resp)
+            info[subop] = value
+        return info
+
+    @classmethod
+    def _commandKey(cls, command):
+        '''(opcode, sub-opcode, slot) describing the reply a command expects'''
+        opcode = command[0]
+        subop = command[1] if (opcode in (OPKFD.CMD_READ_REQ, OPKFD.CMD_WRITE_REQ) and len(command) > 1) else None
+        slot = command[2] if (opcode == OPKFD.CMD_READ_REQ and subop in cls.SLOT_READS and len(command) > 2) else None
+        return (opcode, subop, slot)
+
+    @classmethod
+    def _replyKey(cls, resp):
+        '''Key of the request a reply answers, None for an error reply, which goes to the oldest request,
+        or ReplyMultiplexer.DISCARD for a frame too short to answer anything'''
+        if (not resp):
+            return ReplyMultiplexer.DISCARD
+        opcode = resp[0]
+        if (opcode == OPKFD.REPLY_ERROR):
+            return None
+        if (opcode in (OPKFD.REPLY_READ, OPKFD.REPLY_WRITE) and len(resp) < 2):
+            return ReplyMultiplexer.DISCARD
+        # every reply opcode is its command opcode + 0x10
+        subop = resp[1] if (opcode in (OPKFD.REPLY_READ, OPKFD.REPLY_WRITE)) else None
+        slot = None
+        if (opcode == OPKFD.REPLY_READ and subop in cls.SLOT_READS):
+            if (len(resp) < 3):
+                return ReplyMultiplexer.DISCARD
+            slot = resp[2]
+        return (opcode - 0x10, subop, slot)
+
+    def _transact(self, command):
+        '''Send one command and return its reply, handing any other replies that turn up to their own waiters'''
+        pending = self._mux.expect(self._commandKey(command))
+        try:
+            self.writeToSerial(command)
+        except BaseException:
+            self._mux.cancel(pending)
+            raise
+        return self._mux.wait(pending)
+
+    @staticmethod
+    def _parseInfoReply(resp):
+        '''Decode a READ_REPLY frame into its sub-opcode and value'''
         opcode = resp[0]
         subop = resp[1]
         if (opcode == OPKFD.REPLY_READ):
             if (subop == OPKFD.READ_ADAPTER_VER):
                 adpver = "{}.{}.{}".format(resp[2], resp[3], resp[4])
-                return adpver
+                return subop, adpver
             elif (subop == OPKFD.READ_FW_VER):
                 fwver = "{}.{}.{}".format(resp[2], resp[3], resp[4])
-                return fwver
+                return subop, fwver
             elif (subop == OPKFD.READ_UID):
-                uid = ""
-                for i in range(2, len(resp)):
-                    uid += "{}".format(resp[i])
-                return uid
+                uid = "".join("{}".format(b) for b in resp[2:])
+                return subop, uid
             elif (subop == OPKFD.READ_MODEL):
                 modelno = resp[2]
-                return modelno
+                return subop, modelno
             elif (subop == OPKFD.READ_HW_REV):
                 hwrev = "{}.{}".format(resp[2], resp[3])
-                return hwrev
+                return subop, hwrev
             elif (subop == OPKFD.READ_SN):
                 serialLength = resp[2]
-                serialNo = ""
                 if (serialLength > 0):
-                    for i in range(3, serialLength+3):
-                        print("Serial number byte: {}".format(resp[i]))
-                        serialNo += "{}".format(str(resp[i]))
+                    serialNo = "".join(str(b) for b in resp[3:serialLength+3])
                 else:
                     serialNo = "NOT SET"
-                return serialNo
+                return subop, serialNo
             else:
                 raise Exception("Unknown data type received: {}".format(subop))
         else:
             raise Exception("Expected READ_REPLY opcode (0x21) but got {}".format(opcode))
 
+    def _pipeline(self, commands, window=None):
+        '''Send commands keeping up to window of them in flight, returning each command's reply in order'''
+        frames = [self._encodeCommand(command) for command in commands]
+        ends = []
+        end = 0
+        for frame in frames:
+            end += len(frame)
+            ends.append(end)
+        return self._streamFrames(b"".join(frames), ends, [self._commandKey(command) for command in commands], window)
+
+    def _streamFrames(self, buffer, ends, keys, window=None):
+        '''Write the already framed commands in buffer (each ending at the matching offset in ends, and
+        expecting the reply described by the matching entry of keys) back-to-back, keeping up to window
+        of them unacknowledged, and return their replies in order'''
+        if (window is None):
+            window = self.PIPELINE_WINDOW
+        view = memoryview(buffer)
+        mux = self._mux
+        self._openSerial()
+        sent = min(window, len(ends))
+        pending = [mux.expect(keys[i]) for i in range(0, sent)]
+        try:
+            if (sent):
+                self._session.write(view[:ends[sent - 1]])
+                for i in range(0, sent):
+                    self._commandSent(view[ends[i - 1] if i else 0:ends[i]])
+            replies = []
+            for i in range(0, len(ends)):
+                replies.append(mux.wait(pending[i]))
+                if (sent < len(ends)):
+                    pending.append(mux.expect(keys[sent]))
+                    frame = view[ends[sent - 1]:ends[sent]]
+                    self._session.write(frame)
+                    self._commandSent(frame)
+                    sent += 1
+        except BaseException:
+            # nothing else will wait on the rest of the burst
+            for request in pending:
+                mux.cancel(request)
+            raise
+        return replies
+
     def writeModelInfo(self, hwid, hwrevMaj, hwrevMin):
         c = self._genInfoBytes(KFDTool.CMD_WRITE_REQ, KFDTool.WRITE_MODEL, hwid, hwrevMaj, hwrevMin)
         #print("Writing bytes: {}".format(c))
@@ -181,28 +374,156 @@ class OPKFD():
 
     def selfTest(self):
         command = [OPKFD.CMD_SELF_TEST]
-        self.writeToSerial(command)
-        resp = self.readFromSerial()
+        resp = self._transact(command)
+        return self._parseSelfTestReply(resp)
+
+    @staticmethod
+    def _parseSelfTestReply(resp):
         assert resp[0] == OPKFD.REPLY_SELF_TEST
         return resp[1]
         
     def sendTwiByte(self, byte):
-        command = [OPKFD.CMD_SEND_BYTE + 0x00 + byte]
-        self.writeToSerial(command)
+        # opcode, reserved, byte
+        command = [OPKFD.CMD_SEND_BYTE, 0x00, byte]
+        resp = self._transact(command)
+        if (resp[0] != OPKFD.REPLY_SEND_BYTE):
+            raise Exception("KFD replied with error {}".format(resp[1] if len(resp) > 1 else None))
 
     def writeToSerial(self, command):
         """Frames and sends data to the keyloader"""
         raise NotImplementedError("Must be implemented in child class to frame and send data")
 
+    def writeManyToSerial(self, commands):
+        """Frames and sends several commands back-to-back without waiting for replies"""
+        for command in commands:
+            self.writeToSerial(command)
+
     def readFromSerial(self):
         """Blocking method to read and un-frame data from the keyloader"""
         raise NotImplementedError("Must be implemented in child class to frame and send data")
 
+    def enableInstrumentation(self, instrumentation=None):
+        '''Start collecting per-opcode counts, byte counts and latencies; returns the Instrumentation'''
+        if (instrumentation is None):
+            instrumentation = Instrumentation()
+        instrumentation.session = self._session
+        self._instr = instrumentation
+        return instrumentation
+
+    def disableInstrumentation(self):
+        self._instr = None
+
+    @property
+    def instrumentation(self):
+        return self._instr
+
+    def _commandSent(self, frame):
+        '''Note a framed command as written, to time its reply'''
+        key = (frame[1], frame[2] if len(frame) > 3 else None)
+        self._awaiting.append((key, time.monotonic()))
+        if (self._instr is not None):
+            self._instrumentSent(frame)
+
+    def _replyDeadline(self):
+        '''Monotonic time by which the oldest outstanding command's reply should have arrived
+
+        The adapter works through commands one at a time, so a pipelined command's clock starts when the
+        reply before it arrived. Once a command has been timed LATENCY_WARMUP times its timeout is the
+        smoothed latency plus four deviations (as for TCP retransmits), between MIN_REPLY_TIMEOUT and
+        REPLY_TIMEOUT.
+        '''
+        if (not self._awaiting):
+            return time.monotonic() + self.REPLY_TIMEOUT
+        key, sentAt = self._awaiting[0]
+        start = max(sentAt, self._lastReplyAt)
+        stats = self._latency.get(key)
+        if (stats is None or stats[0] < self.LATENCY_WARMUP):
+            return start + self.REPLY_TIMEOUT
+        return start + min(self.REPLY_TIMEOUT, max(self.MIN_REPLY_TIMEOUT, stats[1] + 4 * stats[2]))
+
+    def _replyReceived(self):
+        '''Time the reply to the oldest outstanding command; returns that command's (key, sentAt), or None'''
+        now = time.monotonic()
+        answered = None
+        if (self._awaiting):
+            key, sentAt = answered = self._awaiting.popleft()
+            sample = now - max(sentAt, self._lastReplyAt)
+            stats = self._latency.get(key)
+            if (stats is None):
+                self._latency[key] = [1, sample, sample / 2]
+            else:
+                stats[0] += 1
+                stats[2] += (abs(sample - stats[1]) - stats[2]) / 4
+                stats[1] += (sample - stats[1]) / 8
+        self._lastReplyAt = now
+        return answered
+
+    def _replyLost(self):
+        '''Drop the oldest command's timing after its reply timed out or arrived corrupted'''
+        if (self._awaiting):
+            self._awaiting.popleft()
+        self._lastReplyAt = time.monotonic()
+
+    def replyTimeouts(self):
+        '''Current reply timeout in seconds for every command timed so far, keyed by (opcode, sub-opcode)'''
+        timeouts = {}
+        for key, (count, latency, deviation) in self._latency.items():
+            if (count < self.LATENCY_WARMUP):
+                timeouts[key] = self.REPLY_TIMEOUT
+            else:
+                timeouts[key] = min(self.REPLY_TIMEOUT, max(self.MIN_REPLY_TIMEOUT, latency + 4 * deviation))
+        return timeouts
+
+    def _instrumentSent(self, frame):
+        '''Record one framed command; opcodes never collide with framing bytes, so frame[1] is always the opcode'''
+        escapedLength = len(frame) - 2
+        self._instr.commandSent(frame[1], escapedLength - bytes(frame).count(self.FRAME_FORMAT.escape), escapedLength)
+
+    def _instrumentReceived(self, escapedLength, payload, answered):
+        opcode = payload[0] if payload else None
+        if (answered is None):
+            self._instr.frameReceived(opcode, len(payload), escapedLength)
+        else:
+            (commandOpcode, subop), sentAt = answered
+            self._instr.frameReceived(opcode, len(payload), escapedLength, commandOpcode, self._lastReplyAt - sentAt)
+
+    def _instrumentFirstByte(self):
+        if (self._awaiting):
+            (commandOpcode, subop), sentAt = self._awaiting[0]
+            self._instr.firstByte(commandOpcode, time.monotonic() - sentAt)
+
+    @property
+    def session(self):
+        '''The SerialSession this keyloader talks through'''
+        return self._session
+
+    @property
+    def _serialPort(self):
+        return self._session.port
+
     def _openSerial(self):
-        raise NotImplementedError
+        self._session.open()
 
     def _closeSerial(self):
-        raise NotImplementedError
+        if (self._ownsSession):
+            self._session.close()
+        else:
+            #the port belongs to whoever handed us the session
+            pass
+
+    def close(self):
+        '''Release the port; a borrowed session stays open for its owner'''
+        self._closeSerial()
+
+    def keepalive(self):
+        '''Run a self test if the session has been idle past its keepalive interval'''
+        return self._session.keepalive(self.selfTest)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
 
 class KFDTool(OPKFD):
     '''Class to handle communication with the KFDTool'''
@@ -211,9 +532,11 @@ class KFDTool(OPKFD):
     SERIAL_ESC = 0x63
     SERIAL_ESC_PLACEHOLDER = 0x64
 
-    def __init__(self, port):
-        super()
-        self._serialPort = serial.Serial(port, 115200, timeout=2)
+    FRAME_FORMAT = FrameFormat(SERIAL_HEADERFOOTER, SERIAL_HEADERFOOTER, SERIAL_ESC,
+                               SERIAL_HEADERFOOTER_PLACEHOLDER, SERIAL_HEADERFOOTER_PLACEHOLDER, SERIAL_ESC_PLACEHOLDER)
+
+    def __init__(self, port, session=None):
+        super().__init__(port, session, baudrate=115200, timeout=2)
         self._getInfo()
 
     def _getInfo(self):
@@ -234,157 +557,260 @@ class KFDAVR(OPKFD):
     SERIAL_ESC = 0x70
     SERIAL_ESC_PLACEHOLDER = 0x71
 
+    FRAME_FORMAT = FrameFormat(SERIAL_HEADER, SERIAL_FOOTER, SERIAL_ESC,
+                               SERIAL_HEADER_PLACEHOLDER, SERIAL_FOOTER_PLACEHOLDER, SERIAL_ESC_PLACEHOLDER)
+
     READ_KEY_INFO = 0x07
+    SLOT_READS = (READ_KEY_INFO,)
 
     WRITE_KEY = 0x03
 
     MAX_INSTALLED_KEYS = 15
 
-    def __init__(self, port):
-        super()
-        # set DSR/DTR to prevent a reset upon connection
-        self._serialPort = serial.Serial(port, 
-                                         baudrate=115200,
-                                         timeout=2,
-                                         xonxoff=0,
-                                         rtscts=0,
-                                         dsrdtr=True
-                                         )
-        self._getInfo()
+    # writing a key to this slot clears every slot
+    ZEROIZE_SLOT = 0xFE
+    ZEROIZE_COMMAND = [OPKFD.CMD_WRITE_REQ, WRITE_KEY, ZEROIZE_SLOT]
 
-    def _openSerial(self):
-        if (self._serialPort.is_open):
-            #don't open an already open port
-            pass
-        else:
-            self._serialPort.open()
+    @classmethod
+    def _constantCommands(cls):
+        commands = super()._constantCommands()
+        commands.extend([OPKFD.CMD_READ_REQ, cls.READ_KEY_INFO, slot] for slot in range(0, cls.MAX_INSTALLED_KEYS))
+        commands.append(cls.ZEROIZE_COMMAND)
+        return commands
 
-    def _closeSerial(self):
-        if (self._serialPort.is_open):
-            self._serialPort.close()
-        else:
-            #don't close an already closed port
-            pass
+    @classmethod
+    def _buildFrames(cls):
+        super()._buildFrames()
+        # only the slot, SLN, KID and key bytes of a key write vary
+        cls._writeKeyTemplate = FrameTemplate(cls.FRAME_FORMAT, [OPKFD.CMD_WRITE_REQ, cls.WRITE_KEY])
+
+    def __init__(self, port, session=None):
+        # set DSR/DTR to prevent a reset upon connection
+        super().__init__(port, session,
+                         baudrate=115200,
+                         timeout=2,
+                         xonxoff=0,
+                         rtscts=0,
+                         dsrdtr=True
+                         )
+        # bytes received from the port that have not been consumed as a frame yet
+        self._rxBuffer = bytearray()
+        # slot table from the last inventory, None until read or after it has been invalidated
+        self._installedKeys = None
+        self._getInfo()
 
     def writeToSerial(self, command):
         """Frames and sends data to the keyloader"""
         self._openSerial()
-        toSend = bytearray()
-        toSend.append(KFDAVR.SERIAL_HEADER)
-
-        # iterate through bytes and escape if needed
-        for b in command:
-            if (b == KFDAVR.SERIAL_ESC):
-                toSend.append(KFDAVR.SERIAL_ESC)
-                toSend.append(KFDAVR.SERIAL_ESC_PLACEHOLDER)
-
-            elif (b == KFDAVR.SERIAL_HEADER):
-                toSend.append(KFDAVR.SERIAL_ESC)
-                toSend.append(KFDAVR.SERIAL_HEADER_PLACEHOLDER)
-            
-            elif (b == KFDAVR.SERIAL_FOOTER):
-                toSend.append(KFDAVR.SERIAL_ESC)
-                toSend.append(KFDAVR.SERIAL_FOOTER_PLACEHOLDER)
-
-            else:
-                toSend.append(b)
-
-        toSend.append(KFDAVR.SERIAL_FOOTER)
-
-        self._serialPort.write(toSend)
+        toSend = self._encodeCommand(command)
+        self._session.write(toSend)
+        self._commandSent(toSend)
 
-    def readFromSerial(self):
-        unpackedData = []
-        fullFrameReceived = False
-        #set a timeout so we don't loop forever, 2 sec is probably fine
-        t_end = time.time() + 2
-        while time.time() < t_end:
-            b = self._serialPort.read(1)
-            b = int.from_bytes(b, "big")
-            if (b == KFDAVR.SERIAL_HEADER):
-                # if we get a header, clear the buffer
-                unpackedData = []
-            elif (b == KFDAVR.SERIAL_FOOTER):
-                #clean up and un-escape bytes
-                for i in range(0, len(unpackedData)):
-                    if (unpackedData[i] == KFDAVR.SERIAL_ESC):
-                        del unpackedData[i]
-                        if (unpackedData[i] == KFDAVR.SERIAL_ESC_PLACEHOLDER):
-                            unpackedData[i] = KFDAVR.SERIAL_ESC
-                        elif (unpackedData[i] == KFDAVR.SERIAL_HEADER_PLACEHOLDER):
-                            unpackedData[i] = KFDAVR.SERIAL_HEADER
-                        elif (unpackedData[i] == KFDAVR.SERIAL_FOOTER_PLACEHOLDER):
-                            unpackedData[i] = KFDAVR.SERIAL_FOOTER
-                        else:
-                            raise Exception("Invalid character after escape")
-                fullFrameReceived = True
+    def writeManyToSerial(self, commands):
+        """Frames several commands and sends them in a single write"""
+        self._openSerial()
+        frames = [self._encodeCommand(command) for command in commands]
+        self._session.write(b"".join(frames))
+        for frame in frames:
+            self._commandSent(frame)
+
+    def _fillRxBuffer(self, timeout):
+        """Wait up to timeout seconds for bytes and move everything the port has into the receive buffer"""
+        chunk = self._session.readAvailable(timeout)
+        self._rxBuffer += chunk
+        return len(chunk)
+
+    def readFromSerial(self, timeout=None):
+        """Blocking method to read and un-frame data from the keyloader
+
+        Sleeps on the port until bytes arrive rather than polling, and keeps any bytes past the footer in
+        the receive buffer for the next call. Gives up after timeout seconds, or by default once the
+        deadline measured for the command being answered (see _replyDeadline) has passed.
+        """
+        buf = self._rxBuffer
+        instr = self._instr
+        deadline = self._replyDeadline() if timeout is None else time.monotonic() + timeout
+        # where the footer search picks up again, so bytes are only scanned once
+        scanned = 0
+        while True:
+            footer = buf.find(KFDAVR.SERIAL_FOOTER, scanned)
+            if (footer >= 0):
+                # a header restarts the frame, so only keep what follows the last one before the footer
+                header = buf.rfind(KFDAVR.SERIAL_HEADER, 0, footer)
+                if (header < 0):
+                    # the tail of a frame whose header we never saw, so not a reply to anything
+                    del buf[:footer + 1]
+                    scanned = 0
+                    continue
+                frame = buf[header + 1:footer]
+                del buf[:footer + 1]
+                try:
+                    payload = KFDAVR.FRAME_FORMAT.unescapeBytes(frame)
+                except ValueError:
+                    # the corrupted frame still used up the oldest command's reply
+                    self._replyLost()
+                    raise
+                answered = self._replyReceived()
+                if (instr is not None):
+                    self._instrumentReceived(len(frame), payload, answered)
+                return payload
+
+            # no footer yet, so anything before the newest header belongs to an abandoned frame
+            header = buf.rfind(KFDAVR.SERIAL_HEADER)
+            if (header > 0):
+                del buf[:header]
+            elif (header < 0):
+                buf.clear()
+            scanned = len(buf)
+
+            remaining = deadline - time.monotonic()
+            if (remaining <= 0):
                 break
-            else:
-                unpackedData.append(b)
-
-        if (fullFrameReceived):
-            return unpackedData
-        else:
-            raise TimeoutError("KFD failed to reply in a timely manner.")
-            return
+            idle = not buf
+            if (self._fillRxBuffer(remaining) and idle and instr is not None):
+                self._instrumentFirstByte()
+
+        self._replyLost()
+        if (instr is not None):
+            instr.timeout()
+        raise TimeoutError("KFD failed to reply in a timely manner.")
     
-    def getInstalledKeyInfo(self):
-        '''Return a list of all keys installed on the KFD-AVR'''
-        installedKeys = []
-        for i in range(0, KFDAVR.MAX_INSTALLED_KEYS):
-            command = [OPKFD.CMD_READ_REQ, KFDAVR.READ_KEY_INFO, i]
-            self.writeToSerial(command)
-            resp = self.readFromSerial()
-            
-            opcode = resp[0]
-            subop = resp[1]
-            print(opcode)
-            print(subop)
-            if (opcode == OPKFD.ERROR_READ_FAILED):
+    def getInstalledKeyInfo(self, refresh=False):
+        '''Return a list of KeyInfo for all keys installed on the KFD-AVR
+
+        The slot queries are pipelined, and the result is cached until a key is written or zeroized (or refresh is set).
+        '''
+        if (self._installedKeys is None or refresh):
+            commands = [KFDAVR._keyInfoCommand(i) for i in range(0, KFDAVR.MAX_INSTALLED_KEYS)]
+            installedKeys = []
+            for slot, resp in enumerate(self._pipeline(commands)):
+                info = KFDAVR._parseKeyInfoReply(resp, slot)
+                if (info is not None):
+                    installedKeys.append(info)
+            self._installedKeys = installedKeys
+        return list(self._installedKeys)
+
+    @staticmethod
+    def _keyInfoCommand(slot):
+        return [OPKFD.CMD_READ_REQ, KFDAVR.READ_KEY_INFO, slot]
+
+    @staticmethod
+    def _parseKeyInfoReply(resp, slot):
+        '''Decode the key info reply for slot into a KeyInfo, or None if the slot is empty'''
+        opcode = resp[0]
+        if (opcode == OPKFD.REPLY_ERROR):
+            if (resp[1] == OPKFD.ERROR_READ_FAILED):
                 #there probably isn't a key here
-                pass
-            elif (opcode == OPKFD.REPLY_READ):
-                if (opcode == KFDAVR.READ_KEY_INFO):
-                    ckr |= resp[4] << 8
-                    ckr |= resp[5]
-                    kid |= resp[6] << 8
-                    kid |= resp[7]
-                else:
-                    raise Exception("KFD replied with unknown read data")
+                return None
+            else:
+                raise Exception("KFD replied with error {}".format(resp[1]))
+        elif (opcode == OPKFD.REPLY_READ):
+            if (resp[1] == KFDAVR.READ_KEY_INFO):
+                if (resp[2] != slot):
+                    raise Exception("KFD replied with info for slot {} but slot {} was requested".format(resp[2], slot))
+                info = KeyInfo()
+                info.slot = slot
+                info.sln = (resp[4] << 8) | resp[5]
+                info.kid = (resp[6] << 8) | resp[7]
+                return info
             else:
-                raise Exception("KFD replied with unknown opcode")
+                raise Exception("KFD replied with unknown read data")
+        else:
+            raise Exception("KFD replied with unknown opcode")
 
     def writeInstalledKey(self, slot, keyToInstall):
+        command = KFDAVR._writeKeyCommand(slot, keyToInstall)
+        # whatever happens the cached slot table can no longer be trusted
+        self._installedKeys = None
+        KFDAVR._parseWriteReply(self._transact(command))
+
+    def writeInstalledKeys(self, slotsAndItems, window=None):
+        '''Write a whole keyset, given as (slot, KeyItem) pairs, in one pipelined burst
+
+        Every pair is validated before anything is sent. All write commands are framed into one buffer
+        and streamed with up to window writes awaiting acknowledgement. Raises KFDWriteFailed listing
+        the slots the keyloader rejected once every reply has been read.
+        '''
+        slotsAndItems = list(slotsAndItems)
+        slots = [slot for slot, item in slotsAndItems]
+        seen = set()
+        for slot in slots:
+            if (slot in seen):
+                raise ValueError("Slot {} appears more than once in the keyset".format(slot))
+            seen.add(slot)
+        frames = [self._writeKeyFrame(slot, item) for slot, item in slotsAndItems]
+
+        buffer = bytearray(sum(len(frame) for frame in frames))
+        ends = []
+        end = 0
+        for frame in frames:
+            buffer[end:end + len(frame)] = frame
+            end += len(frame)
+            ends.append(end)
+
+        self._installedKeys = None
+        failed = []
+        keys = [(OPKFD.CMD_WRITE_REQ, KFDAVR.WRITE_KEY, None)] * len(frames)
+        for slot, resp in zip(slots, self._streamFrames(buffer, ends, keys, window)):
+            try:
+                KFDAVR._parseWriteReply(resp)
+            except KFDWriteFailed:
+                failed.append(slot)
+        if (failed):
+            raise KFDWriteFailed("KFD rejected writes to slots {}".format(failed))
+
+    @staticmethod
+    def _checkWrite(slot, keyToInstall):
         if (not isinstance(slot, int)):
             raise TypeError("Slot must be an int, not {}".format(type(slot)))
-        if (slot > KFDAVR.MAX_INSTALLED_KEYS):
+        if (slot < 0 or slot >= KFDAVR.MAX_INSTALLED_KEYS):
             raise ValueError("You tried to install a key into slot {}; while the device supports a maximum of {} slots.".format(slot, KFDAVR.MAX_INSTALLED_KEYS))
+        if (not isinstance(keyToInstall, KeyItem)):
+            raise TypeError("You must pass a KeyItem type to me; see pykmm.kmm.items.KeyItem")
 
-        if (isinstance(keyToInstall, KeyItem)):
-            command = [OPKFD.CMD_WRITE_REQ, KFDAVR.WRITE_KEY]
-            command[2] = (slot >> 8) & 0xFF
-            command[3] = 0  # flags are reserved for now
-            command[4] = (keyToInstall.sln >> 8) & 0xFF
-            command[5] = (keyToInstall.sln & 0xFF)
-            command[6] = (keyToInstall.kid >> 8) & 0xFF
-            command[7] = (keyToInstall.kid & 0xFF)
-
-            for b in keyToInstall.key:
-                command.append(b)
+    @staticmethod
+    def _writeKeyCommand(slot, keyToInstall):
+        KFDAVR._checkWrite(slot, keyToInstall)
+        command = [OPKFD.CMD_WRITE_REQ, KFDAVR.WRITE_KEY,
+                   slot & 0xFF,
+                   0,  # flags are reserved for now
+                   (keyToInstall.sln >> 8) & 0xFF,
+                   (keyToInstall.sln & 0xFF),
+                   (keyToInstall.kid >> 8) & 0xFF,
+                   (keyToInstall.kid & 0xFF)]
+
+        command.extend(keyToInstall.keyBytes)
+        return command
+
+    @classmethod
+    def _writeKeyFrame(cls, slot, keyToInstall):
+        '''The framed bytes of _writeKeyCommand, built from the prebuilt write key template'''
+        KFDAVR._checkWrite(slot, keyToInstall)
+        sln = keyToInstall.sln
+        kid = keyToInstall.kid
+        return cls._writeKeyTemplate.build(slot, 0, sln >> 8, sln & 0xFF, kid >> 8, kid & 0xFF, keyToInstall.keyBytes)
+
+    @staticmethod
+    def _parseWriteReply(resp):
+        if (resp[0] == OPKFD.REPLY_WRITE):
+            return
+        elif (resp[0] == OPKFD.REPLY_ERROR):
+            raise KFDWriteFailed("KFD rejected write with error {}".format(resp[1] if len(resp) > 1 else None))
         else:
-            raise TypeError("You must pass a KeyItem type to me; see pykmm.kmm.items.KeyItem")
+            raise Exception("KFD replied with unknown opcode")
 
     def zeroizeInstalledKeys(self):
-        command = [OPKFD.CMD_WRITE_REQ, KFDAVR.WRITE_KEY, 0xFE]
-        self.writeToSerial(command)
-        
+        self._installedKeys = None
+        KFDAVR._parseWriteReply(self._transact(KFDAVR.ZEROIZE_COMMAND))
+        self._installedKeys = []
+
     def enterBootloader(self):
         raise NotImplementedError("Bootloader mode does not exist on KFD-AVR")
 
 def main():
     '''Execute basic test gathering info from connected keyloader'''
     import sys
-    serialPort = 'COM3'
+    serialPort = sys.argv[1] if len(sys.argv) > 1 else 'COM3'
     kfd = KFDAVR(serialPort)
 
     #serialPort = 'COM8'
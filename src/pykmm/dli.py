@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+#
+# PyKMM - KMM and keyloading for Python
+# GPLv2 Open Source. Use is subject to license terms.
+# DO NOT ALTER OR REMOVE COPYRIGHT NOTICES OR THIS FILE HEADER.
+#
+# @package PyKMM
+#
+###############################################################################
+#   Copyright (C) 2022 Natalie Moore <natalie@natnat.xyz>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+###############################################################################
+
+import asyncio
+import itertools
+import logging
+
+from pykmm.kmm.commands import parse_kmm
+
+# room for one UDP datagram without IP fragmentation on a 1500 byte MTU
+MAX_DATAGRAM = 1472
+
+class _DLIProtocol(asyncio.DatagramProtocol):
+    def __init__(self, owner):
+        self._owner = owner
+
+    def datagram_received(self, data, addr):
+        self._owner._onDatagram(data, addr)
+
+    def error_received(self, exc):
+        self._owner.errors += 1
+
+class DLITransport():
+    '''KMMs over UDP to any number of radios from one socket
+
+    Messages queued in the same event loop iteration for the same radio are coalesced into one datagram.
+    request() numbers each message per radio, retransmits it until a reply carrying the same message
+    number arrives and gives up with a TimeoutError after maxRetransmits. Anything that doesn't answer
+    an outstanding request lands in the incoming queue.
+    '''
+    def __init__(self, retransmitInterval=1.0, maxRetransmits=3, maxDatagram=MAX_DATAGRAM):
+        self.retransmitInterval = retransmitInterval
+        self.maxRetransmits = maxRetransmits
+        self.maxDatagram = maxDatagram
+        self.incoming = asyncio.Queue()
+
+        self.datagramsSent = 0
+        self.messagesSent = 0
+        self.retransmits = 0
+        self.errors = 0
+
+        self._loop = asyncio.get_running_loop()
+        self._transport = None
+        self._txQueue = {}
+        self._flushScheduled = False
+        self._messageNumbers = {}
+        self._outstanding = {}
+
+    @classmethod
+    async def open(cls, localAddr=("0.0.0.0", 0), **kwargs):
+        self = cls(**kwargs)
+        self._transport, protocol = await self._loop.create_datagram_endpoint(lambda: _DLIProtocol(self), local_addr=localAddr)
+        return self
+
+    @property
+    def localAddress(self):
+        return self._transport.get_extra_info("sockname")
+
+    def send(self, message, addr):
+        '''Queue a message for addr; it goes out with anything else queued for addr this loop iteration'''
+        self._queue(bytes(message.to_bytes()), addr)
+
+    def _queue(self, frame, addr):
+        self._txQueue.setdefault(addr, []).append(frame)
+        self.messagesSent += 1
+        if (not self._flushScheduled):
+            self._flushScheduled = True
+            self._loop.call_soon(self._flush)
+
+    def _flush(self):
+        self._flushScheduled = False
+        queued, self._txQueue = self._txQueue, {}
+        for addr, frames in queued.items():
+            datagram = bytearray()
+            for frame in frames:
+                if (datagram and len(datagram) + len(frame) > self.maxDatagram):
+                    self._sendDatagram(datagram, addr)
+                    datagram = bytearray()
+                datagram += frame
+            self._sendDatagram(datagram, addr)
+
+    def _sendDatagram(self, datagram, addr):
+        if (self._transport is None or self._transport.is_closing()):
+            return
+        self._transport.sendto(bytes(datagram), addr)
+        self.datagramsSent += 1
+
+    def nextMessageNumber(self, addr):
+        counter = self._messageNumbers.get(addr)
+        if (counter is None):
+            counter = self._messageNumbers[addr] = itertools.count()
+        return next(counter) & 0xFFFF
+
+    async def request(self, message, addr):
+        '''Send a message and wait for the reply that carries its message number'''
+        if (message.messageNumber is None):
+            message.messageNumber = self.nextMessageNumber(addr)
+        key = (addr, message.messageNumber)
+        if (key in self._outstanding):
+            raise ValueError("Message number {} to {} is already outstanding".format(message.messageNumber, addr))
+
+        frame = bytes(message.to_bytes())
+        reply = self._loop.create_future()
+        self._outstanding[key] = reply
+        try:
+            for attempt in range(0, self.maxRetransmits + 1):
+                if (attempt > 0):
+                    self.retransmits += 1
+                self._queue(frame, addr)
+                done, pending = await asyncio.wait((reply,), timeout=self.retransmitInterval)
+                if (done):
+                    return reply.result()
+            raise TimeoutError("No reply from {} to message number {}".format(addr, message.messageNumber))
+        finally:
+            del self._outstanding[key]
+
+    def _onDatagram(self, data, addr):
+        view = memoryview(data)
+        offset = 0
+        while offset < len(view):
+            try:
+                message, offset = parse_kmm(view, offset)
+            except Exception as e:
+                # anything on the wire can be malformed, so a bad datagram is only counted and dropped
+                self.errors += 1
+                logging.warning("Dropping undecodable datagram from {}: {}".format(addr, e))
+                return
+            reply = self._outstanding.get((addr, message.messageNumber))
+            if (reply is not None and not reply.done()):
+                reply.set_result(message)
+            else:
+                self.incoming.put_nowait((message, addr))
+
+    def counters(self):
+        return {
+            "datagramsSent": self.datagramsSent,
+            "messagesSent": self.messagesSent,
+            "retransmits": self.retransmits,
+            "errors": self.errors,
+            "outstanding": len(self._outstanding),
+        }
+
+    def close(self):
+        if (self._flushScheduled):
+            self._flush()
+        for reply in self._outstanding.values():
+            if (not reply.done()):
+                reply.cancel()
+        if (self._transport is not None):
+            self._transport.close()
+            self._transport = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
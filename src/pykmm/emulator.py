@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+#
+# PyKMM - KMM and keyloading for Python
+# GPLv2 Open Source. Use is subject to license terms.
+# DO NOT ALTER OR REMOVE COPYRIGHT NOTICES OR THIS FILE HEADER.
+#
+# @package PyKMM
+#
+###############################################################################
+#   Copyright (C) 2022 Natalie Moore <natalie@natnat.xyz>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+###############################################################################
+
+import os
+import random
+import select
+import threading
+import time
+import tty
+
+from pykmm.deviceprotocol import OPKFD, KFDAVR
+from pykmm.framing import encode_frame
+
+class KFDEmulator():
+    '''Software keyloader speaking the OPKFD adapter protocol on one end of a pty
+
+    Point KFDAVR (or KFDTool, via deviceClass) at emulator.port and it behaves like the real adapter:
+    info reads, key slot reads and writes, zeroize, self test and TWI byte sends. Each reply is held back
+    by latency seconds plus up to +/- jitter, each reply byte is corrupted with probability byteErrorRate
+    and whole replies are dropped with probability dropRate. POSIX only, since it needs a pty.
+    '''
+    def __init__(self, deviceClass=KFDAVR, latency=0.0, jitter=0.0, byteErrorRate=0.0, dropRate=0.0, seed=None):
+        self.frameFormat = deviceClass.FRAME_FORMAT
+        self.maxSlots = getattr(deviceClass, "MAX_INSTALLED_KEYS", 15)
+        self.latency = latency
+        self.jitter = jitter
+        self.byteErrorRate = byteErrorRate
+        self.dropRate = dropRate
+        self._random = random.Random(seed)
+
+        self.adapterVersion = (2, 0, 0)
+        self.firmwareVersion = (1, 4, 0)
+        self.uid = bytes([0x10, 0x20, 0x30, 0x40])
+        self.model = 0x01
+        self.hardwareRevision = (1, 0)
+        self.serialNumber = b"\x01\x02\x03"
+        self.selfTestResult = 0x00
+
+        # slot -> (sln, kid, key bytes)
+        self.slots = {}
+        self.twiBytes = bytearray()
+
+        self.framesReceived = 0
+        self.repliesSent = 0
+        self.repliesDropped = 0
+        self.bytesCorrupted = 0
+
+        self._rxBuffer = bytearray()
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._running = False
+
+    @property
+    def port(self):
+        '''Device path to open with serial / KFDAVR'''
+        return os.ttyname(self._slave)
+
+    def start(self):
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._master)
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, name="KFDEmulator", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if (self._thread is not None):
+            self._thread.join()
+            self._thread = None
+        for fd in (self._master, self._slave):
+            if (fd is not None):
+                os.close(fd)
+        self._master = self._slave = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _serve(self):
+        while self._running:
+            ready, _, _ = select.select([self._master], [], [], 0.05)
+            if (not ready):
+                continue
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                # the other end hung up
+                continue
+            for reply in self.feed(data):
+                self._send(reply)
+
+    def _send(self, reply):
+        if (self.dropRate and self._random.random() < self.dropRate):
+            self.repliesDropped += 1
+            return
+        delay = self.latency + (self._random.uniform(-self.jitter, self.jitter) if self.jitter else 0)
+        if (delay > 0):
+            time.sleep(delay)
+        os.write(self._master, self.corrupt(encode_frame(reply, self.frameFormat)))
+        self.repliesSent += 1
+
+    def corrupt(self, frame):
+        '''Flip one random bit in each byte of frame chosen with probability byteErrorRate'''
+        if (not self.byteErrorRate):
+            return frame
+        frame = bytearray(frame)
+        for i in range(0, len(frame)):
+            if (self._random.random() < self.byteErrorRate):
+                frame[i] ^= 1 << self._random.randrange(8)
+                self.bytesCorrupted += 1
+        return bytes(frame)
+
+    def feed(self, data):
+        '''Deframe incoming bytes and return the replies to every complete command'''
+        fmt = self.frameFormat
+        buf = self._rxBuffer
+        buf += data
+        replies = []
+        while True:
+            header = buf.find(fmt.header)
+            if (header < 0):
+                buf.clear()
+                break
+            footer = buf.find(fmt.footer, header + 1)
+            if (footer < 0):
+                del buf[:header]
+                break
+            # a later header restarts the frame
+            start = buf.rfind(fmt.header, header, footer) if fmt.header != fmt.footer else header
+            frame = buf[start + 1:footer]
+            del buf[:footer + 1]
+            if (not frame):
+                continue
+            self.framesReceived += 1
+            try:
+                command = fmt.unescapeBytes(frame)
+            except ValueError:
+                replies.append([OPKFD.REPLY_ERROR, OPKFD.ERROR_OTHER])
+                continue
+            reply = self.handle(command)
+            if (reply is not None):
+                replies.append(reply)
+        return replies
+
+    def handle(self, command):
+        '''Reply (as a list of bytes, unframed) to one unframed command'''
+        opcode = command[0]
+        if (opcode == OPKFD.CMD_READ_REQ):
+            return self._handleRead(command)
+        elif (opcode == OPKFD.CMD_WRITE_REQ):
+            return self._handleWrite(command)
+        elif (opcode == OPKFD.CMD_SELF_TEST):
+            return [OPKFD.REPLY_SELF_TEST, self.selfTestResult]
+        elif (opcode == OPKFD.CMD_SEND_BYTE):
+            # opcode, reserved, byte
+            self.twiBytes.extend(command[2:])
+            return [OPKFD.REPLY_SEND_BYTE]
+        elif (opcode == OPKFD.CMD_RESET):
+            self.slots.clear()
+            return [OPKFD.REPLY_RESET]
+        return [OPKFD.REPLY_ERROR, OPKFD.ERROR_INVALID_CMD_OPCODE]
+
+    def _handleRead(self, command):
+        if (len(command) < 2):
+            return [OPKFD.REPLY_ERROR, OPKFD.ERROR_INVALID_CMD_LENGTH]
+        subop = command[1]
+        if (subop == OPKFD.READ_ADAPTER_VER):
+            return [OPKFD.REPLY_READ, subop, *self.adapterVersion]
+        elif (subop == OPKFD.READ_FW_VER):
+            return [OPKFD.REPLY_READ, subop, *self.firmwareVersion]
+        elif (subop == OPKFD.READ_UID):
+            return [OPKFD.REPLY_READ, subop, *self.uid]
+        elif (subop == OPKFD.READ_MODEL):
+            return [OPKFD.REPLY_READ, subop, self.model]
+        elif (subop == OPKFD.READ_HW_REV):
+            return [OPKFD.REPLY_READ, subop, *self.hardwareRevision]
+        elif (subop == OPKFD.READ_SN):
+            return [OPKFD.REPLY_READ, subop, len(self.serialNumber), *self.serialNumber]
+        elif (subop == KFDAVR.READ_KEY_INFO):
+            if (len(command) < 3):
+                return [OPKFD.REPLY_ERROR, OPKFD.ERROR_INVALID_CMD_LENGTH]
+            slot = command[2]
+            if (slot not in self.slots):
+                return [OPKFD.REPLY_ERROR, OPKFD.ERROR_READ_FAILED]
+            sln, kid, key = self.slots[slot]
+            return [OPKFD.REPLY_READ, subop, slot, 0, sln >> 8, sln & 0xFF, kid >> 8, kid & 0xFF]
+        return [OPKFD.REPLY_ERROR, OPKFD.ERROR_INVALID_READ_OPCODE]
+
+    def _handleWrite(self, command):
+        if (len(command) < 2):
+            return [OPKFD.REPLY_ERROR, OPKFD.ERROR_INVALID_CMD_LENGTH]
+        subop = command[1]
+        if (subop == KFDAVR.WRITE_KEY):
+            if (len(command) < 3):
+                return [OPKFD.REPLY_ERROR, OPKFD.ERROR_INVALID_CMD_LENGTH]
+            slot = command[2]
+            if (slot == KFDAVR.ZEROIZE_SLOT):
+                self.slots.clear()
+                return [OPKFD.REPLY_WRITE, subop]
+            if (len(command) < 8):
+                return [OPKFD.REPLY_ERROR, OPKFD.ERROR_INVALID_CMD_LENGTH]
+            if (slot >= self.maxSlots):
+                return [OPKFD.REPLY_ERROR, OPKFD.ERROR_WRITE_FAILED]
+            sln = (command[4] << 8) | command[5]
+            kid = (command[6] << 8) | command[7]
+            self.slots[slot] = (sln, kid, bytes(command[8:]))
+            return [OPKFD.REPLY_WRITE, subop]
+        elif (subop == OPKFD.WRITE_MODEL):
+            if (len(command) < 5):
+                return [OPKFD.REPLY_ERROR, OPKFD.ERROR_INVALID_CMD_LENGTH]
+            self.model = command[2]
+            self.hardwareRevision = (command[3], command[4])
+            return [OPKFD.REPLY_WRITE, subop]
+        elif (subop == OPKFD.WRITE_SN):
+            self.serialNumber = bytes(command[2:])
+            return [OPKFD.REPLY_WRITE, subop]
+        return [OPKFD.REPLY_ERROR, OPKFD.ERROR_INVALID_WRITE_OPCODE]
+
+def main():
+    '''Run an emulated KFD-AVR until interrupted'''
+    with KFDEmulator() as emulator:
+        print("Emulated KFD-AVR on {}".format(emulator.port))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == "__main__":
+    main()
@@ -24,6 +24,476 @@
 #   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 ###############################################################################
 
+import base64
+import binascii
+import collections
+import gzip
+import hashlib
+import hmac
+import mmap
+import os
+import threading
+import time
+import xml.parsers.expat
+from xml.etree.ElementTree import XMLPullParser, ParseError
+from xml.sax.saxutils import escape
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+from pykmm.kmm.items import KeyItem
+from pykmm.kmm.keyset import KeyIndex
+
+XMLENC_NS = "http://www.w3.org/2001/04/xmlenc#"
+AES256_CBC = XMLENC_NS + "aes256-cbc"
+
+# bytes of the container read or produced per step
+CHUNK_SIZE = 65536
+AES_BLOCK = 16
+
+def _requireCrypto():
+    if (Cipher is None):
+        raise ImportError("EKC support needs the cryptography package (pip install pykmm[ekc])")
+
+def deriveKey(password, salt, iterations, keyLength=32, hashName="sha512"):
+    '''PBKDF2 key derivation used to protect the container'''
+    return hashlib.pbkdf2_hmac(hashName, password.encode("utf-8"), salt, iterations, keyLength)
+
+class DerivedKeyCache():
+    '''Bounded, time-limited in-memory cache of container keys derived from passwords
+
+    Entries are keyed by the container salt and derivation parameters plus an HMAC fingerprint of the
+    password, so a different password never gets a cached key. Key material is held in bytearrays
+    that are overwritten with zeros when an entry expires, is evicted or the cache is cleared.
+    '''
+    def __init__(self, maxEntries=16, ttl=300):
+        self.maxEntries = maxEntries
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _zeroise(key):
+        key[:] = bytes(len(key))
+
+    def _expire(self, now):
+        while self._entries:
+            cacheKey, (key, expires) = next(iter(self._entries.items()))
+            if (expires > now and len(self._entries) <= self.maxEntries):
+                break
+            del self._entries[cacheKey]
+            self._zeroise(key)
+
+    def derive(self, password, salt, iterations, keyLength=32, hashName="sha512"):
+        '''Return the derived key, running PBKDF2 only if it is not cached'''
+        fingerprint = hmac.new(salt, password.encode("utf-8"), hashlib.sha256).digest()
+        cacheKey = (bytes(salt), iterations, keyLength, hashName, fingerprint)
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            entry = self._entries.get(cacheKey)
+            if (entry is not None):
+                self.hits += 1
+                # refresh the expiry and move to the back of the eviction order
+                self._entries[cacheKey] = (entry[0], now + self.ttl)
+                self._entries.move_to_end(cacheKey)
+                return bytes(entry[0])
+            self.misses += 1
+
+        key = bytearray(deriveKey(password, salt, iterations, keyLength, hashName))
+        with self._lock:
+            old = self._entries.pop(cacheKey, None)
+            if (old is not None):
+                self._zeroise(old[0])
+            self._entries[cacheKey] = (key, time.monotonic() + self.ttl)
+            self._expire(time.monotonic())
+            return bytes(key)
+
+    def clear(self):
+        '''Zeroise and drop every cached key'''
+        with self._lock:
+            for key, expires in self._entries.values():
+                self._zeroise(key)
+            self._entries.clear()
+
+# shared by EKC.unlock so a service reopening the same containers derives each key once
+defaultKeyCache = DerivedKeyCache()
+
+class ContainerKey():
+    '''A key entry from a KFDTool key container'''
+    __slots__ = ("id", "name", "activeKeyset", "keysetId", "sln", "keyTypeAuto", "keyTypeTek", "keyTypeKek", "kid", "algId", "key")
+
+    def __init__(self):
+        self.id = 0
+        self.name = ""
+        self.activeKeyset = True
+        self.keysetId = 1
+        self.sln = 0
+        self.keyTypeAuto = True
+        self.keyTypeTek = False
+        self.keyTypeKek = False
+        self.kid = 0
+        self.algId = 0
+        self.key = b""
+
+    def toKeyItem(self):
+        '''KeyItem ready for a Modify Key command'''
+        keyItem = KeyItem()
+        keyItem.sln = self.sln
+        keyItem.kid = self.kid
+        keyItem.key = self.key
+        keyItem.kek = self.keyTypeKek
+        return keyItem
+
+    def __str__(self):
+        return f"<ContainerKey {self.name} SLN 0x{self.sln:X} KID 0x{self.kid:X}>"
+
+class ContainerGroup():
+    '''A named group of key ids from a KFDTool key container'''
+    __slots__ = ("id", "name", "keys")
+
+    def __init__(self):
+        self.id = 0
+        self.name = ""
+        self.keys = []
+
+    def __str__(self):
+        return f"<ContainerGroup {self.name}>"
+
+def _parseBool(text):
+    return (text or "").strip().lower() == "true"
+
+def _keyFromElement(elem):
+    key = ContainerKey()
+    key.id = int(elem.findtext("Id", "0"))
+    key.name = elem.findtext("Name", "")
+    key.activeKeyset = _parseBool(elem.findtext("ActiveKeyset"))
+    key.keysetId = int(elem.findtext("KeysetId", "0"))
+    key.sln = int(elem.findtext("Sln", "0"))
+    key.keyTypeAuto = _parseBool(elem.findtext("KeyTypeAuto"))
+    key.keyTypeTek = _parseBool(elem.findtext("KeyTypeTek"))
+    key.keyTypeKek = _parseBool(elem.findtext("KeyTypeKek"))
+    key.kid = int(elem.findtext("KeyId", "0"))
+    key.algId = int(elem.findtext("AlgorithmId", "0"))
+    key.key = bytes.fromhex(elem.findtext("Key", ""))
+    return key
+
+def _groupFromElement(elem):
+    group = ContainerGroup()
+    group.id = int(elem.findtext("Id", "0"))
+    group.name = elem.findtext("Name", "")
+    group.keys = [int(e.text) for e in elem.iterfind("Keys/int")]
+    return group
+
+def _keyToXml(key):
+    return ("<KeyItem><Id>{}</Id><Name>{}</Name><ActiveKeyset>{}</ActiveKeyset><KeysetId>{}</KeysetId><Sln>{}</Sln>"
+            "<KeyTypeAuto>{}</KeyTypeAuto><KeyTypeTek>{}</KeyTypeTek><KeyTypeKek>{}</KeyTypeKek><KeyId>{}</KeyId>"
+            "<AlgorithmId>{}</AlgorithmId><Key>{}</Key></KeyItem>").format(
+                key.id, escape(key.name), str(key.activeKeyset).lower(), key.keysetId, key.sln,
+                str(key.keyTypeAuto).lower(), str(key.keyTypeTek).lower(), str(key.keyTypeKek).lower(),
+                key.kid, key.algId, bytes(key.key).hex().upper())
+
+def _groupToXml(group):
+    return "<GroupItem><Id>{}</Id><Name>{}</Name><Keys>{}</Keys></GroupItem>".format(
+        group.id, escape(group.name), "".join("<int>{}</int>".format(k) for k in group.keys))
+
+class _InnerReader():
+    '''Decrypts base64 cipher text pushed to it and parses the inner container as it goes'''
+    def __init__(self, aesKey):
+        self._aesKey = aesKey
+        self._b64 = bytearray()
+        self._iv = bytearray()
+        self._decryptor = None
+        # the last block is held back until the end so its padding can be removed
+        self._tail = b""
+        self._parser = XMLPullParser(events=("start", "end"))
+        self._parents = []
+        self.entries = []
+
+    def feedBase64(self, text):
+        self._b64 += text.encode("ascii").translate(None, b" \t\r\n")
+        usable = len(self._b64) - (len(self._b64) % 4)
+        if (usable):
+            self._feedCipher(binascii.a2b_base64(self._b64[:usable]))
+            del self._b64[:usable]
+
+    def _feedCipher(self, data):
+        if (self._decryptor is None):
+            need = AES_BLOCK - len(self._iv)
+            self._iv += data[:need]
+            data = data[need:]
+            if (len(self._iv) < AES_BLOCK):
+                return
+            self._decryptor = Cipher(algorithms.AES(self._aesKey), modes.CBC(bytes(self._iv))).decryptor()
+        plain = self._tail + self._decryptor.update(data)
+        split = len(plain) - AES_BLOCK if len(plain) >= AES_BLOCK else 0
+        self._feedXml(plain[:split])
+        self._tail = plain[split:]
+
+    def finish(self):
+        if (self._b64.strip(b"=")):
+            raise ValueError("Truncated cipher text in key container")
+        if (self._decryptor is None):
+            raise ValueError("Key container holds no encrypted data")
+        plain = self._tail + self._decryptor.finalize()
+        if (len(plain) != AES_BLOCK or not 1 <= plain[-1] <= AES_BLOCK):
+            raise ValueError("Could not decrypt key container (wrong password?)")
+        # ISO 10126 / PKCS#7 padding: the last byte says how many to drop
+        self._feedXml(plain[:-plain[-1]])
+        try:
+            self._parser.close()
+            self._drain()
+        except ParseError:
+            raise ValueError("Key container inner XML is incomplete")
+
+    def _feedXml(self, data):
+        if (data):
+            try:
+                self._parser.feed(data)
+                self._drain()
+            except ParseError:
+                raise ValueError("Could not decrypt key container (wrong password?)")
+
+    def _drain(self):
+        for event, elem in self._parser.read_events():
+            if (event == "start"):
+                self._parents.append(elem)
+                continue
+            self._parents.pop()
+            if (elem.tag == "KeyItem"):
+                self.entries.append(_keyFromElement(elem))
+            elif (elem.tag == "GroupItem"):
+                self.entries.append(_groupFromElement(elem))
+            else:
+                continue
+            # drop finished entries so memory stays flat however large the container is
+            if (self._parents):
+                self._parents[-1].remove(elem)
+
 class EKC():
-    def __init__():
-        raise NotImplementedError
\ No newline at end of file
+    '''Reader for KFDTool encrypted key container (.ekc) files
+
+    The file is memory mapped and parsed as a stream: cipher text is base64-decoded, decrypted and the
+    inner XML parsed a chunk at a time, so keys() and groups() yield entries without ever holding the
+    whole container (or every key object) in memory. Each iteration re-reads the file.
+
+        with EKC("agency.ekc", password) as ekc:
+            for key in ekc.keys():
+                ...
+    '''
+    def __init__(self, path, password, keyCache=None):
+        _requireCrypto()
+        self._keyCache = keyCache
+        self._file = open(path, "rb")
+        if (os.fstat(self._file.fileno()).st_size == 0):
+            self._file.close()
+            raise ValueError("Key container {} is empty".format(path))
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._password = password
+        self.salt = None
+        self.iterations = None
+        self.keyLength = None
+        self.hashName = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+    def _stream(self):
+        '''File-like view of the (decompressed) outer container'''
+        self._mmap.seek(0)
+        if (self._mmap[:2] == b"\x1f\x8b"):
+            return gzip.GzipFile(fileobj=self._mmap, mode="rb")
+        return self._mmap
+
+    @classmethod
+    def unlock(cls, path, password, keyCache=None):
+        '''Open a container, reusing a cached derived key for its salt if there is one (defaultKeyCache unless given)'''
+        return cls(path, password, keyCache if keyCache is not None else defaultKeyCache)
+
+    def _deriveKey(self):
+        if (self._keyCache is not None):
+            return self._keyCache.derive(self._password, self.salt, self.iterations, self.keyLength, self.hashName)
+        return deriveKey(self._password, self.salt, self.iterations, self.keyLength, self.hashName)
+
+    def entries(self):
+        '''Yield every ContainerKey and ContainerGroup in file order'''
+        state = {"path": [], "text": "", "inner": None, "method": None}
+        fields = {}
+        outer = xml.parsers.expat.ParserCreate(namespace_separator=" ")
+
+        def start(name, attrs):
+            tag = name.split(" ")[-1]
+            state["path"].append(tag)
+            state["text"] = ""
+            if (tag == "EncryptionMethod"):
+                state["method"] = attrs.get("Algorithm")
+            elif (tag == "CipherValue"):
+                if (state["method"] not in (None, AES256_CBC)):
+                    raise ValueError("Unsupported container encryption {}".format(state["method"]))
+                self._applyDerivation(fields)
+                state["inner"] = _InnerReader(self._deriveKey())
+
+        def end(name):
+            tag = state["path"].pop()
+            if (tag == "CipherValue"):
+                state["inner"].finish()
+            elif ("KeyDerivation" in state["path"]):
+                fields[tag] = state["text"].strip()
+
+        def chars(text):
+            if (state["path"] and state["path"][-1] == "CipherValue"):
+                state["inner"].feedBase64(text)
+            else:
+                state["text"] += text
+
+        outer.StartElementHandler = start
+        outer.EndElementHandler = end
+        outer.CharacterDataHandler = chars
+
+        stream = self._stream()
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            outer.Parse(chunk, not chunk)
+            if (state["inner"] is not None):
+                yield from state["inner"].entries
+                state["inner"].entries.clear()
+            if (not chunk):
+                break
+        if (state["inner"] is None):
+            raise ValueError("Key container holds no encrypted data")
+
+    def keys(self):
+        '''Yield the ContainerKey entries'''
+        for entry in self.entries():
+            if (isinstance(entry, ContainerKey)):
+                yield entry
+
+    def groups(self):
+        '''Yield the ContainerGroup entries'''
+        for entry in self.entries():
+            if (isinstance(entry, ContainerGroup)):
+                yield entry
+
+    def index(self):
+        '''KeyIndex over the container's keys, for diffing against another container or a radio inventory'''
+        return KeyIndex.fromContainerKeys(self.keys())
+
+    def _applyDerivation(self, fields):
+        if (fields.get("DerivationAlgorithm", "PBKDF2") != "PBKDF2"):
+            raise ValueError("Unsupported key derivation {}".format(fields.get("DerivationAlgorithm")))
+        if ("Salt" not in fields or "IterationCount" not in fields):
+            raise ValueError("Key container is missing its key derivation parameters")
+        self.hashName = fields.get("HashAlgorithm", "SHA512").lower()
+        self.salt = base64.b64decode(fields["Salt"])
+        self.iterations = int(fields["IterationCount"])
+        self.keyLength = int(fields.get("KeyLength", "32"))
+
+class EKCWriter():
+    '''Incremental writer for KFDTool encrypted key container (.ekc) files
+
+    Keys and groups are encrypted and written as they are added, so a container of any size can be
+    produced without building it in memory. All keys must be written before the first group.
+    '''
+    def __init__(self, path, password, iterations=100000, salt=None, compress=True):
+        _requireCrypto()
+        self.salt = salt if salt is not None else os.urandom(32)
+        self.iterations = iterations
+        self._raw = open(path, "wb")
+        self._out = gzip.GzipFile(fileobj=self._raw, mode="wb") if compress else self._raw
+        self._section = None
+        self._nextKey = 1
+        self._nextGroup = 1
+        self._b64 = b""
+        self._plainLength = 0
+
+        iv = os.urandom(AES_BLOCK)
+        aesKey = deriveKey(password, self.salt, iterations)
+        self._encryptor = Cipher(algorithms.AES(aesKey), modes.CBC(iv)).encryptor()
+
+        self._out.write(('<?xml version="1.0" encoding="utf-8"?>'
+                         '<OuterContainer version="1.0"><KeyDerivation>'
+                         '<DerivationAlgorithm>PBKDF2</DerivationAlgorithm><HashAlgorithm>SHA512</HashAlgorithm>'
+                         '<Salt>{}</Salt><IterationCount>{}</IterationCount><KeyLength>32</KeyLength>'
+                         '</KeyDerivation>'
+                         '<EncryptedData Type="{}Element" xmlns="{}"><EncryptionMethod Algorithm="{}" />'
+                         '<CipherData><CipherValue>').format(
+                             base64.b64encode(self.salt).decode("ascii"), iterations, XMLENC_NS, XMLENC_NS, AES256_CBC
+                         ).encode("utf-8"))
+        self._writeBase64(iv)
+        self._writeInner('<?xml version="1.0" encoding="utf-8"?><InnerContainer version="1.0">')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if (excType is None):
+            self.close()
+        else:
+            self._out.close()
+            self._raw.close()
+
+    def _writeBase64(self, data):
+        data = self._b64 + data
+        usable = len(data) - (len(data) % 3)
+        self._out.write(base64.b64encode(data[:usable]))
+        self._b64 = data[usable:]
+
+    def _writeInner(self, text):
+        data = text.encode("utf-8")
+        self._plainLength += len(data)
+        self._writeBase64(self._encryptor.update(data))
+
+    def _enter(self, section):
+        if (self._section == section):
+            return
+        if (self._section == "Groups" and section == "Keys"):
+            raise ValueError("Keys must be written before groups")
+        if (self._section is not None):
+            self._writeInner("</{}>".format(self._section))
+        self._writeInner("<{}>".format(section))
+        self._section = section
+
+    def writeKey(self, key):
+        '''Append a ContainerKey; a zero id is replaced with the next free one'''
+        self._enter("Keys")
+        if (not key.id):
+            key.id = self._nextKey
+        self._nextKey = max(self._nextKey, key.id + 1)
+        self._writeInner(_keyToXml(key))
+
+    def writeGroup(self, group):
+        '''Append a ContainerGroup; a zero id is replaced with the next free one'''
+        self._enter("Groups")
+        if (not group.id):
+            group.id = self._nextGroup
+        self._nextGroup = max(self._nextGroup, group.id + 1)
+        self._writeInner(_groupToXml(group))
+
+    def close(self):
+        if (self._section is None):
+            self._enter("Keys")
+        self._enter("Groups")
+        self._writeInner("</Groups><NextKeyNumber>{}</NextKeyNumber><NextGroupNumber>{}</NextGroupNumber></InnerContainer>".format(
+            self._nextKey, self._nextGroup))
+
+        # PKCS#7 padding, which is also valid ISO 10126 padding
+        padLength = AES_BLOCK - (self._plainLength % AES_BLOCK)
+        self._writeBase64(self._encryptor.update(bytes([padLength]) * padLength) + self._encryptor.finalize())
+        self._out.write(base64.b64encode(self._b64))
+        self._out.write(b"</CipherValue></CipherData></EncryptedData></OuterContainer>")
+        self._out.close()
+        self._raw.close()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+#
+# PyKMM - KMM and keyloading for Python
+# GPLv2 Open Source. Use is subject to license terms.
+# DO NOT ALTER OR REMOVE COPYRIGHT NOTICES OR THIS FILE HEADER.
+#
+# @package PyKMM
+#
+###############################################################################
+#   Copyright (C) 2022 Natalie Moore <natalie@natnat.xyz>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+###############################################################################
+
+import collections
+import logging
+import threading
+import time
+
+from serial.tools import list_ports
+
+from pykmm.deviceprotocol import KFDAVR
+
+# USB VID/PID pairs of known keyloaders; extend or replace through Fleet(adapterTable=...)
+ADAPTER_TABLE = {
+    (0x2341, 0x0043): KFDAVR,   # KFD-AVR on an Arduino Uno
+    (0x2341, 0x0042): KFDAVR,   # KFD-AVR on an Arduino Mega
+}
+
+# USB serial bridge chips that also turn up in plenty of things that aren't keyloaders, so ports
+# behind them are only used when asked for with includeGeneric
+GENERIC_ADAPTER_TABLE = {
+    (0x1A86, 0x7523): KFDAVR,   # KFD-AVR on a CH340 clone
+}
+
+def discoverPorts(adapterTable=None, includeGeneric=False):
+    '''Return a dict of serial port to keyloader class for every attached adapter found in adapterTable'''
+    if (adapterTable is None):
+        adapterTable = ADAPTER_TABLE
+    if (includeGeneric):
+        adapterTable = {**GENERIC_ADAPTER_TABLE, **adapterTable}
+    found = {}
+    for portInfo in list_ports.comports():
+        deviceClass = adapterTable.get((portInfo.vid, portInfo.pid))
+        if (deviceClass is not None):
+            found[portInfo.device] = deviceClass
+    return found
+
+class KeyloadJob():
+    '''One unit of fleet work: action(kfd) run against whichever keyloader picks it up'''
+    def __init__(self, name, action, maxAttempts=3):
+        self.name = name
+        self.action = action
+        self.maxAttempts = maxAttempts
+        self.attempts = 0
+        self.triedPorts = set()
+        self.port = None
+        self.result = None
+        self.error = None
+        self.done = False
+
+    @classmethod
+    def installKeys(cls, name, slotsAndItems, maxAttempts=3):
+        '''Job that writes each (slot, KeyItem) pair to the keyloader'''
+        def action(kfd):
+            kfd.writeInstalledKeys(slotsAndItems)
+        return cls(name, action, maxAttempts)
+
+    def __str__(self):
+        return f"<KeyloadJob {self.name}>"
+
+class DeviceStats():
+    '''Per-keyloader counters kept by the fleet'''
+    def __init__(self, port):
+        self.port = port
+        self.jobs = 0
+        self.failures = 0
+        self.busySeconds = 0.0
+        self.bytesMoved = 0
+        self.online = False
+
+    def to_dict(self):
+        return {
+            "port": self.port,
+            "online": self.online,
+            "jobs": self.jobs,
+            "failures": self.failures,
+            "busySeconds": self.busySeconds,
+            "jobsPerMinute": (self.jobs * 60 / self.busySeconds) if self.busySeconds else 0.0,
+            "bytesPerSecond": (self.bytesMoved / self.busySeconds) if self.busySeconds else 0.0,
+        }
+
+class Fleet():
+    '''Spread a queue of keyload jobs across many attached keyloaders
+
+    maxWorkers threads (by default one per keyloader) share every keyloader: a worker takes the next
+    job together with an idle keyloader, connecting to it the first time it is used, so fewer workers
+    than keyloaders still rotate through all of them. A job that fails is handed to a keyloader it has
+    not tried yet, up to its maxAttempts; a keyloader that can't be connected to is dropped.
+    '''
+    def __init__(self, ports=None, maxWorkers=None, adapterTable=None, connect=None, includeGeneric=False):
+        if (ports is None):
+            ports = discoverPorts(adapterTable, includeGeneric)
+        self.ports = dict(ports)
+        self.maxWorkers = maxWorkers if maxWorkers is not None else len(self.ports)
+        self._connect = connect if connect is not None else (lambda port, deviceClass: deviceClass(port))
+        self.stats = {port: DeviceStats(port) for port in self.ports}
+
+        self._cond = threading.Condition()
+        self._pending = collections.deque()
+        self._inFlight = 0
+        # keyloaders not yet known to be unreachable, those of them not in use, and open connections
+        self._live = set()
+        self._idle = set()
+        self._devices = {}
+
+    def run(self, jobs):
+        '''Run every job to completion or final failure and return them'''
+        jobs = list(jobs)
+        self._pending.extend(jobs)
+        self._inFlight = 0
+        self._live = set(self.ports)
+        self._idle = set(self.ports)
+        workers = []
+        for i in range(0, min(self.maxWorkers, len(self.ports))):
+            t = threading.Thread(target=self._worker, name="fleet-{}".format(i), daemon=True)
+            workers.append(t)
+            t.start()
+        for t in workers:
+            t.join()
+
+        for port, kfd in self._devices.items():
+            self.stats[port].online = False
+            kfd.close()
+        self._devices = {}
+
+        # anything left over had no keyloader able to take it
+        while self._pending:
+            job = self._pending.popleft()
+            job.error = job.error or Exception("No keyloader available")
+        return jobs
+
+    def _nextJob(self):
+        '''Block until there is a job and an idle keyloader for it; returns None when the queue is finished'''
+        with self._cond:
+            while True:
+                if (not self._live or (not self._pending and self._inFlight == 0)):
+                    return None
+                for job in self._pending:
+                    # prefer keyloaders this job has not failed on, unless every live one has been tried
+                    ports = self._idle - job.triedPorts if not self._live <= job.triedPorts else self._idle
+                    if (ports):
+                        port = ports.pop()
+                        self._pending.remove(job)
+                        self._idle.discard(port)
+                        self._inFlight += 1
+                        return job, port
+                self._cond.wait(0.5)
+
+    def _finishJob(self, job, port, failed):
+        with self._cond:
+            self._inFlight -= 1
+            self._idle.add(port)
+            if (failed and job.attempts < job.maxAttempts):
+                self._pending.append(job)
+            self._cond.notify_all()
+
+    def _dropPort(self, job, port):
+        '''Give up on a keyloader that can't be connected to and put its job back at the front'''
+        with self._cond:
+            self._inFlight -= 1
+            self._live.discard(port)
+            self._pending.appendleft(job)
+            self._cond.notify_all()
+
+    def _worker(self):
+        while True:
+            assignment = self._nextJob()
+            if (assignment is None):
+                break
+            job, port = assignment
+            kfd = self._devices.get(port)
+            if (kfd is None):
+                try:
+                    kfd = self._connect(port, self.ports[port])
+                except Exception as e:
+                    logging.error("Could not connect to keyloader on {}: {}".format(port, e))
+                    self._dropPort(job, port)
+                    continue
+                self._devices[port] = kfd
+                self.stats[port].online = True
+            self._runJob(kfd, port, job, self.stats[port])
+
+    def _runJob(self, kfd, port, job, stats):
+        session = getattr(kfd, "session", None)
+        before = self._bytesMoved(session)
+        start = time.monotonic()
+        job.attempts += 1
+        job.triedPorts.add(port)
+        failed = False
+        try:
+            job.result = job.action(kfd)
+            job.error = None
+            job.done = True
+            job.port = port
+            stats.jobs += 1
+        except Exception as e:
+            logging.warning("Job {} failed on {} (attempt {}): {}".format(job.name, port, job.attempts, e))
+            job.error = e
+            stats.failures += 1
+            failed = True
+        stats.busySeconds += time.monotonic() - start
+        stats.bytesMoved += self._bytesMoved(session) - before
+        self._finishJob(job, port, failed)
+
+    @staticmethod
+    def _bytesMoved(session):
+        if (session is None):
+            return 0
+        return session.bytesWritten + session.bytesRead
+
+    def report(self):
+        '''Per-keyloader throughput as a list of dicts'''
+        return [s.to_dict() for s in self.stats.values()]
+
+def main():
+    '''List the keyloaders the fleet would use'''
+    ports = discoverPorts()
+    if (not ports):
+        print("No keyloaders found")
+    for port, deviceClass in ports.items():
+        print("{}\t: {}".format(port, deviceClass.__name__))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+#
+# PyKMM - KMM and keyloading for Python
+# GPLv2 Open Source. Use is subject to license terms.
+# DO NOT ALTER OR REMOVE COPYRIGHT NOTICES OR THIS FILE HEADER.
+#
+# @package PyKMM
+#
+###############################################################################
+#   Copyright (C) 2022 Natalie Moore <natalie@natnat.xyz>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+###############################################################################
+
+class FrameFormat():
+    '''Header, footer and escape constants of a keyloader serial framing scheme
+
+    Any header, footer or escape byte inside a payload is sent as the escape byte followed by its placeholder.
+    The header and footer may be the same byte (as on the KFDTool).
+    '''
+    def __init__(self, header, footer, escape, headerPlaceholder, footerPlaceholder, escapePlaceholder):
+        specials = {header, footer, escape}
+        placeholders = {headerPlaceholder, footerPlaceholder, escapePlaceholder}
+        if (specials & placeholders):
+            raise ValueError("Escape placeholders must not be header, footer or escape bytes")
+
+        self.header = header
+        self.footer = footer
+        self.escape = escape
+        self.headerPlaceholder = headerPlaceholder
+        self.footerPlaceholder = footerPlaceholder
+        self.escapePlaceholder = escapePlaceholder
+
+        self._headerByte = bytes([header])
+        self._footerByte = bytes([footer])
+        self._escapeByte = bytes([escape])
+        self._headerPair = bytes([escape, headerPlaceholder])
+        self._footerPair = bytes([escape, footerPlaceholder])
+        self._escapePair = bytes([escape, escapePlaceholder])
+        self._sameHeaderFooter = (header == footer)
+        # wire form of every byte value, for patching single bytes into prebuilt frames
+        self.escapeTable = tuple(self.escapeBytes(bytes([b])) for b in range(0, 256))
+
+    def escapeBytes(self, payload):
+        '''Return payload with every header, footer and escape byte replaced by its escape pair'''
+        if (not isinstance(payload, bytes)):
+            payload = bytes(payload)
+
+        # the escape byte has to be replaced first so the pairs added below are not escaped again
+        if (self._escapeByte in payload):
+            payload = payload.replace(self._escapeByte, self._escapePair)
+        if (self._headerByte in payload):
+            payload = payload.replace(self._headerByte, self._headerPair)
+        if (not self._sameHeaderFooter and self._footerByte in payload):
+            payload = payload.replace(self._footerByte, self._footerPair)
+        return payload
+
+    def unescapeBytes(self, data):
+        '''Return data with every escape pair turned back into the byte it stands for'''
+        if (not isinstance(data, bytes)):
+            data = bytes(data)
+
+        escapes = data.count(self._escapeByte)
+        if (escapes == 0):
+            return data
+
+        # the escape pair has to be restored last so it can't combine with a following placeholder
+        length = len(data)
+        data = data.replace(self._headerPair, self._headerByte)
+        if (not self._sameHeaderFooter):
+            data = data.replace(self._footerPair, self._footerByte)
+        data = data.replace(self._escapePair, self._escapeByte)
+
+        # every valid pair shrinks the data by one byte, so anything short of that is a stray escape
+        if (length - len(data) != escapes):
+            raise ValueError("Invalid character after escape")
+        return data
+
+def encode_frame(payload, frameFormat):
+    '''Escape payload and wrap it in the header and footer of frameFormat'''
+    return frameFormat._headerByte + frameFormat.escapeBytes(payload) + frameFormat._footerByte
+
+def decode_frame(frame, frameFormat):
+    '''Strip the header and footer from a complete frame and un-escape the payload'''
+    view = memoryview(frame)
+    if (len(view) < 2 or view[0] != frameFormat.header or view[-1] != frameFormat.footer):
+        raise ValueError("Frame is not wrapped in the expected header and footer")
+    return frameFormat.unescapeBytes(view[1:-1])
+
+class FrameTemplate():
+    '''A frame whose leading (and trailing) payload bytes never change, escaped and framed once up front
+
+    build() only has to escape the bytes in between: single byte fields (slot, SLN and KID halves) are
+    looked up in the format's escape table, longer ones (key material) go through escapeBytes.
+    '''
+    __slots__ = ("frameFormat", "_prefix", "_suffix")
+
+    def __init__(self, frameFormat, prefix, suffix=b""):
+        self.frameFormat = frameFormat
+        self._prefix = frameFormat._headerByte + frameFormat.escapeBytes(prefix)
+        self._suffix = frameFormat.escapeBytes(suffix) + frameFormat._footerByte
+
+    def build(self, *fields):
+        '''Frame the prefix, then each field (an int for one byte, or bytes-like), then the suffix'''
+        table = self.frameFormat.escapeTable
+        parts = [self._prefix]
+        for field in fields:
+            if (isinstance(field, int)):
+                parts.append(table[field])
+            else:
+                parts.append(self.frameFormat.escapeBytes(field))
+        parts.append(self._suffix)
+        return b"".join(parts)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+#
+# PyKMM - KMM and keyloading for Python
+# GPLv2 Open Source. Use is subject to license terms.
+# DO NOT ALTER OR REMOVE COPYRIGHT NOTICES OR THIS FILE HEADER.
+#
+# @package PyKMM
+#
+###############################################################################
+#   Copyright (C) 2022 Natalie Moore <natalie@natnat.xyz>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+###############################################################################
+
+import bisect
+import collections
+
+# latency bucket upper bounds in seconds, spanning a fast USB adapter up to the 2 s read deadline
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0)
+
+class Histogram():
+    '''Fixed-bucket latency histogram, cheap enough to update on every frame'''
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        # the last bucket catches everything past the largest bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        return {
+            "buckets": {str(bound): count for bound, count in zip(self.bounds + ("+Inf",), self.counts)},
+            "count": self.count,
+            "sum": self.sum,
+        }
+
+class Instrumentation():
+    '''Counters and per-opcode latency histograms for one keyloader's serial traffic
+
+    The keyloader calls commandSent for every frame it writes, firstByte when reply bytes start arriving
+    after an idle receive buffer, frameReceived for every complete reply and timeout when a read gives up.
+    Matching replies to commands is left to the keyloader's own request bookkeeping, which passes in the
+    opcode of the command being answered and how long ago it was written.
+    '''
+    def __init__(self):
+        self.commands = collections.Counter()
+        self.replies = collections.Counter()
+        self.bytesSent = 0
+        self.bytesSentEscaped = 0
+        self.bytesReceived = 0
+        self.bytesReceivedEscaped = 0
+        self.timeouts = 0
+        self.unmatchedReplies = 0
+        # frames with no payload, so no opcode to file them under
+        self.emptyReplies = 0
+        # command opcode -> Histogram
+        self.firstByteLatency = {}
+        self.frameLatency = {}
+        self.session = None
+
+    @staticmethod
+    def _observe(histograms, opcode, latency):
+        histogram = histograms.get(opcode)
+        if (histogram is None):
+            histogram = histograms[opcode] = Histogram()
+        histogram.observe(latency)
+
+    def commandSent(self, opcode, rawLength, escapedLength):
+        self.commands[opcode] += 1
+        self.bytesSent += rawLength
+        self.bytesSentEscaped += escapedLength
+
+    def firstByte(self, opcode, latency):
+        '''Reply bytes started arriving latency seconds after the command with opcode was written'''
+        self._observe(self.firstByteLatency, opcode, latency)
+
+    def frameReceived(self, opcode, rawLength, escapedLength, commandOpcode=None, latency=None):
+        '''A reply frame with opcode arrived; latency is None when it answered no outstanding command'''
+        self.bytesReceived += rawLength
+        self.bytesReceivedEscaped += escapedLength
+        if (opcode is None):
+            self.emptyReplies += 1
+            return
+        self.replies[opcode] += 1
+        if (latency is None):
+            self.unmatchedReplies += 1
+        else:
+            self._observe(self.frameLatency, commandOpcode, latency)
+
+    def timeout(self):
+        self.timeouts += 1
+
+    @property
+    def retries(self):
+        '''Reconnect-and-retry cycles the serial session went through'''
+        if (self.session is None):
+            return 0
+        return self.session.counters().get("reconnects", 0)
+
+    def reset(self):
+        session = self.session
+        self.__init__()
+        self.session = session
+
+    @staticmethod
+    def _byOpcode(values):
+        return {"0x{:02X}".format(op): value for op, value in sorted(values.items())}
+
+    def snapshot(self):
+        return {
+            "commands": self._byOpcode(self.commands),
+            "replies": self._byOpcode(self.replies),
+            "bytesSent": self.bytesSent,
+            "bytesSentEscaped": self.bytesSentEscaped,
+            "bytesReceived": self.bytesReceived,
+            "bytesReceivedEscaped": self.bytesReceivedEscaped,
+            "timeouts": self.timeouts,
+            "retries": self.retries,
+            "unmatchedReplies": self.unmatchedReplies,
+            "emptyReplies": self.emptyReplies,
+            "firstByteLatency": self._byOpcode({op: h.to_dict() for op, h in self.firstByteLatency.items()}),
+            "frameLatency": self._byOpcode({op: h.to_dict() for op, h in self.frameLatency.items()}),
+        }
+
+    def prometheus(self, prefix="pykmm_kfd", labels=None):
+        '''Render the counters in the Prometheus text exposition format'''
+        baseLabels = ",".join('{}="{}"'.format(k, v) for k, v in sorted((labels or {}).items()))
+
+        def fmt(*extra):
+            inner = ",".join(part for part in (baseLabels,) + extra if part)
+            return "{" + inner + "}" if inner else ""
+
+        lines = []
+        def counter(name, help, values):
+            lines.append("# HELP {}_{} {}".format(prefix, name, help))
+            lines.append("# TYPE {}_{} counter".format(prefix, name))
+            for extra, value in values:
+                lines.append("{}_{}{} {}".format(prefix, name, fmt(extra), value))
+
+        counter("commands_total", "Frames sent to the keyloader by opcode.",
+                [('opcode="0x{:02X}"'.format(op), n) for op, n in sorted(self.commands.items())])
+        counter("replies_total", "Frames received from the keyloader by opcode.",
+                [('opcode="0x{:02X}"'.format(op), n) for op, n in sorted(self.replies.items())])
+        counter("sent_bytes_total", "Payload bytes sent, before and after escaping.",
+                [('stage="raw"', self.bytesSent), ('stage="escaped"', self.bytesSentEscaped)])
+        counter("received_bytes_total", "Payload bytes received, before and after unescaping.",
+                [('stage="raw"', self.bytesReceived), ('stage="escaped"', self.bytesReceivedEscaped)])
+        counter("timeouts_total", "Reads that hit the reply deadline.", [("", self.timeouts)])
+        counter("unmatched_replies_total", "Replies that answered no outstanding command.", [("", self.unmatchedReplies)])
+        counter("empty_replies_total", "Frames received with no payload.", [("", self.emptyReplies)])
+        counter("retries_total", "Serial session reconnects.", [("", self.retries)])
+
+        for name, help, histograms in (("first_byte_seconds", "Time from writing a command to the first reply byte, by command opcode.", self.firstByteLatency),
+                                       ("frame_seconds", "Time from writing a command to its complete reply, by command opcode.", self.frameLatency)):
+            lines.append("# HELP {}_{} {}".format(prefix, name, help))
+            lines.append("# TYPE {}_{} histogram".format(prefix, name))
+            for op, histogram in sorted(histograms.items()):
+                opcode = 'opcode="0x{:02X}"'.format(op)
+                cumulative = 0
+                for bound, count in zip(histogram.bounds + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append("{}_{}_bucket{} {}".format(prefix, name, fmt(opcode, 'le="{}"'.format(bound)), cumulative))
+                lines.append("{}_{}_sum{} {}".format(prefix, name, fmt(opcode), histogram.sum))
+                lines.append("{}_{}_count{} {}".format(prefix, name, fmt(opcode), histogram.count))
+        return "\n".join(lines) + "\n"
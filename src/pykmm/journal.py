@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+#
+# PyKMM - KMM and keyloading for Python
+# GPLv2 Open Source. Use is subject to license terms.
+# DO NOT ALTER OR REMOVE COPYRIGHT NOTICES OR THIS FILE HEADER.
+#
+# @package PyKMM
+#
+###############################################################################
+#   Copyright (C) 2022 Natalie Moore <natalie@natnat.xyz>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+###############################################################################
+
+import asyncio
+import os
+import struct
+import time
+import zlib
+
+JOURNAL_MAGIC = b"PKMMJRN2"
+
+# record type, target RSI, keyset ID, campaign (keyset content hash), algorithm ID, key ID, status, timestamp
+_RECORD = struct.Struct(">BIB16sBHBI")
+_CRC = struct.Struct(">I")
+RECORD_LENGTH = _RECORD.size + _CRC.size
+
+class JournalState():
+    '''What a journal says has already happened, for one keyset and campaign'''
+    def __init__(self):
+        self.done = set()
+        self.failed = {}
+        self.ackedSteps = set()
+        self.records = 0
+
+    def stepDone(self, rsi, algId):
+        return (rsi, algId) in self.ackedSteps
+
+class RekeyJournal():
+    '''Append-only log of rekey progress
+
+    Every record is a fixed 30 byte struct plus a CRC32, so replay is a single pass of iter_unpack and a
+    torn write at the tail (power loss, kill -9) is detected and cut off on the next open. Records carry
+    the campaign hash (KeySet.contentHash) of the keys being sent, and progress is kept per keyset ID and
+    campaign, so a journal is never replayed against a different set of keys. Records are buffered and
+    fsynced in batches: after syncEvery records or syncInterval seconds, whichever is first; inside an
+    event loop a timer makes sure the last batch is written even if no further record comes along.
+    Anything not yet synced when the process dies is simply redone, which a radio accepts as a repeat.
+    '''
+    SENT = 0x01
+    ACKED = 0x02
+    DONE = 0x03
+    FAILED = 0x04
+
+    def __init__(self, path, syncEvery=64, syncInterval=0.1):
+        self.path = path
+        self.syncEvery = syncEvery
+        self.syncInterval = syncInterval
+        self.syncs = 0
+
+        self._states = {}
+        self._pending = bytearray()
+        self._pendingCount = 0
+        self._lastSync = time.monotonic()
+        self._syncTimer = None
+
+        self._file = open(path, "a+b")
+        self._file.seek(0)
+        if (self._file.read(len(JOURNAL_MAGIC)) not in (JOURNAL_MAGIC, b"")):
+            self._file.close()
+            raise ValueError("{} is not a rekey journal".format(path))
+        self._replay()
+
+    def _replay(self):
+        self._file.seek(0)
+        data = self._file.read()
+        if (not data):
+            self._file.write(JOURNAL_MAGIC)
+            self._fsync()
+            return
+
+        view = memoryview(data)[len(JOURNAL_MAGIC):]
+        whole = len(view) - len(view) % RECORD_LENGTH
+        good = 0
+        for offset in range(0, whole, RECORD_LENGTH):
+            record = view[offset:offset + _RECORD.size]
+            crc, = _CRC.unpack_from(view, offset + _RECORD.size)
+            if (zlib.crc32(record) != crc):
+                break
+            self._apply(*_RECORD.unpack(record))
+            good = offset + RECORD_LENGTH
+
+        if (good != len(view)):
+            # drop the torn or corrupt tail so new records follow the last good one
+            self._file.truncate(len(JOURNAL_MAGIC) + good)
+            self._fsync()
+
+    def _apply(self, recordType, rsi, keysetId, campaignHash, algId, kid, status, timestamp):
+        state = self.state(keysetId, campaignHash)
+        state.records += 1
+        if (recordType == RekeyJournal.ACKED):
+            state.ackedSteps.add((rsi, algId))
+        elif (recordType == RekeyJournal.DONE):
+            state.done.add(rsi)
+            state.failed.pop(rsi, None)
+        elif (recordType == RekeyJournal.FAILED):
+            state.failed[rsi] = status
+
+    def state(self, keysetId, campaignHash):
+        '''Progress recorded so far for a keyset and campaign'''
+        key = (keysetId, bytes(campaignHash))
+        state = self._states.get(key)
+        if (state is None):
+            state = self._states[key] = JournalState()
+        return state
+
+    def record(self, recordType, rsi, keysetId, campaignHash, algId=0, kid=0, status=0):
+        if (len(campaignHash) != 16):
+            raise ValueError("Campaign hash must be 16 bytes but was {}".format(len(campaignHash)))
+        fields = (recordType, rsi, keysetId, bytes(campaignHash), algId, kid, status, int(time.time()) & 0xFFFFFFFF)
+        offset = len(self._pending)
+        self._pending += bytes(RECORD_LENGTH)
+        _RECORD.pack_into(self._pending, offset, *fields)
+        _CRC.pack_into(self._pending, offset + _RECORD.size, zlib.crc32(self._pending[offset:offset + _RECORD.size]))
+        self._apply(*fields)
+
+        self._pendingCount += 1
+        if (self._pendingCount >= self.syncEvery or time.monotonic() - self._lastSync >= self.syncInterval):
+            self.sync()
+        elif (self._syncTimer is None):
+            self._armSyncTimer()
+
+    def _armSyncTimer(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no event loop to run a timer; the batch goes out with a later record or on close
+            return
+        self._syncTimer = loop.call_later(self.syncInterval, self._timedSync)
+
+    def _timedSync(self):
+        self._syncTimer = None
+        if (self._file is not None):
+            self.sync()
+
+    def sync(self):
+        '''Write and fsync every buffered record'''
+        if (self._syncTimer is not None):
+            self._syncTimer.cancel()
+            self._syncTimer = None
+        if (self._pending):
+            self._file.write(self._pending)
+            self._pending.clear()
+            self._pendingCount = 0
+            self._fsync()
+        self._lastSync = time.monotonic()
+
+    def _fsync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.syncs += 1
+
+    def close(self):
+        if (self._file is not None):
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
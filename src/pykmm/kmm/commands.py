@@ -24,27 +24,691 @@
 #   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 ###############################################################################
 
-from bitarray import bitarray
+import struct
+
+from pykmm.kmm.items import KeyItem, KeyInfo
+
+# message ID, message length, message format, destination RSI, source RSI
+_FRAME_HEADER = struct.Struct(">BHB3s3s")
+_MESSAGE_NUMBER = struct.Struct(">H")
+# the message length counts everything after the length field
+_LENGTH_END = 3
+
+# decryption instruction format, extended decryption instruction format, algorithm ID, key ID,
+# then keyset ID, algorithm ID, key length, number of items
+_MODIFY_KEY = struct.Struct(">BBBHBBBB")
+# just the decryption instruction, which is all that is readable of an encrypted Modify Key body
+_DECRYPTION_INSTRUCTION = struct.Struct(">BBBH")
+# inventory type, inventory marker, max keys requested
+_INVENTORY_LIST_KEYS = struct.Struct(">B3sH")
+# inventory type, inventory marker, number of items
+_INVENTORY_KEYS_RESPONSE = struct.Struct(">B3sH")
+# inventory type, number of items
+_INVENTORY_KSETS_RESPONSE = struct.Struct(">BB")
+# acknowledged message ID, message number, status
+_NEGATIVE_ACK = struct.Struct(">BHB")
+# acknowledged message ID, number of items
+_REKEY_ACK = struct.Struct(">BB")
+# algorithm ID, key ID, status
+_KEY_STATUS = struct.Struct(">BHB")
+# change sequence, old RSI, new RSI, message number
+_CHANGE_RSI = struct.Struct(">B3s3sH")
+# change sequence, old RSI, new RSI, status
+_CHANGE_RSI_RESPONSE = struct.Struct(">B3s3sB")
+
+class KmmMessage():
+    '''Base class of TIA-102.AACA key management messages
+
+    A KMM frame is the message ID, message length, message format, destination and source RSI,
+    an optional message number, the message body and an optional MAC trailer. Subclasses set
+    MESSAGE_ID and implement body_length, pack_body_into and parse_body; parse_body returns the
+    offset just past the body, and whatever follows it in a frame flagged with a MAC is kept
+    undecoded in mac.
+    '''
+    MESSAGE_ID = None
+
+    RESPONSE_NONE = 0
+    RESPONSE_DELAYED = 1
+    RESPONSE_IMMEDIATE = 2
+
+    FORMAT_MESSAGE_NUMBER = 0x10
+    FORMAT_MAC = 0x08
+    FORMAT_DONE = 0x01
+
+    __slots__ = ("responseKind", "dstRsi", "srcRsi", "messageNumber", "done", "mac")
 
-class InventoryCommand():
     def __init__(self):
-        self._sln = 0
-        self._kid = 0
-        self._key = 0
-        self.kek = False
-        self.erase = False
-
-    def get_sln(self):
-        return self._sln
-    
-    def set_sln(self, slnIn):
-        if (isinstance(slnIn, int)):
-            if (slnIn > 0 and slnIn < 0xFFFF):
-                self._sln = slnIn
-            else:
-                raise ValueError("SLN must be between 0x0 and 0xFFFF")
-        else:
-            raise TypeError("SLN must be an int type")
-    
-    def del_sln(self):
-        del self._sln
\ No newline at end of file
+        self.responseKind = KmmMessage.RESPONSE_IMMEDIATE
+        self.dstRsi = 0
+        self.srcRsi = 0
+        self.messageNumber = None
+        self.done = False
+        self.mac = None
+
+    def body_length(self):
+        return 0
+
+    def pack_body_into(self, buffer, offset):
+        return offset
+
+    def parse_body(self, view, offset, end):
+        return offset
+
+    def encoded_length(self):
+        length = _FRAME_HEADER.size + self.body_length()
+        if (self.messageNumber is not None):
+            length += _MESSAGE_NUMBER.size
+        if (self.mac is not None):
+            length += len(self.mac)
+        return length
+
+    def pack_into(self, buffer, offset=0):
+        '''Encode the whole frame into a writable buffer at offset and return the offset just past it'''
+        messageFormat = (self.responseKind & 0x03) << 6
+        if (self.messageNumber is not None):
+            messageFormat |= KmmMessage.FORMAT_MESSAGE_NUMBER
+        if (self.mac is not None):
+            messageFormat |= KmmMessage.FORMAT_MAC
+        if (self.done):
+            messageFormat |= KmmMessage.FORMAT_DONE
+
+        _FRAME_HEADER.pack_into(buffer, offset, self.MESSAGE_ID, self.encoded_length() - _LENGTH_END, messageFormat,
+                                self.dstRsi.to_bytes(3, "big"), self.srcRsi.to_bytes(3, "big"))
+        pos = offset + _FRAME_HEADER.size
+        if (self.messageNumber is not None):
+            _MESSAGE_NUMBER.pack_into(buffer, pos, self.messageNumber)
+            pos += _MESSAGE_NUMBER.size
+        pos = self.pack_body_into(buffer, pos)
+        if (self.mac is not None):
+            buffer[pos:pos + len(self.mac)] = self.mac
+            pos += len(self.mac)
+        return pos
+
+    def to_bytes(self):
+        kmmBytes = bytearray(self.encoded_length())
+        self.pack_into(kmmBytes)
+        return kmmBytes
+
+    def __str__(self):
+        return f"<{type(self).__name__} 0x{self.srcRsi:06X} -> 0x{self.dstRsi:06X}>"
+
+def _rsi(raw):
+    return int.from_bytes(raw, "big")
+
+class InventoryCommand(KmmMessage):
+    '''Inventory request; the fields of inventory types other than the two below are kept as-is in rawBody'''
+    MESSAGE_ID = 0x0D
+
+    LIST_ACTIVE_KSET_IDS = 0x02
+    LIST_ACTIVE_KEYS = 0xFD
+
+    __slots__ = ("inventoryType", "inventoryMarker", "maxKeysRequested", "rawBody")
+
+    def __init__(self, inventoryType=LIST_ACTIVE_KEYS):
+        super().__init__()
+        self.inventoryType = inventoryType
+        self.inventoryMarker = 0
+        self.maxKeysRequested = 0xFFFF
+        self.rawBody = b""
+
+    def body_length(self):
+        if (self.inventoryType == InventoryCommand.LIST_ACTIVE_KEYS):
+            return _INVENTORY_LIST_KEYS.size
+        elif (self.inventoryType == InventoryCommand.LIST_ACTIVE_KSET_IDS):
+            return 1
+        return 1 + len(self.rawBody)
+
+    def pack_body_into(self, buffer, offset):
+        if (self.inventoryType == InventoryCommand.LIST_ACTIVE_KEYS):
+            _INVENTORY_LIST_KEYS.pack_into(buffer, offset, self.inventoryType, self.inventoryMarker.to_bytes(3, "big"), self.maxKeysRequested)
+            return offset + _INVENTORY_LIST_KEYS.size
+        buffer[offset] = self.inventoryType
+        offset += 1
+        if (self.inventoryType == InventoryCommand.LIST_ACTIVE_KSET_IDS):
+            return offset
+        buffer[offset:offset + len(self.rawBody)] = self.rawBody
+        return offset + len(self.rawBody)
+
+    def parse_body(self, view, offset, end):
+        self.inventoryType = view[offset]
+        if (self.inventoryType == InventoryCommand.LIST_ACTIVE_KEYS):
+            inventoryType, marker, self.maxKeysRequested = _INVENTORY_LIST_KEYS.unpack_from(view, offset)
+            self.inventoryMarker = _rsi(marker)
+            return offset + _INVENTORY_LIST_KEYS.size
+        elif (self.inventoryType == InventoryCommand.LIST_ACTIVE_KSET_IDS):
+            return offset + 1
+        self.rawBody = bytes(view[offset + 1:end])
+        return end
+
+class InventoryResponse(KmmMessage):
+    '''Inventory reply; keysetIds for LIST_ACTIVE_KSET_IDS, keys (KeyInfo) for LIST_ACTIVE_KEYS
+
+    Any other inventory type is kept undecoded (including any MAC trailer) in rawBody.
+    '''
+    MESSAGE_ID = 0x0E
+
+    __slots__ = ("inventoryType", "inventoryMarker", "keysetIds", "keys", "rawBody")
+
+    def __init__(self, inventoryType=InventoryCommand.LIST_ACTIVE_KEYS):
+        super().__init__()
+        self.inventoryType = inventoryType
+        self.inventoryMarker = 0
+        self.keysetIds = []
+        self.keys = []
+        self.rawBody = b""
+
+    def body_length(self):
+        if (self.inventoryType == InventoryCommand.LIST_ACTIVE_KEYS):
+            return _INVENTORY_KEYS_RESPONSE.size + KeyInfo.LENGTH * len(self.keys)
+        elif (self.inventoryType == InventoryCommand.LIST_ACTIVE_KSET_IDS):
+            return _INVENTORY_KSETS_RESPONSE.size + len(self.keysetIds)
+        return 1 + len(self.rawBody)
+
+    def pack_body_into(self, buffer, offset):
+        if (self.inventoryType == InventoryCommand.LIST_ACTIVE_KEYS):
+            _INVENTORY_KEYS_RESPONSE.pack_into(buffer, offset, self.inventoryType, self.inventoryMarker.to_bytes(3, "big"), len(self.keys))
+            offset += _INVENTORY_KEYS_RESPONSE.size
+            for keyInfo in self.keys:
+                offset = keyInfo.pack_into(buffer, offset)
+            return offset
+        elif (self.inventoryType == InventoryCommand.LIST_ACTIVE_KSET_IDS):
+            _INVENTORY_KSETS_RESPONSE.pack_into(buffer, offset, self.inventoryType, len(self.keysetIds))
+            offset += _INVENTORY_KSETS_RESPONSE.size
+            buffer[offset:offset + len(self.keysetIds)] = bytes(self.keysetIds)
+            return offset + len(self.keysetIds)
+        buffer[offset] = self.inventoryType
+        offset += 1
+        buffer[offset:offset + len(self.rawBody)] = self.rawBody
+        return offset + len(self.rawBody)
+
+    def parse_body(self, view, offset, end):
+        self.inventoryType = view[offset]
+        if (self.inventoryType == InventoryCommand.LIST_ACTIVE_KEYS):
+            inventoryType, marker, count = _INVENTORY_KEYS_RESPONSE.unpack_from(view, offset)
+            self.inventoryMarker = _rsi(marker)
+            offset += _INVENTORY_KEYS_RESPONSE.size
+            self.keys = []
+            for i in range(0, count):
+                keyInfo = KeyInfo()
+                offset = keyInfo.parse(view, offset)
+                self.keys.append(keyInfo)
+            return offset
+        elif (self.inventoryType == InventoryCommand.LIST_ACTIVE_KSET_IDS):
+            inventoryType, count = _INVENTORY_KSETS_RESPONSE.unpack_from(view, offset)
+            offset += _INVENTORY_KSETS_RESPONSE.size
+            if (offset + count > end):
+                raise ValueError("Inventory claims {} keyset IDs but only {} bytes are left".format(count, end - offset))
+            self.keysetIds = list(view[offset:offset + count])
+            return offset + count
+        self.rawBody = bytes(view[offset + 1:end])
+        return end
+
+class ModifyKeyCommand(KmmMessage):
+    '''Load (or erase) a set of keys of one algorithm into a keyset
+
+    kekAlgId/kekKid describe how the key items are encrypted; ALGID_CLEAR means they are sent in the clear.
+    A body with a non-zero decryptionFormat can't be decoded here, so everything after the decryption
+    instruction (including any MAC trailer) is kept as-is in encryptedBody and keys is left empty.
+    '''
+    MESSAGE_ID = 0x13
+
+    ALGID_CLEAR = 0x80
+
+    __slots__ = ("decryptionFormat", "kekAlgId", "kekKid", "keysetId", "algId", "keys", "encryptedBody")
+
+    def __init__(self):
+        super().__init__()
+        self.decryptionFormat = 0x00
+        self.kekAlgId = ModifyKeyCommand.ALGID_CLEAR
+        self.kekKid = 0
+        self.keysetId = 0
+        self.algId = 0
+        self.keys = []
+        self.encryptedBody = None
+
+    def _keyLength(self):
+        if (not self.keys):
+            return 0
+        keyLength = len(self.keys[0].keyBytes)
+        for keyItem in self.keys:
+            if (len(keyItem.keyBytes) != keyLength):
+                raise ValueError("All keys in a {} must be the same length".format(type(self).__name__))
+        return keyLength
+
+    def body_length(self):
+        if (self.encryptedBody is not None):
+            return _DECRYPTION_INSTRUCTION.size + len(self.encryptedBody)
+        return _MODIFY_KEY.size + (KeyItem.HEADER_LENGTH + self._keyLength()) * len(self.keys)
+
+    def pack_body_into(self, buffer, offset):
+        if (self.encryptedBody is not None):
+            _DECRYPTION_INSTRUCTION.pack_into(buffer, offset, self.decryptionFormat, 0x00, self.kekAlgId, self.kekKid)
+            offset += _DECRYPTION_INSTRUCTION.size
+            buffer[offset:offset + len(self.encryptedBody)] = self.encryptedBody
+            return offset + len(self.encryptedBody)
+        _MODIFY_KEY.pack_into(buffer, offset, self.decryptionFormat, 0x00, self.kekAlgId, self.kekKid,
+                              self.keysetId, self.algId, self._keyLength(), len(self.keys))
+        offset += _MODIFY_KEY.size
+        for keyItem in self.keys:
+            offset = keyItem.pack_into(buffer, offset)
+        return offset
+
+    def parse_body(self, view, offset, end):
+        self.decryptionFormat, extendedFormat, self.kekAlgId, self.kekKid = _DECRYPTION_INSTRUCTION.unpack_from(view, offset)
+        self.keys = []
+        if (self.decryptionFormat != 0x00):
+            offset += _DECRYPTION_INSTRUCTION.size
+            self.encryptedBody = bytes(view[offset:end])
+            return end
+
+        self.encryptedBody = None
+        (decryptionFormat, extendedFormat, self.kekAlgId, self.kekKid,
+         self.keysetId, self.algId, keyLength, count) = _MODIFY_KEY.unpack_from(view, offset)
+        offset += _MODIFY_KEY.size
+        for i in range(0, count):
+            keyItem = KeyItem()
+            offset = keyItem.parse(view, keyLength, offset)
+            self.keys.append(keyItem)
+        return offset
+
+class RekeyCommand(ModifyKeyCommand):
+    '''OTAR rekey; carries the same KEK and keyset layout as a Modify Key command'''
+    MESSAGE_ID = 0x1E
+
+    __slots__ = ()
+
+class KeyStatus():
+    '''Per-key result carried in a Rekey Acknowledgment'''
+    __slots__ = ("algId", "kid", "status")
+
+    def __init__(self, algId=0, kid=0, status=0):
+        self.algId = algId
+        self.kid = kid
+        self.status = status
+
+class RekeyAcknowledgment(KmmMessage):
+    MESSAGE_ID = 0x1D
+
+    __slots__ = ("acknowledgedMessageId", "statuses")
+
+    def __init__(self):
+        super().__init__()
+        self.acknowledgedMessageId = RekeyCommand.MESSAGE_ID
+        self.statuses = []
+
+    def body_length(self):
+        return _REKEY_ACK.size + _KEY_STATUS.size * len(self.statuses)
+
+    def pack_body_into(self, buffer, offset):
+        _REKEY_ACK.pack_into(buffer, offset, self.acknowledgedMessageId, len(self.statuses))
+        offset += _REKEY_ACK.size
+        for keyStatus in self.statuses:
+            _KEY_STATUS.pack_into(buffer, offset, keyStatus.algId, keyStatus.kid, keyStatus.status)
+            offset += _KEY_STATUS.size
+        return offset
+
+    def parse_body(self, view, offset, end):
+        self.acknowledgedMessageId, count = _REKEY_ACK.unpack_from(view, offset)
+        offset += _REKEY_ACK.size
+        self.statuses = [KeyStatus(*_KEY_STATUS.unpack_from(view, offset + i * _KEY_STATUS.size)) for i in range(0, count)]
+        return offset + count * _KEY_STATUS.size
+
+class NegativeAcknowledgment(KmmMessage):
+    MESSAGE_ID = 0x16
+
+    __slots__ = ("acknowledgedMessageId", "acknowledgedMessageNumber", "status")
+
+    def __init__(self):
+        super().__init__()
+        self.acknowledgedMessageId = 0
+        self.acknowledgedMessageNumber = 0
+        self.status = 0
+
+    def body_length(self):
+        return _NEGATIVE_ACK.size
+
+    def pack_body_into(self, buffer, offset):
+        _NEGATIVE_ACK.pack_into(buffer, offset, self.acknowledgedMessageId, self.acknowledgedMessageNumber, self.status)
+        return offset + _NEGATIVE_ACK.size
+
+    def parse_body(self, view, offset, end):
+        self.acknowledgedMessageId, self.acknowledgedMessageNumber, self.status = _NEGATIVE_ACK.unpack_from(view, offset)
+        return offset + _NEGATIVE_ACK.size
+
+class ZeroizeCommand(KmmMessage):
+    MESSAGE_ID = 0x21
+
+    __slots__ = ()
+
+class ZeroizeResponse(KmmMessage):
+    MESSAGE_ID = 0x22
+
+    __slots__ = ()
+
+class ChangeRsiCommand(KmmMessage):
+    MESSAGE_ID = 0x03
+
+    __slots__ = ("changeSequence", "rsiOld", "rsiNew", "changeMessageNumber")
+
+    def __init__(self):
+        super().__init__()
+        self.changeSequence = 0
+        self.rsiOld = 0
+        self.rsiNew = 0
+        self.changeMessageNumber = 0
+
+    def body_length(self):
+        return _CHANGE_RSI.size
+
+    def pack_body_into(self, buffer, offset):
+        _CHANGE_RSI.pack_into(buffer, offset, self.changeSequence, self.rsiOld.to_bytes(3, "big"),
+                              self.rsiNew.to_bytes(3, "big"), self.changeMessageNumber)
+        return offset + _CHANGE_RSI.size
+
+    def parse_body(self, view, offset, end):
+        self.changeSequence, rsiOld, rsiNew, self.changeMessageNumber = _CHANGE_RSI.unpack_from(view, offset)
+        self.rsiOld = _rsi(rsiOld)
+        self.rsiNew = _rsi(rsiNew)
+        return offset + _CHANGE_RSI.size
+
+class ChangeRsiResponse(KmmMessage):
+    MESSAGE_ID = 0x04
+
+    __slots__ = ("changeSequence", "rsiOld", "rsiNew", "status")
+
+    def __init__(self):
+        super().__init__()
+        self.changeSequence = 0
+        self.rsiOld = 0
+        self.rsiNew = 0
+        self.status = 0
+
+    def body_length(self):
+        return _CHANGE_RSI_RESPONSE.size
+
+    def pack_body_into(self, buffer, offset):
+        _CHANGE_RSI_RESPONSE.pack_into(buffer, offset, self.changeSequence, self.rsiOld.to_bytes(3, "big"),
+                                       self.rsiNew.to_bytes(3, "big"), self.status)
+        return offset + _CHANGE_RSI_RESPONSE.size
+
+    def parse_body(self, view, offset, end):
+        self.changeSequence, rsiOld, rsiNew, self.status = _CHANGE_RSI_RESPONSE.unpack_from(view, offset)
+        self.rsiOld = _rsi(rsiOld)
+        self.rsiNew = _rsi(rsiNew)
+        return offset + _CHANGE_RSI_RESPONSE.size
+
+class UnknownMessage(KmmMessage):
+    '''Any message without a codec here; the body (and any MAC trailer) is kept as raw bytes'''
+    __slots__ = ("messageId", "body")
+
+    def __init__(self, messageId=0):
+        super().__init__()
+        self.messageId = messageId
+        self.body = b""
+
+    @property
+    def MESSAGE_ID(self):
+        return self.messageId
+
+    def body_length(self):
+        return len(self.body)
+
+    def pack_body_into(self, buffer, offset):
+        buffer[offset:offset + len(self.body)] = self.body
+        return offset + len(self.body)
+
+    def parse_body(self, view, offset, end):
+        self.body = bytes(view[offset:end])
+        return end
+
+# message ID -> class used to decode it
+MESSAGE_TYPES = {cls.MESSAGE_ID: cls for cls in (
+    InventoryCommand, InventoryResponse, ModifyKeyCommand, RekeyCommand, RekeyAcknowledgment,
+    NegativeAcknowledgment, ZeroizeCommand, ZeroizeResponse, ChangeRsiCommand, ChangeRsiResponse,
+)}
+
+def frame_length(view, offset=0):
+    '''Total length of the KMM frame starting at offset, or None if the length field isn't there yet'''
+    if (len(view) - offset < _LENGTH_END):
+        return None
+    return _LENGTH_END + ((view[offset + 1] << 8) | view[offset + 2])
+
+def parse_kmm(bytesIn, offset=0):
+    '''Decode the KMM frame at offset; returns (message, offset just past it)
+
+    Raises ValueError for a truncated or malformed frame.
+    '''
+    view = memoryview(bytesIn)
+    if (len(view) - offset < _FRAME_HEADER.size):
+        raise ValueError("Expected at least {} bytes incoming but got {}".format(_FRAME_HEADER.size, len(view) - offset))
+
+    messageId, messageLength, messageFormat, dstRsi, srcRsi = _FRAME_HEADER.unpack_from(view, offset)
+    end = offset + _LENGTH_END + messageLength
+    if (end - offset < _FRAME_HEADER.size):
+        raise ValueError("KMM length {} is shorter than its header".format(messageLength))
+    if (end > len(view)):
+        raise ValueError("KMM claims {} bytes but only {} are available".format(end - offset, len(view) - offset))
+    # the body can't read into whatever follows the frame
+    view = view[:end]
+
+    cls = MESSAGE_TYPES.get(messageId)
+    message = cls() if cls is not None else UnknownMessage(messageId)
+    message.responseKind = messageFormat >> 6
+    message.done = bool(messageFormat & KmmMessage.FORMAT_DONE)
+    message.dstRsi = _rsi(dstRsi)
+    message.srcRsi = _rsi(srcRsi)
+    pos = offset + _FRAME_HEADER.size
+    try:
+        if (messageFormat & KmmMessage.FORMAT_MESSAGE_NUMBER):
+            message.messageNumber, = _MESSAGE_NUMBER.unpack_from(view, pos)
+            pos += _MESSAGE_NUMBER.size
+        pos = message.parse_body(view, pos, end)
+    except (struct.error, IndexError) as e:
+        raise ValueError("Truncated {} body: {}".format(type(message).__name__, e)) from e
+    if (messageFormat & KmmMessage.FORMAT_MAC):
+        message.mac = bytes(view[pos:end])
+    elif (pos != end):
+        raise ValueError("Unexpected {} bytes after the {} body".format(end - pos, type(message).__name__))
+    return message, end
+
+def iter_kmms(bytesIn):
+    '''Yield every message from back-to-back KMM frames, e.g. a capture file read into memory'''
+    view = memoryview(bytesIn)
+    offset = 0
+    while offset < len(view):
+        message, offset = parse_kmm(view, offset)
+        yield message
+
+class KmmEncoder():
+    '''Encodes messages into one reusable buffer instead of allocating per message'''
+    def __init__(self, size=4096):
+        self._buffer = bytearray(size)
+
+    def _reserve(self, size):
+        if (len(self._buffer) < size):
+            self._buffer = bytearray(max(size, 2 * len(self._buffer)))
+
+    def encode(self, message):
+        '''Return a memoryview of the encoded frame; only valid until the next call'''
+        return self.encode_many((message,))
+
+    def encode_many(self, messages):
+        '''Encode messages back-to-back; the returned memoryview is only valid until the next call'''
+        messages = list(messages)
+        self._reserve(sum(message.encoded_length() for message in messages))
+        offset = 0
+        for message in messages:
+            offset = message.pack_into(self._buffer, offset)
+        return memoryview(self._buffer)[:offset]
+
+class LazyKmm():
+    '''A KMM frame backed by a memoryview; header fields are read on access and the body is only
+    decoded (into the matching KmmMessage) when one of its fields is asked for
+
+    The view points into the chunk it was parsed from, so call copy() to keep a message past
+    the point where that buffer gets reused.
+    '''
+    __slots__ = ("_view", "_decoded")
+
+    def __init__(self, view):
+        self._view = view
+        self._decoded = None
+
+    @property
+    def raw(self):
+        return self._view
+
+    @property
+    def messageId(self):
+        return self._view[0]
+
+    @property
+    def MESSAGE_ID(self):
+        return self._view[0]
+
+    @property
+    def messageLength(self):
+        return (self._view[1] << 8) | self._view[2]
+
+    @property
+    def responseKind(self):
+        return self._view[3] >> 6
+
+    @property
+    def done(self):
+        return bool(self._view[3] & KmmMessage.FORMAT_DONE)
+
+    @property
+    def dstRsi(self):
+        return _rsi(self._view[4:7])
+
+    @property
+    def srcRsi(self):
+        return _rsi(self._view[7:10])
+
+    @property
+    def messageNumber(self):
+        if (not self._view[3] & KmmMessage.FORMAT_MESSAGE_NUMBER):
+            return None
+        return _MESSAGE_NUMBER.unpack_from(self._view, _FRAME_HEADER.size)[0]
+
+    @property
+    def body(self):
+        offset = _FRAME_HEADER.size
+        if (self._view[3] & KmmMessage.FORMAT_MESSAGE_NUMBER):
+            offset += _MESSAGE_NUMBER.size
+        return self._view[offset:]
+
+    def decode(self):
+        '''Full KmmMessage for this frame (decoded once)'''
+        if (self._decoded is None):
+            self._decoded, end = parse_kmm(self._view)
+        return self._decoded
+
+    def copy(self):
+        '''Detach from the source buffer'''
+        return LazyKmm(memoryview(bytes(self._view)))
+
+    def __len__(self):
+        return len(self._view)
+
+    def __bytes__(self):
+        return bytes(self._view)
+
+    def __getattr__(self, name):
+        # only reached for names that aren't header properties, i.e. body fields
+        return getattr(self.decode(), name)
+
+class KmmStreamParser():
+    '''Push parser for KMM frames arriving in arbitrary chunks (serial reads, DLI datagrams, files)
+
+    Frames wholly inside a fed chunk are handed out as views into that chunk without copying;
+    only a frame split across chunks is reassembled in the internal buffer.
+    '''
+    def __init__(self, maxLength=0xFFFF + _LENGTH_END):
+        self._partial = bytearray()
+        self._maxLength = maxLength
+        self._error = None
+
+    @property
+    def buffered(self):
+        '''Number of bytes held back waiting for the rest of a frame'''
+        return len(self._partial)
+
+    def feed(self, chunk):
+        '''Consume a chunk of bytes and return a LazyKmm for every frame it completes
+
+        Raises ValueError for an invalid frame length. If complete frames came before it in the same
+        chunk, those are returned and the error is raised by the next call instead, which leaves its
+        own chunk unconsumed; feed(b"") picks up such an error, and reset() clears it.
+        '''
+        if (self._error is not None):
+            error, self._error = self._error, None
+            raise error
+        frames = []
+        try:
+            for frame in self._frames(chunk):
+                frames.append(frame)
+        except ValueError as e:
+            if (not frames):
+                raise
+            self._error = e
+        return frames
+
+    def _frames(self, chunk):
+        view = memoryview(chunk).cast("B")
+        offset = 0
+
+        if (self._partial):
+            # top the partial frame up with just the bytes it is missing
+            need = self._missing(self._partial)
+            if (need is None):
+                take = min(_LENGTH_END - len(self._partial), len(view))
+                self._partial += view[:take]
+                offset = take
+                need = self._missing(self._partial)
+                if (need is None):
+                    return
+            take = min(need, len(view) - offset)
+            self._partial += view[offset:offset + take]
+            offset += take
+            if (take < need):
+                return
+            frame = memoryview(bytes(self._partial))
+            self._partial.clear()
+            yield LazyKmm(frame)
+
+        while offset < len(view):
+            length = frame_length(view, offset)
+            if (length is not None):
+                self._checkLength(length)
+            if (length is None or offset + length > len(view)):
+                self._partial += view[offset:]
+                return
+            yield LazyKmm(view[offset:offset + length])
+            offset += length
+
+    def _missing(self, partial):
+        length = frame_length(partial)
+        if (length is None):
+            return None
+        self._checkLength(length)
+        return length - len(partial)
+
+    def _checkLength(self, length):
+        if (length < _FRAME_HEADER.size or length > self._maxLength):
+            self._partial.clear()
+            raise ValueError("Invalid KMM length {}".format(length))
+
+    def reset(self):
+        self._partial.clear()
+        self._error = None
+
+def iter_kmm_stream(chunks):
+    '''Yield LazyKmm messages from an iterable of byte chunks, e.g. iter(partial(f.read, 65536), b"")'''
+    parser = KmmStreamParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    parser.feed(b"")
+    if (parser.buffered):
+        raise ValueError("Stream ended with {} bytes of an incomplete KMM".format(parser.buffered))
@@ -24,14 +24,27 @@
 #   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 ###############################################################################
 
-from bitarray import bitarray
-from bitarray.util import ba2int, zeros
+import struct
+
+# key format, SLN, KID; the key material follows
+_KEY_ITEM_HEADER = struct.Struct(">BHH")
+# keyset ID, SLN, algorithm ID, KID
+_KEY_INFO = struct.Struct(">BHBH")
 
 class KeyItem():
+    '''A key item as carried in a TIA-102.AACA Modify Key command'''
+    FORMAT_KEK = 0x80
+    FORMAT_ERASE = 0x20
+
+    # key format, SLN and KID
+    HEADER_LENGTH = _KEY_ITEM_HEADER.size
+
+    __slots__ = ("_sln", "_kid", "_key", "kek", "erase")
+
     def __init__(self):
         self._sln = 0
         self._kid = 0
-        self._key = 0
+        self._key = b""
         self.kek = False
         self.erase = False
 
@@ -66,37 +79,65 @@ class KeyItem():
         del self._kid
 
     def get_key(self):
-        return self._key
+        return list(self._key)
     
     def set_key(self, keyIn):
-        if (isinstance(keyIn, list)):
-            self._key = keyIn
+        if (isinstance(keyIn, (list, bytes, bytearray, memoryview))):
+            self._key = bytes(keyIn)
         else:
-            raise TypeError("Key must be a list, but was {}".format(type(keyIn)))
+            raise TypeError("Key must be a list or bytes, but was {}".format(type(keyIn)))
     
     def del_key(self):
         del self._key
 
-    def to_bytes(self):
-        keyItemFormat = bitarray(8)
-        keyItemFormat[7] = self.kek
-        keyItemFormat[5] = self.erase
+    @property
+    def keyBytes(self):
+        '''The key material as bytes, without the list copy the key property makes'''
+        return self._key
 
-        keyItemData = []
-        keyItemData.append(ba2int(keyItemFormat))
-        #keyItemData += self._sln   # 2 bytes
-        #keyItemData += self._kid   # 2 bytes
-        #keyItemData += self._key   # however long the key is
+    def encoded_length(self):
+        '''Number of bytes to_bytes/pack_into produce for this item'''
+        return _KEY_ITEM_HEADER.size + len(self._key)
 
-        #TODO: finish this
+    def pack_into(self, buffer, offset=0):
+        '''Encode the item into a writable buffer at offset and return the offset just past it'''
+        keyItemFormat = 0
+        if (self.kek):
+            keyItemFormat |= KeyItem.FORMAT_KEK
+        if (self.erase):
+            keyItemFormat |= KeyItem.FORMAT_ERASE
 
-        return bytearray(keyItemData)
+        _KEY_ITEM_HEADER.pack_into(buffer, offset, keyItemFormat, self._sln, self._kid)
+        offset += _KEY_ITEM_HEADER.size
+        end = offset + len(self._key)
+        buffer[offset:end] = self._key
+        return end
 
-    def parse(self, bytesIn):
-        if (len(bytesIn) < 5):
-            raise ValueError("Expected more then 5 bytes incoming but got {}".format(len(bytesIn)))
+    def to_bytes(self):
+        keyItemBytes = bytearray(self.encoded_length())
+        self.pack_into(keyItemBytes)
+        return keyItemBytes
 
-        #TODO: finish
+    def parse(self, bytesIn, keyLength=None, offset=0):
+        '''Decode a key item from bytesIn at offset and return the offset just past it
+
+        keyLength is the key length from the enclosing keyset; without it the rest of bytesIn is taken as the key.
+        '''
+        view = memoryview(bytesIn)
+        available = len(view) - offset
+        if (available < _KEY_ITEM_HEADER.size):
+            raise ValueError("Expected more then 5 bytes incoming but got {}".format(available))
+        if (keyLength is None):
+            keyLength = available - _KEY_ITEM_HEADER.size
+        elif (available < _KEY_ITEM_HEADER.size + keyLength):
+            raise ValueError("Expected {} bytes incoming but got {}".format(_KEY_ITEM_HEADER.size + keyLength, available))
+
+        keyItemFormat, self._sln, self._kid = _KEY_ITEM_HEADER.unpack_from(view, offset)
+        self.kek = bool(keyItemFormat & KeyItem.FORMAT_KEK)
+        self.erase = bool(keyItemFormat & KeyItem.FORMAT_ERASE)
+        offset += _KEY_ITEM_HEADER.size
+        self._key = bytes(view[offset:offset + keyLength])
+        return offset + keyLength
 
     '''SLN, or storage location number, of the key'''
     sln = property(get_sln, set_sln, del_sln)
@@ -108,7 +149,15 @@ class KeyItem():
 
 
 class KeyInfo():
+    '''Key information as listed in a TIA-102.AACA inventory (keyset, SLN, algorithm and KID, no key material)'''
+    LENGTH = _KEY_INFO.size
+
+    __slots__ = ("slot", "keysetId", "algId", "_sln", "_kid", "_key", "kek", "erase")
+
     def __init__(self):
+        self.slot = None    # keyloader slot the key was read from, if any
+        self.keysetId = 0
+        self.algId = 0
         self._sln = 0
         self._kid = 0
         self._key = 0
@@ -157,27 +206,24 @@ class KeyInfo():
     def del_key(self):
         del self._key
 
-    def to_bytes(self):
-        # create empty bitarray
-        keyItemFormat = zeros(8)
-        keyItemFormat[7] = self.kek
-        keyItemFormat[5] = self.erase
-
-        keyItemBytes = bytearray(5 + len(self._key))
-        keyItemBytes[0] = keyItemFormat
-        #keyItemBytes += self._sln   # 2 bytes
-        #keyItemBytes += self._kid   # 2 bytes
-        #keyItemBytes += self._key   # however long the key is
+    def pack_into(self, buffer, offset=0):
+        '''Encode the key info into a writable buffer at offset and return the offset just past it'''
+        _KEY_INFO.pack_into(buffer, offset, self.keysetId, self._sln, self.algId, self._kid)
+        return offset + _KEY_INFO.size
 
-        #TODO: finish this
-
-        return keyItemBytes
-
-    def parse(self, bytesIn):
-        if (len(bytesIn) < 5):
-            raise ValueError("Expected more then 5 bytes incoming but got {}".format(len(bytesIn)))
-
-        #TODO: finish
+    def to_bytes(self):
+        keyInfoBytes = bytearray(_KEY_INFO.size)
+        self.pack_into(keyInfoBytes)
+        return keyInfoBytes
+
+    def parse(self, bytesIn, offset=0):
+        '''Decode key info from bytesIn at offset and return the offset just past it'''
+        available = len(bytesIn) - offset
+        if (available < _KEY_INFO.size):
+            raise ValueError("Expected {} bytes incoming but got {}".format(_KEY_INFO.size, available))
+
+        self.keysetId, self._sln, self.algId, self._kid = _KEY_INFO.unpack_from(bytesIn, offset)
+        return offset + _KEY_INFO.size
 
     sln = property(get_sln, set_sln, del_sln)
     kid = property(get_kid, set_kid, del_kid)
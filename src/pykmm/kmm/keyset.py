@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+#
+# PyKMM - KMM and keyloading for Python
+# GPLv2 Open Source. Use is subject to license terms.
+# DO NOT ALTER OR REMOVE COPYRIGHT NOTICES OR THIS FILE HEADER.
+#
+# @package PyKMM
+#
+###############################################################################
+#   Copyright (C) 2022 Natalie Moore <natalie@natnat.xyz>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+###############################################################################
+
+from array import array
+import hashlib
+
+from pykmm.kmm.items import KeyItem
+
+class KeySet():
+    '''Columnar store for large numbers of keys
+
+    SLN, KID, algorithm and flags live in typed arrays and all key material in one contiguous buffer,
+    so each key costs a few bytes of bookkeeping rather than a Python object. Lookups by SLN or KID
+    are O(1); KeyItem objects are only built when an entry is read back.
+    '''
+    FLAG_KEK = 0x01
+    FLAG_ERASE = 0x02
+
+    def __init__(self, keysetId=0):
+        self.keysetId = keysetId
+        self._sln = array('H')
+        self._kid = array('H')
+        self._algId = array('H')
+        self._flags = array('B')
+        self._keyOffset = array('L')
+        self._keyLength = array('H')
+        self._keyData = bytearray()
+        self._bySln = {}
+        self._byKid = {}
+
+    def __len__(self):
+        return len(self._sln)
+
+    def __contains__(self, sln):
+        return sln in self._bySln
+
+    def __iter__(self):
+        for i in range(0, len(self._sln)):
+            yield self.item(i)
+
+    def add(self, keyItem, algId):
+        '''Store keyItem under algorithm algId, replacing any key already at the same SLN; returns its index'''
+        if (not isinstance(keyItem, KeyItem)):
+            raise TypeError("You must pass a KeyItem type to me; see pykmm.kmm.items.KeyItem")
+
+        if (not isinstance(algId, int) or algId < 0 or algId > 0xFF):
+            raise ValueError("Algorithm ID must be between 0x0 and 0xFF")
+
+        key = keyItem.keyBytes
+        flags = 0
+        if (keyItem.kek):
+            flags |= KeySet.FLAG_KEK
+        if (keyItem.erase):
+            flags |= KeySet.FLAG_ERASE
+
+        index = self._bySln.get(keyItem.sln)
+        if (index is not None and len(key) == self._keyLength[index]):
+            offset = self._keyOffset[index]
+            self._keyData[offset:offset + len(key)] = key
+        else:
+            # grow the buffer before touching any column, so a failure here leaves the set as it was;
+            # replaced material is left behind until compact()
+            offset = len(self._keyData)
+            self._keyData += key
+
+        if (index is None):
+            index = len(self._sln)
+            self._sln.append(keyItem.sln)
+            self._kid.append(keyItem.kid)
+            self._algId.append(algId)
+            self._flags.append(flags)
+            self._keyOffset.append(offset)
+            self._keyLength.append(len(key))
+            self._bySln[keyItem.sln] = index
+        else:
+            self._unindexKid(index)
+            self._kid[index] = keyItem.kid
+            self._algId[index] = algId
+            self._flags[index] = flags
+            self._keyOffset[index] = offset
+            self._keyLength[index] = len(key)
+
+        self._byKid.setdefault(keyItem.kid, []).append(index)
+        return index
+
+    def _unindexKid(self, index):
+        indexes = self._byKid[self._kid[index]]
+        indexes.remove(index)
+        if (not indexes):
+            del self._byKid[self._kid[index]]
+
+    def remove(self, sln):
+        '''Drop the key at sln; the last entry takes its index'''
+        index = self._bySln.pop(sln)
+        self._unindexKid(index)
+        last = len(self._sln) - 1
+        if (index != last):
+            self._unindexKid(last)
+            for column in (self._sln, self._kid, self._algId, self._flags, self._keyOffset, self._keyLength):
+                column[index] = column[last]
+            self._bySln[self._sln[index]] = index
+            self._byKid.setdefault(self._kid[index], []).append(index)
+        for column in (self._sln, self._kid, self._algId, self._flags, self._keyOffset, self._keyLength):
+            column.pop()
+
+    def compact(self):
+        '''Rebuild the key buffer without material left behind by replaced or removed keys'''
+        keyData = bytearray()
+        for i in range(0, len(self._sln)):
+            offset = self._keyOffset[i]
+            self._keyOffset[i] = len(keyData)
+            keyData += self._keyData[offset:offset + self._keyLength[i]]
+        self._keyData = keyData
+
+    def keyMaterial(self, index):
+        '''Key bytes of an entry, as a copy that later changes to the set don't affect'''
+        offset = self._keyOffset[index]
+        return bytes(self._keyData[offset:offset + self._keyLength[index]])
+
+    def algId(self, index):
+        return self._algId[index]
+
+    def item(self, index):
+        '''Build a KeyItem for the entry at index'''
+        keyItem = KeyItem()
+        keyItem._sln = self._sln[index]
+        keyItem._kid = self._kid[index]
+        keyItem.key = self.keyMaterial(index)
+        keyItem.kek = bool(self._flags[index] & KeySet.FLAG_KEK)
+        keyItem.erase = bool(self._flags[index] & KeySet.FLAG_ERASE)
+        return keyItem
+
+    def findBySln(self, sln):
+        '''Return the KeyItem stored at sln, or None'''
+        index = self._bySln.get(sln)
+        return None if index is None else self.item(index)
+
+    def findByKid(self, kid):
+        '''Return a list of KeyItems with the given KID (one per algorithm using it)'''
+        return [self.item(i) for i in self._byKid.get(kid, ())]
+
+    def contentHash(self):
+        '''BLAKE2b digest of the keyset ID and every key in it, whatever order they were added in'''
+        h = hashlib.blake2b(self.keysetId.to_bytes(1, "big"), digest_size=16)
+        for i in sorted(range(0, len(self._sln)), key=self._sln.__getitem__):
+            keyItem = self.item(i)
+            h.update(bytes([self._algId[i]]) + keyItem.sln.to_bytes(2, "big") + keyItem.kid.to_bytes(2, "big"))
+            h.update(_contentHash(keyItem))
+        return h.digest()
+
+def _contentHash(keyItem):
+    h = hashlib.blake2b(keyItem.keyBytes, digest_size=16)
+    h.update(b"\x01" if keyItem.kek else b"\x00")
+    return h.digest()
+
+class KeyDiff():
+    '''Result of KeyIndex.diff: lists of (algId, KeyItem) to send as Modify Key operations
+
+    Removed items are copies of the old keys with erase set.
+    '''
+    def __init__(self):
+        self.added = []
+        self.changed = []
+        self.removed = []
+
+    def __len__(self):
+        return len(self.added) + len(self.changed) + len(self.removed)
+
+    def items(self):
+        '''Every (algId, KeyItem) that has to be sent, erasures first
+
+        An SLN reassigned to a new KID or algorithm shows up as both removed and added, and erasing it
+        after the load would wipe the key just loaded into it.
+        '''
+        return self.removed + self.added + self.changed
+
+class KeyIndex():
+    '''Index of keys by (SLN, KID, algorithm ID) with a content hash per entry
+
+    Built from a container, a KeySet or a radio inventory (KeyInfo records, which carry no key
+    material and so can only show keys as present or missing), and compared with diff().
+    '''
+    def __init__(self):
+        # (sln, kid, algId) -> (content hash or None, KeyItem or None)
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, triple):
+        return triple in self._entries
+
+    def add(self, keyItem, algId):
+        self._entries[(keyItem.sln, keyItem.kid, algId)] = (_contentHash(keyItem), keyItem)
+
+    def addInfo(self, keyInfo):
+        '''Add a key known only by its KeyInfo'''
+        self._entries[(keyInfo.sln, keyInfo.kid, keyInfo.algId)] = (None, None)
+
+    def contentHash(self, sln, kid, algId):
+        return self._entries[(sln, kid, algId)][0]
+
+    @classmethod
+    def fromContainerKeys(cls, containerKeys):
+        '''Index ContainerKey entries, e.g. EKC.keys()'''
+        index = cls()
+        for key in containerKeys:
+            index.add(key.toKeyItem(), key.algId)
+        return index
+
+    @classmethod
+    def fromKeySet(cls, keyset):
+        index = cls()
+        for i in range(0, len(keyset)):
+            index.add(keyset.item(i), keyset.algId(i))
+        return index
+
+    @classmethod
+    def fromInventory(cls, keyInfos):
+        '''Index the KeyInfo records of a radio or keyloader inventory'''
+        index = cls()
+        for keyInfo in keyInfos:
+            index.addInfo(keyInfo)
+        return index
+
+    def diff(self, newer):
+        '''Return the KeyDiff that turns the keys in this index into those in newer
+
+        Keys present on both sides count as changed only when both have key material and the hashes differ.
+        '''
+        result = KeyDiff()
+        for triple, (newHash, newItem) in newer._entries.items():
+            old = self._entries.get(triple)
+            if (old is None):
+                if (newItem is not None):
+                    result.added.append((triple[2], newItem))
+            elif (newHash is not None and old[0] is not None and newHash != old[0]):
+                result.changed.append((triple[2], newItem))
+
+        for triple, (oldHash, oldItem) in self._entries.items():
+            if (triple not in newer._entries):
+                erase = KeyItem()
+                erase._sln = triple[0]
+                erase._kid = triple[1]
+                erase.kek = oldItem.kek if oldItem is not None else False
+                erase.erase = True
+                result.removed.append((triple[2], erase))
+        return result
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#
+# PyKMM - KMM and keyloading for Python
+# GPLv2 Open Source. Use is subject to license terms.
+# DO NOT ALTER OR REMOVE COPYRIGHT NOTICES OR THIS FILE HEADER.
+#
+# @package PyKMM
+#
+###############################################################################
+#   Copyright (C) 2022 Natalie Moore <natalie@natnat.xyz>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+###############################################################################
+
+import collections
+import logging
+
+class PendingReply():
+    '''A request waiting on its reply'''
+    __slots__ = ("key", "reply", "done")
+
+    def __init__(self, key):
+        self.key = key
+        self.reply = None
+        self.done = False
+
+class ReplyMultiplexer():
+    '''Matches reply frames to the requests waiting on them, so several commands can be in flight
+
+    Requests and replies are described by (opcode, sub-opcode, slot) keys, with None for a field that
+    doesn't apply; replyKey maps a reply frame to the key of the request it answers, None for a frame
+    that can only be attributed by order (error replies), or DISCARD for a frame that can't answer
+    anything (empty or truncated frames, line noise). A reply goes to the oldest outstanding request
+    whose key it matches; an order-only reply goes to the oldest outstanding request of any kind. Replies
+    nobody is waiting for (late answers to requests that timed out, unsolicited frames) are discarded.
+    '''
+    DISCARD = object()
+
+    def __init__(self, readFrame, replyKey):
+        self._readFrame = readFrame
+        self._replyKey = replyKey
+        self._outstanding = collections.deque()
+        self.discarded = 0
+
+    def __len__(self):
+        return len(self._outstanding)
+
+    def expect(self, key):
+        '''Register a request (before or just after writing it) and return the PendingReply to wait on'''
+        pending = PendingReply(key)
+        self._outstanding.append(pending)
+        return pending
+
+    @staticmethod
+    def _matches(requestKey, replyKey):
+        for want, got in zip(requestKey, replyKey):
+            if (want is not None and got is not None and want != got):
+                return False
+        return True
+
+    def dispatch(self, resp):
+        '''Hand one reply frame to the request it answers; returns that request, or None if it was discarded'''
+        key = self._replyKey(resp)
+        if (key is ReplyMultiplexer.DISCARD):
+            self.discarded += 1
+            logging.debug("Discarding unattributable reply {}".format(bytes(resp).hex()))
+            return None
+        for pending in self._outstanding:
+            if (key is None or self._matches(pending.key, key)):
+                self._outstanding.remove(pending)
+                pending.reply = resp
+                pending.done = True
+                return pending
+        self.discarded += 1
+        logging.debug("Discarding reply {} that no request is waiting for".format(bytes(resp).hex()))
+        return None
+
+    def wait(self, pending):
+        '''Read and dispatch frames until pending has its reply, then return the reply
+
+        Any failure reading or dispatching a frame (a timeout, a corrupted frame) withdraws pending, so a
+        late reply to it is discarded rather than mistaken for the answer to a later request.
+        '''
+        try:
+            while not pending.done:
+                self.dispatch(self._readFrame())
+        except BaseException:
+            self.cancel(pending)
+            raise
+        return pending.reply
+
+    def cancel(self, pending):
+        if (pending in self._outstanding):
+            self._outstanding.remove(pending)
+
+    def clear(self):
+        self._outstanding.clear()
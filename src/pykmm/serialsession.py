@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+#
+# PyKMM - KMM and keyloading for Python
+# GPLv2 Open Source. Use is subject to license terms.
+# DO NOT ALTER OR REMOVE COPYRIGHT NOTICES OR THIS FILE HEADER.
+#
+# @package PyKMM
+#
+###############################################################################
+#   Copyright (C) 2022 Natalie Moore <natalie@natnat.xyz>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+###############################################################################
+
+import logging
+import select
+import time
+
+import serial
+
+class SerialSession():
+    '''Keeps a keyloader serial port open across a whole job
+
+    Keyloader objects borrow the handle instead of opening and closing the port around every exchange,
+    which avoids the DTR resets and settle delays some adapters have on open. Write and read errors
+    close and reopen the port (up to maxReconnects times in a row) before giving up.
+
+    Can be used as a context manager:
+
+        with SerialSession("/dev/ttyUSB0", baudrate=115200, timeout=2, dsrdtr=True) as session:
+            kfd = KFDAVR("/dev/ttyUSB0", session=session)
+    '''
+    def __init__(self, port, keepaliveInterval=None, maxReconnects=3, **serialArgs):
+        self.portName = port
+        self.keepaliveInterval = keepaliveInterval
+        self.maxReconnects = maxReconnects
+        self._serialArgs = serialArgs
+        self._serialPort = None
+        self._lastActivity = time.monotonic()
+
+        self.opens = 0
+        self.reconnects = 0
+        self.bytesWritten = 0
+        self.bytesRead = 0
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    @property
+    def port(self):
+        '''The underlying serial port handle, opened if needed'''
+        self.open()
+        return self._serialPort
+
+    @property
+    def is_open(self):
+        return (self._serialPort is not None and self._serialPort.is_open)
+
+    @property
+    def in_waiting(self):
+        return self.port.in_waiting
+
+    def open(self):
+        if (self.is_open):
+            #don't open an already open port
+            return
+        if (self._serialPort is None):
+            self._serialPort = serial.serial_for_url(self.portName, do_not_open=True, **self._serialArgs)
+        self._serialPort.open()
+        self.opens += 1
+        self._lastActivity = time.monotonic()
+
+    def close(self):
+        if (self.is_open):
+            self._serialPort.close()
+
+    def reconnect(self):
+        '''Close and reopen the port'''
+        logging.warning("Reconnecting to keyloader on {}".format(self.portName))
+        self.close()
+        self._serialPort = None
+        self.open()
+        self.reconnects += 1
+
+    def write(self, data):
+        attempts = 0
+        while True:
+            try:
+                written = self.port.write(data)
+                break
+            except serial.SerialException:
+                attempts += 1
+                if (attempts > self.maxReconnects):
+                    raise
+                self.reconnect()
+        self.bytesWritten += len(data)
+        self._lastActivity = time.monotonic()
+        return written
+
+    def read(self, size=1):
+        '''Read up to size bytes; a port error reconnects and returns nothing, like a read timeout would'''
+        try:
+            data = self.port.read(size)
+        except serial.SerialException:
+            self.reconnect()
+            return b""
+        self.bytesRead += len(data)
+        if (data):
+            self._lastActivity = time.monotonic()
+        return data
+
+    def fileno(self):
+        '''File descriptor of the open port, or None for ports without one (loop://, socket:// on some platforms, Windows)'''
+        try:
+            return self.port.fileno()
+        except (AttributeError, OSError):
+            return None
+
+    def readAvailable(self, timeout):
+        '''Wait up to timeout seconds for data and return everything that has arrived, or b"" on timeout
+
+        Waits in select() on the port's file descriptor, so the call wakes as soon as the first byte lands
+        instead of once per byte. Ports without a descriptor fall back to a single read bounded by timeout.
+        '''
+        port = self.port
+        fd = self.fileno()
+        if (fd is not None):
+            ready, _, _ = select.select([fd], [], [], max(0, timeout))
+            if (not ready):
+                return b""
+            return self.read(max(1, port.in_waiting))
+
+        waiting = port.in_waiting
+        if (waiting):
+            return self.read(waiting)
+        portTimeout = port.timeout
+        port.timeout = max(0, timeout if portTimeout is None else min(timeout, portTimeout))
+        try:
+            data = self.read(1)
+        finally:
+            port.timeout = portTimeout
+        if (data and self.port.in_waiting):
+            data += self.read(self.port.in_waiting)
+        return data
+
+    def keepalive(self, probe):
+        '''Call probe() (e.g. a keyloader self test) if the port has been idle longer than keepaliveInterval
+
+        Returns True if the probe was run.
+        '''
+        if (self.keepaliveInterval is None):
+            return False
+        if (time.monotonic() - self._lastActivity < self.keepaliveInterval):
+            return False
+        try:
+            probe()
+        except (serial.SerialException, TimeoutError):
+            self.reconnect()
+            probe()
+        self._lastActivity = time.monotonic()
+        return True
+
+    def counters(self):
+        '''Snapshot of the session counters as a dict'''
+        return {
+            "opens": self.opens,
+            "reconnects": self.reconnects,
+            "bytesWritten": self.bytesWritten,
+            "bytesRead": self.bytesRead,
+        }
@@ -1,24 +1,54 @@
+from array import array
+
 def stringToByteList(stringIn):
-    result = []
-    if (len(stringIn) % 2 == 0):
-        for i in range(0, len(stringIn), 2):
-            result.append(int(stringIn[i:i+2], 16))
-    else:
+    if (len(stringIn) % 2 != 0):
+        raise ValueError("Input string is not even length")
+    return list(bytes.fromhex(stringIn))
+
+def hexToBytes(stringIn):
+    '''Convert a hex string (e.g. a key from a CSV) to bytes'''
+    if (len(stringIn) % 2 != 0):
         raise ValueError("Input string is not even length")
-    return result
+    return bytes.fromhex(stringIn)
+
+def bytesToHex(dataIn, sep=""):
+    '''Convert bytes (or a list of ints) to an uppercase hex string, optionally with sep between bytes'''
+    if (not isinstance(dataIn, (bytes, bytearray, memoryview))):
+        dataIn = bytes(dataIn)
+    if (sep):
+        return dataIn.hex(sep).upper()
+    return dataIn.hex().upper()
+
+def hexListToBuffer(hexStrings, keyLength=None):
+    '''Convert many hex keys in one pass
+
+    Returns (buffer, offsets): the keys packed back-to-back in one bytes object, and an array with the
+    start of each key followed by the end of the last one. If keyLength is given every key must be that many bytes.
+    '''
+    hexStrings = list(hexStrings)
+    offsets = array('L', [0])
+    end = 0
+    for h in hexStrings:
+        if (len(h) % 2 != 0):
+            raise ValueError("Input string is not even length")
+        if (keyLength is not None and len(h) != keyLength * 2):
+            raise ValueError("Expected a {} byte key but got {} bytes".format(keyLength, len(h) // 2))
+        end += len(h) // 2
+        offsets.append(end)
+    buffer = bytes.fromhex("".join(hexStrings))
+    if (len(buffer) != end):
+        raise ValueError("Input strings contain whitespace")
+    return buffer, offsets
+
+def bufferToHexList(buffer, offsets):
+    '''Inverse of hexListToBuffer: split a packed buffer back into uppercase hex strings'''
+    hexString = memoryview(buffer).hex().upper()
+    return [hexString[offsets[i] * 2:offsets[i + 1] * 2] for i in range(0, len(offsets) - 1)]
 
 def dataFormat(dataIn):
     if (isinstance(dataIn, int)):
-        if (dataIn > 0xFF):
+        if (dataIn < 0 or dataIn > 0xFF):
             raise ValueError("Input must be >0 <255")
-        else:
-            padding = 2
-        return f"{dataIn:#0{padding}x}"
-    elif (isinstance(dataIn, list)):
-        dataString = ""
-        for b in dataIn:
-            dataString += dataFormat(b)
-            dataString += ", "
-        #cut the last ", " from the list
-        dataString = dataString[-2]
-        return dataString
+        return f"0x{dataIn:02x}"
+    elif (isinstance(dataIn, (list, bytes, bytearray))):
+        return ", ".join(dataFormat(b) for b in dataIn)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# PyKMM - KMM and keyloading for Python
+# GPLv2 Open Source. Use is subject to license terms.
+# DO NOT ALTER OR REMOVE COPYRIGHT NOTICES OR THIS FILE HEADER.
+#
+# @package PyKMM
+#
+###############################################################################
+#   Copyright (C) 2022 Natalie Moore <natalie@natnat.xyz>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+###############################################################################
+
+import asyncio
+import os
+import tty
+import unittest
+
+from pykmm.asyncprotocol import AsyncOPKFD, AsyncSerialTransport
+from pykmm.deviceprotocol import OPKFD, KFDAVR, KFDWriteFailed
+from pykmm.framing import encode_frame
+from pykmm.kmm.items import KeyItem
+
+class TestAsyncOPKFD(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        """Test setup, with a pty standing in for the keyloader's serial port."""
+        self._master, slave = os.openpty()
+        tty.setraw(self._master)
+        self._kfd = AsyncOPKFD(AsyncSerialTransport(os.ttyname(slave)), KFDAVR, timeout=0.5)
+        os.close(slave)
+
+    async def asyncTearDown(self):
+        """Tear down."""
+        self._kfd.close()
+        if (self._master is not None):
+            os.close(self._master)
+
+    def _reply(self, resp):
+        os.write(self._master, encode_frame(resp, KFDAVR.FRAME_FORMAT))
+
+    async def test_self_test(self):
+        """Test a self test exchange"""
+        self._reply([OPKFD.REPLY_SELF_TEST, 0x00])
+        self.assertEqual(await self._kfd.selfTest(), 0x00)
+
+    async def test_read_info(self):
+        """Test reading the firmware version"""
+        self._reply([OPKFD.REPLY_READ, OPKFD.READ_FW_VER, 1, 2, 3])
+        self.assertEqual(await self._kfd._readInfo(OPKFD.READ_FW_VER), "1.2.3")
+        self.assertEqual(os.read(self._master, 64), encode_frame([OPKFD.CMD_READ_REQ, OPKFD.READ_FW_VER], KFDAVR.FRAME_FORMAT))
+
+    async def test_write_key(self):
+        """Test writing a key and a rejected zeroize"""
+        key = KeyItem()
+        key.sln = 0x0001
+        key.kid = 0x0002
+        key.key = [0x61, 0x63, 0x70]
+        self._reply([OPKFD.REPLY_WRITE, KFDAVR.WRITE_KEY])
+        await self._kfd.writeInstalledKey(0, key)
+        self._reply([OPKFD.REPLY_ERROR, OPKFD.ERROR_WRITE_FAILED])
+        with self.assertRaises(KFDWriteFailed):
+            await self._kfd.zeroizeInstalledKeys()
+
+    async def test_timeout(self):
+        """Test that a silent keyloader times out"""
+        with self.assertRaises(TimeoutError):
+            await self._kfd.selfTest()
+
+    async def test_stale_reply_discarded(self):
+        """Test that a reply arriving after its command timed out isn't taken as the next reply"""
+        self._kfd.timeout = 0.05
+        with self.assertRaises(TimeoutError):
+            await self._kfd.selfTest()
+        self._reply([OPKFD.REPLY_SELF_TEST, 0x00])
+        self._reply([OPKFD.REPLY_READ, OPKFD.READ_MODEL, 0x05])
+        self.assertEqual(await self._kfd._readInfo(OPKFD.READ_MODEL), 0x05)
+        self.assertEqual(self._kfd._mux.discarded, 1)
+        self.assertEqual(len(self._kfd._mux), 0)
+
+    async def test_hang_up(self):
+        """Test that a port hanging up fails the read instead of spinning the loop"""
+        read = asyncio.ensure_future(self._kfd.selfTest())
+        await asyncio.sleep(0.01)
+        os.close(self._master)
+        self._master = None
+        with self.assertRaises(ConnectionError):
+            await read
+        self.assertFalse(self._kfd._transport._reading)
+        with self.assertRaises(ConnectionError):
+            await self._kfd.selfTest()
+
+    async def test_many_keyloaders(self):
+        """Test driving several keyloaders concurrently"""
+        others = []
+        for i in range(0, 4):
+            master, slave = os.openpty()
+            tty.setraw(master)
+            others.append((master, AsyncOPKFD(AsyncSerialTransport(os.ttyname(slave)), KFDAVR, timeout=0.5)))
+            os.close(slave)
+            os.write(master, encode_frame([OPKFD.REPLY_SELF_TEST, i], KFDAVR.FRAME_FORMAT))
+
+        results = await asyncio.gather(*(kfd.selfTest() for master, kfd in others))
+        self.assertEqual(results, [0, 1, 2, 3])
+        for master, kfd in others:
+            kfd.close()
+            os.close(master)
+
+if __name__ == '__main__':
+    unittest.main()
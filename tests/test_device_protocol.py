@@ -24,9 +24,13 @@
 #   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 ###############################################################################
 
+import time
 import unittest
 
 from pykmm.kmm.items import *
+from pykmm.deviceprotocol import OPKFD, KFDAVR, KFDWriteFailed
+from pykmm.framing import encode_frame
+from pykmm.serialsession import SerialSession
 
 class TestKeyItem(unittest.TestCase):
     def setUp(self):
@@ -61,5 +65,218 @@ class TestKeyItem(unittest.TestCase):
         with self.assertRaises(ValueError):
             self._keyitem.sln = 0xFFFFFF
 
+class TestKFDAVRFraming(unittest.TestCase):
+    def setUp(self):
+        """Test setup, using a loopback port in place of a real keyloader."""
+        self._session = SerialSession("loop://", timeout=0.1)
+        self._kfd = KFDAVR.__new__(KFDAVR)
+        OPKFD.__init__(self._kfd, "loop://", self._session)
+        self._kfd._rxBuffer = bytearray()
+
+    def tearDown(self):
+        """Tear down."""
+        self._session.close()
+        del self._kfd
+
+    def test_read_frame(self):
+        """Test reading a single frame"""
+        self._session.write(b'\x61\x25\x00\x63')
+        self.assertEqual(list(self._kfd.readFromSerial()), [0x25, 0x00])
+
+    def test_read_keeps_leftover(self):
+        """Test that bytes past the footer are kept for the next frame"""
+        self._session.write(b'\x61\x25\x00\x63\x61\x21\x02\x01\x02\x03\x63')
+        self.assertEqual(list(self._kfd.readFromSerial()), [0x25, 0x00])
+        self.assertEqual(list(self._kfd.readFromSerial()), [0x21, 0x02, 0x01, 0x02, 0x03])
+
+    def test_read_drops_headerless_frame(self):
+        """Test that bytes ending in a footer with no header before them are dropped, not returned as a frame"""
+        self._session.write(b'\x05\x06\x63\x61\x25\x00\x63')
+        self.assertEqual(list(self._kfd.readFromSerial()), [0x25, 0x00])
+
+    def test_read_resync_on_header(self):
+        """Test that a header restarts the frame"""
+        self._session.write(b'\x01\x61\x02\x61\x25\x00\x63')
+        self.assertEqual(list(self._kfd.readFromSerial()), [0x25, 0x00])
+
+    def test_pipelined_info(self):
+        """Test that info replies are matched up by sub-opcode whatever order they arrive in"""
+        # shuffled within each PIPELINE_WINDOW, as only requests already sent can be answered
+        replies = [
+            [OPKFD.REPLY_READ, OPKFD.READ_MODEL, 0x01],
+            [OPKFD.REPLY_READ, OPKFD.READ_ADAPTER_VER, 0x02, 0x00, 0x00],
+            [OPKFD.REPLY_READ, OPKFD.READ_UID, 0x10, 0x20],
+            [OPKFD.REPLY_READ, OPKFD.READ_FW_VER, 0x01, 0x04, 0x00],
+            [OPKFD.REPLY_READ, OPKFD.READ_SN, 0x02, 0x01, 0x02],
+            [OPKFD.REPLY_READ, OPKFD.READ_HW_REV, 0x01, 0x00],
+        ]
+        for r in replies:
+            self._session.write(encode_frame(r, KFDAVR.FRAME_FORMAT))
+
+        self._kfd.refresh()
+        self.assertEqual(self._kfd.AdapterProtocolVersion, "2.0.0")
+        self.assertEqual(self._kfd.FirmwareVersion, "1.4.0")
+        self.assertEqual(self._kfd.UID, "1632")
+        self.assertEqual(self._kfd.ModelNumber, 1)
+        self.assertEqual(self._kfd.HardwareRevision, "1.0")
+        self.assertEqual(self._kfd.SerialNumber, "12")
+
+        # a second adapter object on the same port reuses the cached info without touching the port
+        other = KFDAVR("loop://", session=self._session)
+        self.assertEqual(other.FirmwareVersion, "1.4.0")
+
+        # reconnecting may have swapped the adapter, so the next keyloader queries it again
+        self._session.reconnect()
+        for r in replies:
+            if (r[1] == OPKFD.READ_FW_VER):
+                r = [OPKFD.REPLY_READ, OPKFD.READ_FW_VER, 0x01, 0x05, 0x00]
+            self._session.write(encode_frame(r, KFDAVR.FRAME_FORMAT))
+        swapped = KFDAVR("loop://", session=self._session)
+        self.assertEqual(swapped.FirmwareVersion, "1.5.0")
+
+    def test_borrowed_session(self):
+        """Test that a keyloader keeps a borrowed session open and counts traffic through it"""
+        self._session.open()
+        for sub, data in ((OPKFD.READ_ADAPTER_VER, [2, 0, 0]), (OPKFD.READ_FW_VER, [1, 0, 0]), (OPKFD.READ_UID, [1]),
+                          (OPKFD.READ_MODEL, [1]), (OPKFD.READ_HW_REV, [1, 0]), (OPKFD.READ_SN, [0])):
+            self._session.write(encode_frame([OPKFD.REPLY_READ, sub] + data, KFDAVR.FRAME_FORMAT))
+
+        with KFDAVR("loop://", session=self._session) as kfd:
+            self.assertEqual(kfd.SerialNumber, "NOT SET")
+        self.assertTrue(self._session.is_open)
+
+        counters = self._session.counters()
+        self.assertEqual(counters["opens"], 1)
+        self.assertEqual(counters["reconnects"], 0)
+        self.assertGreater(counters["bytesWritten"], 0)
+        self.assertGreater(counters["bytesRead"], 0)
+
+    def test_installed_key_inventory(self):
+        """Test reading the slot table and its cache"""
+        for slot in range(0, KFDAVR.MAX_INSTALLED_KEYS):
+            if (slot in (0, 3)):
+                resp = [OPKFD.REPLY_READ, KFDAVR.READ_KEY_INFO, slot, 0x00, 0x00, slot + 1, 0x10, slot]
+            else:
+                resp = [OPKFD.REPLY_ERROR, OPKFD.ERROR_READ_FAILED]
+            self._session.write(encode_frame(resp, KFDAVR.FRAME_FORMAT))
+        self._kfd._installedKeys = None
+
+        keys = self._kfd.getInstalledKeyInfo()
+        self.assertEqual([(k.slot, k.sln, k.kid) for k in keys], [(0, 1, 0x1000), (3, 4, 0x1003)])
+
+        # served from the cache, so nothing more is read from the port
+        read = self._session.bytesRead
+        self.assertEqual(len(self._kfd.getInstalledKeyInfo()), 2)
+        self.assertEqual(self._session.bytesRead, read)
+
+        self._session.port.reset_input_buffer()
+        self._kfd._rxBuffer.clear()
+        self._session.write(encode_frame([OPKFD.REPLY_WRITE, KFDAVR.WRITE_KEY], KFDAVR.FRAME_FORMAT))
+        self._kfd.zeroizeInstalledKeys()
+        self.assertEqual(self._kfd.getInstalledKeyInfo(), [])
+
+    def test_write_keyset(self):
+        """Test writing a whole keyset in one burst"""
+        items = []
+        for slot in range(0, KFDAVR.MAX_INSTALLED_KEYS):
+            item = KeyItem()
+            item.sln = slot + 1
+            item.kid = 0x6100 + slot
+            item.key = [0x61, 0x63, 0x70] * 11
+            items.append((slot, item))
+            if (slot == 7):
+                resp = [OPKFD.REPLY_ERROR, OPKFD.ERROR_WRITE_FAILED]
+            else:
+                resp = [OPKFD.REPLY_WRITE, KFDAVR.WRITE_KEY]
+            self._session.write(encode_frame(resp, KFDAVR.FRAME_FORMAT))
+        written = self._session.bytesWritten
+
+        with self.assertRaises(KFDWriteFailed) as cm:
+            self._kfd.writeInstalledKeys(items)
+        self.assertIn("[7]", str(cm.exception))
+
+        expected = sum(len(encode_frame(KFDAVR._writeKeyCommand(slot, item), KFDAVR.FRAME_FORMAT)) for slot, item in items)
+        self.assertEqual(self._session.bytesWritten - written, expected)
+
+        # nothing is sent when the keyset does not validate
+        with self.assertRaises(ValueError):
+            self._kfd.writeInstalledKeys([(0, items[0][1]), (0, items[1][1])])
+        with self.assertRaises(ValueError):
+            self._kfd.writeInstalledKeys([(0, items[0][1]), (KFDAVR.MAX_INSTALLED_KEYS, items[1][1])])
+        self.assertEqual(self._session.bytesWritten - written, expected)
+
+    def test_read_drops_abandoned_frame(self):
+        """Test that a header with no footer yet discards the partial frame before it"""
+        self._session.write(b'\x01\x02\x61\x25\x61\x27')
+        with self.assertRaises(TimeoutError):
+            self._kfd.readFromSerial(timeout=0.05)
+        self.assertEqual(self._kfd._rxBuffer, b'\x61\x27')
+        self._session.write(b'\x00\x63')
+        self.assertEqual(list(self._kfd.readFromSerial()), [0x27, 0x00])
+
+    def test_adaptive_timeout(self):
+        """Test that a command answered quickly several times gets a short reply timeout"""
+        # loop:// would echo the command back, so only note it as sent
+        command = encode_frame([OPKFD.CMD_SELF_TEST], KFDAVR.FRAME_FORMAT)
+        for i in range(0, OPKFD.LATENCY_WARMUP):
+            self._kfd._commandSent(command)
+            self._session.write(encode_frame([OPKFD.REPLY_SELF_TEST, 0x00], KFDAVR.FRAME_FORMAT))
+            self.assertEqual(list(self._kfd.readFromSerial()), [OPKFD.REPLY_SELF_TEST, 0x00])
+        self.assertEqual(self._kfd.replyTimeouts(), {(OPKFD.CMD_SELF_TEST, None): OPKFD.MIN_REPLY_TIMEOUT})
+
+        # nothing comes back this time, so the read gives up after the measured timeout rather than 2 s
+        self._kfd._commandSent(command)
+        start = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            self._kfd.readFromSerial()
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertEqual(len(self._kfd._awaiting), 0)
+
+    def test_inventory_out_of_order(self):
+        """Test that key info replies are matched to their requests by slot"""
+        for pair in range(0, KFDAVR.MAX_INSTALLED_KEYS, 2):
+            for slot in (pair + 1, pair):
+                if (slot < KFDAVR.MAX_INSTALLED_KEYS):
+                    resp = [OPKFD.REPLY_READ, KFDAVR.READ_KEY_INFO, slot, 0x00, 0x00, slot + 1, 0x10, slot]
+                    self._session.write(encode_frame(resp, KFDAVR.FRAME_FORMAT))
+        self._kfd._installedKeys = None
+
+        keys = self._kfd.getInstalledKeyInfo()
+        self.assertEqual([k.slot for k in keys], list(range(0, KFDAVR.MAX_INSTALLED_KEYS)))
+        self.assertEqual([k.sln for k in keys], list(range(1, KFDAVR.MAX_INSTALLED_KEYS + 1)))
+
+    def test_stale_reply_discarded(self):
+        """Test that a reply arriving after its request timed out isn't taken as the next reply"""
+        self._kfd.REPLY_TIMEOUT = 0.05
+        with self.assertRaises(TimeoutError):
+            self._kfd._mux.wait(self._kfd._mux.expect((OPKFD.CMD_SELF_TEST, None, None)))
+        self.assertEqual(len(self._kfd._mux), 0)
+
+        # the late self test reply, then the reply to the read that follows
+        self._session.write(encode_frame([OPKFD.REPLY_SELF_TEST, 0x00], KFDAVR.FRAME_FORMAT))
+        self._session.write(encode_frame([OPKFD.REPLY_READ, OPKFD.READ_MODEL, 0x05], KFDAVR.FRAME_FORMAT))
+        self.assertEqual(self._kfd._readInfo(OPKFD.READ_MODEL), 0x05)
+        self.assertGreaterEqual(self._kfd._mux.discarded, 1)
+
+    def test_corrupt_reply_withdrawn(self):
+        """Test that a corrupted reply withdraws its request and its timing"""
+        self._kfd._commandSent(encode_frame([OPKFD.CMD_SELF_TEST], KFDAVR.FRAME_FORMAT))
+        self._session.write(b'\x61\x22\x70\x00\x63')
+        with self.assertRaises(ValueError):
+            self._kfd._mux.wait(self._kfd._mux.expect((OPKFD.CMD_SELF_TEST, None, None)))
+        self.assertEqual(len(self._kfd._mux), 0)
+        self.assertEqual(len(self._kfd._awaiting), 0)
+
+        self._session.write(encode_frame([OPKFD.REPLY_READ, OPKFD.READ_MODEL, 0x05], KFDAVR.FRAME_FORMAT))
+        self.assertEqual(self._kfd._readInfo(OPKFD.READ_MODEL), 0x05)
+
+    def test_empty_reply_discarded(self):
+        """Test that an empty frame (line noise) is discarded and doesn't strand the request"""
+        self._session.write(b'\x61\x63')
+        self._session.write(encode_frame([OPKFD.REPLY_READ, OPKFD.READ_MODEL, 0x05], KFDAVR.FRAME_FORMAT))
+        self.assertEqual(self._kfd._readInfo(OPKFD.READ_MODEL), 0x05)
+        self.assertEqual(self._kfd._mux.discarded, 1)
+        self.assertEqual(len(self._kfd._mux), 0)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# PyKMM - KMM and keyloading for Python
+# GPLv2 Open Source. Use is subject to license terms.
+# DO NOT ALTER OR REMOVE COPYRIGHT NOTICES OR THIS FILE HEADER.
+#
+# @package PyKMM
+#
+###############################################################################
+#   Copyright (C) 2022 Natalie Moore <natalie@natnat.xyz>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+###############################################################################
+
+import asyncio
+import unittest
+
+from pykmm.deviceprotocol import DLI
+from pykmm.kmm.commands import *
+
+class RadioEmulator(asyncio.DatagramProtocol):
+    '''Answers inventory and zeroize commands like a radio, dropping the first few datagrams if asked'''
+    def __init__(self, drop=0):
+        self.drop = drop
+        self.datagrams = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.datagrams.append(data)
+        if (self.drop > 0):
+            self.drop -= 1
+            return
+        replies = bytearray()
+        for message in iter_kmms(data):
+            if (isinstance(message, ZeroizeCommand)):
+                reply = ZeroizeResponse()
+            else:
+                reply = InventoryResponse(InventoryCommand.LIST_ACTIVE_KSET_IDS)
+                reply.keysetIds = [1]
+            reply.messageNumber = message.messageNumber
+            reply.srcRsi = message.dstRsi
+            replies += reply.to_bytes()
+        self.transport.sendto(bytes(replies), addr)
+
+class TestDLITransport(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        """Test setup, with two emulated radios on localhost."""
+        loop = asyncio.get_running_loop()
+        self._radios = []
+        for drop in (0, 2):
+            transport, radio = await loop.create_datagram_endpoint(lambda: RadioEmulator(drop), local_addr=("127.0.0.1", 0))
+            radio.addr = transport.get_extra_info("sockname")
+            self._radios.append(radio)
+        self._dli = await DLI("127.0.0.1", 0).open(retransmitInterval=0.05, maxRetransmits=3)
+
+    async def asyncTearDown(self):
+        """Tear down."""
+        self._dli.close()
+        for radio in self._radios:
+            radio.transport.close()
+
+    async def test_request(self):
+        """Test a request/reply matched on message number"""
+        radio = self._radios[0]
+        reply = await self._dli.request(InventoryCommand(InventoryCommand.LIST_ACTIVE_KSET_IDS), radio.addr)
+        self.assertIsInstance(reply, InventoryResponse)
+        self.assertEqual(reply.keysetIds, [1])
+        self.assertEqual(self._dli.retransmits, 0)
+
+    async def test_coalesce(self):
+        """Test concurrent requests to one radio share a datagram"""
+        radio = self._radios[0]
+        replies = await asyncio.gather(*(self._dli.request(ZeroizeCommand(), radio.addr) for i in range(0, 20)))
+        self.assertEqual(sorted(reply.messageNumber for reply in replies), list(range(0, 20)))
+        self.assertEqual(len(radio.datagrams), 1)
+        self.assertEqual(self._dli.counters()["outstanding"], 0)
+
+    async def test_retransmit(self):
+        """Test retransmission to a lossy radio alongside a good one"""
+        good, lossy = self._radios
+        replies = await asyncio.gather(self._dli.request(ZeroizeCommand(), good.addr),
+                                       self._dli.request(ZeroizeCommand(), lossy.addr))
+        self.assertTrue(all(isinstance(reply, ZeroizeResponse) for reply in replies))
+        self.assertEqual(self._dli.retransmits, 2)
+        self.assertEqual(len(lossy.datagrams), 3)
+
+    async def test_timeout(self):
+        """Test giving up on a radio that never answers"""
+        self._radios[1].drop = 100
+        with self.assertRaises(TimeoutError):
+            await self._dli.request(ZeroizeCommand(), self._radios[1].addr)
+        self.assertEqual(self._dli.retransmits, 3)
+
+    async def test_unsolicited(self):
+        """Test messages that answer nothing are queued"""
+        message = ZeroizeResponse()
+        self._radios[0].transport.sendto(bytes(message.to_bytes()), self._dli.localAddress)
+        received, addr = await asyncio.wait_for(self._dli.incoming.get(), 1)
+        self.assertIsInstance(received, ZeroizeResponse)
+        self.assertEqual(addr, self._radios[0].addr)
+
+    async def test_bad_datagrams(self):
+        """Test malformed and unsupported datagrams are counted and dropped"""
+        addr = self._radios[0].addr
+        with self.assertLogs(level="WARNING"):
+            # truncated, body cut short, length shorter than the header
+            self._dli._onDatagram(b'\x21\x00\x07\x80', addr)
+            self._dli._onDatagram(b'\x16\x00\x08\x80\xFF\xFF\xFF\x00\x00\x01\x13', addr)
+            self._dli._onDatagram(b'\x21\x00\x00\x80\xFF\xFF\xFF\x00\x00\x01', addr)
+        self.assertEqual(self._dli.errors, 3)
+        self.assertTrue(self._dli.incoming.empty())
+
+if __name__ == '__main__':
+    unittest.main()
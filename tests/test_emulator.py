@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#
+# PyKMM - KMM and keyloading for Python
+# GPLv2 Open Source. Use is subject to license terms.
+# DO NOT ALTER OR REMOVE COPYRIGHT NOTICES OR THIS FILE HEADER.
+#
+# @package PyKMM
+#
+###############################################################################
+#   Copyright (C) 2022 Natalie Moore <natalie@natnat.xyz>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+###############################################################################
+
+import os
+import time
+import unittest
+
+from pykmm.deviceprotocol import OPKFD, KFDAVR, KFDTool, KFDWriteFailed
+from pykmm.emulator import KFDEmulator
+from pykmm.framing import encode_frame
+from pykmm.kmm.items import KeyItem
+
+def makeKey(sln):
+    keyItem = KeyItem()
+    keyItem.sln = sln
+    keyItem.kid = 0x100 + sln
+    keyItem.key = [sln] * 32
+    return keyItem
+
+@unittest.skipUnless(hasattr(os, "openpty"), "emulator needs a pty")
+class TestKFDEmulator(unittest.TestCase):
+    def setUp(self):
+        """Test setup, with a real KFDAVR talking to the emulator."""
+        self._emulator = KFDEmulator(seed=1).start()
+        self._kfd = KFDAVR(self._emulator.port)
+
+    def tearDown(self):
+        """Tear down."""
+        self._kfd.close()
+        self._emulator.stop()
+
+    def test_info(self):
+        """Test the adapter info read at connect"""
+        self.assertEqual(self._kfd.AdapterProtocolVersion, "2.0.0")
+        self.assertEqual(self._kfd.FirmwareVersion, "1.4.0")
+        self.assertEqual(self._kfd.HardwareRevision, "1.0")
+        self.assertEqual(self._kfd.SerialNumber, "123")
+        self.assertEqual(self._kfd.selfTest(), 0x00)
+
+    def test_keys(self):
+        """Test writing, listing and zeroizing key slots"""
+        self.assertEqual(self._kfd.getInstalledKeyInfo(), [])
+        self._kfd.writeInstalledKey(3, makeKey(3))
+        self._kfd.writeInstalledKeys([(slot, makeKey(slot)) for slot in range(5, 10)], window=2)
+        self.assertEqual(self._emulator.slots[3], (3, 0x103, bytes([3]) * 32))
+
+        keys = self._kfd.getInstalledKeyInfo()
+        self.assertEqual([info.slot for info in keys], [3, 5, 6, 7, 8, 9])
+        self.assertEqual([info.kid for info in keys], [0x103, 0x105, 0x106, 0x107, 0x108, 0x109])
+
+        self._kfd.zeroizeInstalledKeys()
+        self.assertEqual(self._emulator.slots, {})
+        self.assertEqual(self._kfd.getInstalledKeyInfo(refresh=True), [])
+
+    def test_escaped_key(self):
+        """Test key material full of framing bytes survives the round trip"""
+        keyItem = makeKey(1)
+        keyItem.key = [KFDAVR.SERIAL_HEADER, KFDAVR.SERIAL_FOOTER, KFDAVR.SERIAL_ESC] * 8
+        self._kfd.writeInstalledKey(0, keyItem)
+        self.assertEqual(self._emulator.slots[0][2], keyItem.keyBytes)
+
+    def test_write_rejected(self):
+        """Test the emulator rejects writes past the last slot"""
+        self._emulator.maxSlots = 4
+        with self.assertRaises(KFDWriteFailed):
+            self._kfd.writeInstalledKeys([(slot, makeKey(slot)) for slot in range(2, 6)])
+        self.assertEqual(sorted(self._emulator.slots), [2, 3])
+
+    def test_send_byte(self):
+        """Test sending a TWI byte waits for its acknowledgement"""
+        self._kfd.sendTwiByte(0xC5)
+        self.assertEqual(self._emulator.twiBytes, b'\xC5')
+        self.assertEqual(self._kfd.selfTest(), 0x00)
+
+    def test_dropped_reply(self):
+        """Test a lost reply costs the measured timeout, not the 2 s default, on a real file descriptor"""
+        self.assertIsNotNone(self._kfd.session.fileno())
+        for i in range(0, OPKFD.LATENCY_WARMUP):
+            self._kfd.selfTest()
+        self._emulator.dropRate = 1.0
+        start = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            self._kfd.selfTest()
+        self.assertLess(time.monotonic() - start, 1.0)
+        self._emulator.dropRate = 0.0
+        self.assertEqual(self._kfd.selfTest(), 0x00)
+
+class TestKFDEmulatorCommands(unittest.TestCase):
+    def setUp(self):
+        """Test setup."""
+        self._emulator = KFDEmulator(seed=1)
+
+    def tearDown(self):
+        """Tear down."""
+        del self._emulator
+
+    def test_unknown(self):
+        """Test error replies"""
+        self.assertEqual(self._emulator.handle([0x7F]), [OPKFD.REPLY_ERROR, OPKFD.ERROR_INVALID_CMD_OPCODE])
+        self.assertEqual(self._emulator.handle([OPKFD.CMD_READ_REQ, 0x40]), [OPKFD.REPLY_ERROR, OPKFD.ERROR_INVALID_READ_OPCODE])
+        self.assertEqual(self._emulator.handle([OPKFD.CMD_WRITE_REQ, KFDAVR.WRITE_KEY, 1]), [OPKFD.REPLY_ERROR, OPKFD.ERROR_INVALID_CMD_LENGTH])
+
+    def test_send_byte(self):
+        """Test TWI bytes are recorded"""
+        self.assertEqual(self._emulator.handle([OPKFD.CMD_SEND_BYTE, 0x00, 0xC5]), [OPKFD.REPLY_SEND_BYTE])
+        self.assertEqual(self._emulator.twiBytes, b'\xC5')
+
+    def test_kfdtool_framing(self):
+        """Test deframing with KFDTool's shared header/footer byte, split across reads"""
+        emulator = KFDEmulator(KFDTool)
+        frames = encode_frame([OPKFD.CMD_SELF_TEST], KFDTool.FRAME_FORMAT) + encode_frame([OPKFD.CMD_READ_REQ, OPKFD.READ_MODEL], KFDTool.FRAME_FORMAT)
+        replies = emulator.feed(frames[:3]) + emulator.feed(frames[3:])
+        self.assertEqual(replies, [[OPKFD.REPLY_SELF_TEST, 0x00], [OPKFD.REPLY_READ, OPKFD.READ_MODEL, 0x01]])
+
+    def test_corrupt(self):
+        """Test byte error injection"""
+        frame = bytes(range(0, 64))
+        self.assertEqual(self._emulator.corrupt(frame), frame)
+        self._emulator.byteErrorRate = 1.0
+        corrupted = self._emulator.corrupt(frame)
+        self.assertTrue(all(a != b for a, b in zip(frame, corrupted)))
+        self.assertEqual(self._emulator.bytesCorrupted, 64)
+
+if __name__ == '__main__':
+    unittest.main()
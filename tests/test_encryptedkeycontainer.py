@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+#
+# PyKMM - KMM and keyloading for Python
+# GPLv2 Open Source. Use is subject to license terms.
+# DO NOT ALTER OR REMOVE COPYRIGHT NOTICES OR THIS FILE HEADER.
+#
+# @package PyKMM
+#
+###############################################################################
+#   Copyright (C) 2022 Natalie Moore <natalie@natnat.xyz>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+###############################################################################
+
+import os
+import tempfile
+import unittest
+
+import pykmm.encryptedkeycontainer as ekc
+from pykmm.encryptedkeycontainer import EKC, EKCWriter, ContainerKey, ContainerGroup, DerivedKeyCache
+
+def makeKey(sln, name):
+    key = ContainerKey()
+    key.name = name
+    key.sln = sln
+    key.kid = 0x1000 + sln
+    key.algId = 0x84
+    key.key = bytes([sln & 0xFF]) * 32
+    return key
+
+@unittest.skipIf(ekc.Cipher is None, "cryptography is not installed")
+class TestEKC(unittest.TestCase):
+    def setUp(self):
+        """Test setup."""
+        self._dir = tempfile.TemporaryDirectory()
+        self._path = os.path.join(self._dir.name, "test.ekc")
+
+    def tearDown(self):
+        """Tear down."""
+        self._dir.cleanup()
+
+    def _write(self, count, compress=True):
+        with EKCWriter(self._path, "hunter2", iterations=1000, compress=compress) as writer:
+            for i in range(1, count + 1):
+                writer.writeKey(makeKey(i, "Key <{}> & co".format(i)))
+            group = ContainerGroup()
+            group.name = "Group 1"
+            group.keys = [1, 2]
+            writer.writeGroup(group)
+
+    def test_round_trip(self):
+        """Test writing a container and streaming it back"""
+        for compress in (True, False):
+            self._write(500, compress)
+            with EKC(self._path, "hunter2") as container:
+                keys = list(container.keys())
+                groups = list(container.groups())
+            self.assertEqual(len(keys), 500)
+            self.assertEqual((keys[9].id, keys[9].name, keys[9].sln, keys[9].kid), (10, "Key <10> & co", 10, 0x100A))
+            self.assertEqual(keys[9].key, bytes([10]) * 32)
+            self.assertEqual([(g.id, g.name, g.keys) for g in groups], [(1, "Group 1", [1, 2])])
+
+            item = keys[9].toKeyItem()
+            self.assertEqual((item.sln, item.kid, item.keyBytes), (10, 0x100A, bytes([10]) * 32))
+
+    def test_wrong_password(self):
+        """Test that a wrong password is reported"""
+        self._write(10)
+        with EKC(self._path, "password") as container:
+            with self.assertRaises(ValueError):
+                list(container.keys())
+
+    def test_keys_before_groups(self):
+        """Test that keys can't follow groups"""
+        with self.assertRaises(ValueError):
+            with EKCWriter(self._path, "hunter2", iterations=1000) as writer:
+                writer.writeGroup(ContainerGroup())
+                writer.writeKey(makeKey(1, "late"))
+
+    def test_unlock_cache(self):
+        """Test that reopening a container reuses the derived key"""
+        self._write(10)
+        cache = DerivedKeyCache(maxEntries=2, ttl=60)
+        for i in range(0, 3):
+            with EKC.unlock(self._path, "hunter2", cache) as container:
+                self.assertEqual(len(list(container.keys())), 10)
+        self.assertEqual((cache.misses, cache.hits), (1, 2))
+
+        # a different password is not served from the cache
+        with EKC.unlock(self._path, "password", cache) as container:
+            with self.assertRaises(ValueError):
+                list(container.keys())
+        self.assertEqual(cache.misses, 2)
+
+class TestDerivedKeyCache(unittest.TestCase):
+    def test_eviction_zeroises(self):
+        """Test that evicted and expired keys are wiped"""
+        cache = DerivedKeyCache(maxEntries=2, ttl=60)
+        cache.derive("pw", b"salt1", 10)
+        first = cache._entries[next(iter(cache._entries))][0]
+        cache.derive("pw", b"salt2", 10)
+        cache.derive("pw", b"salt3", 10)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(first, bytearray(32))
+
+        cache.ttl = 0
+        key = cache.derive("pw", b"salt4", 10)
+        self.assertEqual(len(key), 32)
+        held = [k for k, expires in cache._entries.values()]
+        cache.derive("pw", b"salt5", 10)
+        self.assertTrue(all(k == bytearray(32) for k in held))
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+if __name__ == '__main__':
+    unittest.main()
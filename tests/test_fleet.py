@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+#
+# PyKMM - KMM and keyloading for Python
+# GPLv2 Open Source. Use is subject to license terms.
+# DO NOT ALTER OR REMOVE COPYRIGHT NOTICES OR THIS FILE HEADER.
+#
+# @package PyKMM
+#
+###############################################################################
+#   Copyright (C) 2022 Natalie Moore <natalie@natnat.xyz>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+###############################################################################
+
+import unittest
+from unittest import mock
+
+from serial.tools.list_ports_common import ListPortInfo
+
+from pykmm.deviceprotocol import KFDAVR
+from pykmm.fleet import Fleet, KeyloadJob, discoverPorts
+
+class FakeKeyloader():
+    '''Stand-in keyloader that records which jobs ran on it'''
+    def __init__(self, port, broken=False):
+        self.port = port
+        self.broken = broken
+        self.ran = []
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+class TestFleet(unittest.TestCase):
+    def setUp(self):
+        """Test setup."""
+        self._keyloaders = {}
+
+    def tearDown(self):
+        """Tear down."""
+        pass
+
+    def _connect(self, port, deviceClass):
+        if (port == "unplugged"):
+            raise IOError("no such port")
+        kfd = FakeKeyloader(port, broken=(port == "bad"))
+        self._keyloaders[port] = kfd
+        return kfd
+
+    def test_spreads_jobs(self):
+        """Test that every job runs once across the keyloaders"""
+        def action(kfd):
+            kfd.ran.append(kfd.port)
+            return kfd.port
+
+        fleet = Fleet({"a": KFDAVR, "b": KFDAVR, "c": KFDAVR}, connect=self._connect)
+        jobs = fleet.run([KeyloadJob(i, action) for i in range(0, 30)])
+        self.assertTrue(all(job.done for job in jobs))
+        self.assertEqual(sum(len(k.ran) for k in self._keyloaders.values()), 30)
+        self.assertTrue(all(k.closed for k in self._keyloaders.values()))
+        self.assertEqual(sum(s["jobs"] for s in fleet.report()), 30)
+
+    def test_retry_elsewhere(self):
+        """Test that jobs failing on one keyloader are retried on another"""
+        def action(kfd):
+            if (kfd.broken):
+                raise IOError("adapter unplugged")
+            return kfd.port
+
+        fleet = Fleet({"bad": KFDAVR, "good": KFDAVR}, connect=self._connect)
+        jobs = fleet.run([KeyloadJob(i, action) for i in range(0, 10)])
+        self.assertTrue(all(job.done and job.result == "good" for job in jobs))
+
+    def test_gives_up(self):
+        """Test that a job failing everywhere ends with its error"""
+        def action(kfd):
+            raise IOError("radio not connected")
+
+        fleet = Fleet({"a": KFDAVR, "b": KFDAVR}, connect=self._connect)
+        job, = fleet.run([KeyloadJob("x", action, maxAttempts=2)])
+        self.assertFalse(job.done)
+        self.assertEqual(job.attempts, 2)
+        self.assertIsInstance(job.error, IOError)
+
+    def test_pool_uses_every_port(self):
+        """Test that fewer workers than keyloaders still draw on all of them"""
+        def action(kfd):
+            if (kfd.broken):
+                raise IOError("adapter unplugged")
+            kfd.ran.append(kfd.port)
+            return kfd.port
+
+        fleet = Fleet({"unplugged": KFDAVR, "bad": KFDAVR, "good": KFDAVR}, maxWorkers=1, connect=self._connect)
+        jobs = fleet.run([KeyloadJob(i, action) for i in range(0, 5)])
+        self.assertTrue(all(job.done and job.result == "good" for job in jobs))
+        self.assertNotIn("unplugged", self._keyloaders)
+        self.assertTrue(all(k.closed for k in self._keyloaders.values()))
+        self.assertFalse(any(s["online"] for s in fleet.report()))
+
+    def test_discover_generic(self):
+        """Test that bridge chips are only picked up when asked for"""
+        ports = []
+        for device, vid, pid in (("/dev/ttyACM0", 0x2341, 0x0043), ("/dev/ttyUSB0", 0x1A86, 0x7523), ("/dev/ttyUSB1", 0x0403, 0x6001)):
+            info = ListPortInfo(device, skip_link_detection=True)
+            info.vid = vid
+            info.pid = pid
+            ports.append(info)
+        with mock.patch("pykmm.fleet.list_ports.comports", return_value=ports):
+            self.assertEqual(discoverPorts(), {"/dev/ttyACM0": KFDAVR})
+            self.assertEqual(discoverPorts(includeGeneric=True), {"/dev/ttyACM0": KFDAVR, "/dev/ttyUSB0": KFDAVR})
+            fleet = Fleet(includeGeneric=True, connect=self._connect)
+            self.assertEqual(sorted(fleet.ports), ["/dev/ttyACM0", "/dev/ttyUSB0"])
+
+if __name__ == '__main__':
+    unittest.main()
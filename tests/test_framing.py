@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#
+# PyKMM - KMM and keyloading for Python
+# GPLv2 Open Source. Use is subject to license terms.
+# DO NOT ALTER OR REMOVE COPYRIGHT NOTICES OR THIS FILE HEADER.
+#
+# @package PyKMM
+#
+###############################################################################
+#   Copyright (C) 2022 Natalie Moore <natalie@natnat.xyz>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+###############################################################################
+
+import unittest
+
+from pykmm.framing import FrameFormat, FrameTemplate, encode_frame, decode_frame
+from pykmm.deviceprotocol import OPKFD, KFDAVR, KFDTool
+from pykmm.kmm.items import KeyItem
+
+class TestFraming(unittest.TestCase):
+    def setUp(self):
+        """Test setup."""
+        self._avr = KFDAVR.FRAME_FORMAT
+        self._tool = KFDTool.FRAME_FORMAT
+
+    def tearDown(self):
+        """Tear down."""
+        pass
+
+    def test_encode_plain(self):
+        """Test a payload without any special bytes"""
+        self.assertEqual(encode_frame([0x11, 0x02], self._avr), b'\x61\x11\x02\x63')
+
+    def test_encode_escapes(self):
+        """Test escaping header, footer and escape bytes"""
+        self.assertEqual(encode_frame([0x61, 0x63, 0x70], self._avr), b'\x61\x70\x62\x70\x64\x70\x71\x63')
+        self.assertEqual(encode_frame([0x61, 0x63], self._tool), b'\x61\x63\x62\x63\x64\x61')
+
+    def test_round_trip(self):
+        """Test every byte value survives encode and decode"""
+        payload = bytes(range(256)) * 4
+        for fmt in (self._avr, self._tool):
+            frame = encode_frame(payload, fmt)
+            self.assertEqual(decode_frame(frame, fmt), payload)
+            self.assertEqual(decode_frame(memoryview(frame), fmt), payload)
+
+    def test_decode_invalid(self):
+        """Test invalid escapes and missing header/footer"""
+        with self.assertRaises(ValueError):
+            decode_frame(b'\x61\x70\x00\x63', self._avr)
+
+        with self.assertRaises(ValueError):
+            decode_frame(b'\x61\x11\x70\x63', self._avr)
+
+        with self.assertRaises(ValueError):
+            decode_frame(b'\x11\x02\x63', self._avr)
+
+    def test_invalid_format(self):
+        """Test placeholders that collide with framing bytes"""
+        with self.assertRaises(ValueError):
+            FrameFormat(0x61, 0x63, 0x70, 0x63, 0x64, 0x71)
+
+    def test_template(self):
+        """Test templated frames match fully encoded ones, whatever the patched bytes are"""
+        for fmt in (self._avr, self._tool):
+            template = FrameTemplate(fmt, [0x12, 0x61], [0x70])
+            for value in range(0, 256):
+                self.assertEqual(template.build(value, bytes([value, 0x63])), encode_frame([0x12, 0x61, value, value, 0x63, 0x70], fmt))
+            self.assertEqual(fmt.escapeTable[0x61], fmt.escapeBytes(b'\x61'))
+
+    def test_constant_frames(self):
+        """Test each keyloader class frames its constant commands with its own format at definition"""
+        for cls in (KFDAVR, KFDTool):
+            selfTest = cls._frameCache[(OPKFD.CMD_SELF_TEST,)]
+            self.assertEqual(selfTest, encode_frame([OPKFD.CMD_SELF_TEST], cls.FRAME_FORMAT))
+            for command, frame in cls._frameCache.items():
+                self.assertEqual(frame, encode_frame(command, cls.FRAME_FORMAT))
+            # anything else is framed on demand
+            self.assertEqual(cls._encodeCommand([0x12, 0x61]), encode_frame([0x12, 0x61], cls.FRAME_FORMAT))
+        self.assertIn(tuple(KFDAVR.ZEROIZE_COMMAND), KFDAVR._frameCache)
+        self.assertIn((OPKFD.CMD_READ_REQ, KFDAVR.READ_KEY_INFO, KFDAVR.MAX_INSTALLED_KEYS - 1), KFDAVR._frameCache)
+        self.assertNotIn(tuple(KFDAVR.ZEROIZE_COMMAND), KFDTool._frameCache)
+
+    def test_write_key_frame(self):
+        """Test the templated key write frame against the framed command"""
+        item = KeyItem()
+        item.sln = 0x6163
+        item.kid = 0x7061
+        item.key = [0x61, 0x63, 0x70, 0x71] * 8
+        for slot in range(0, KFDAVR.MAX_INSTALLED_KEYS):
+            self.assertEqual(KFDAVR._writeKeyFrame(slot, item), encode_frame(KFDAVR._writeKeyCommand(slot, item), self._avr))
+        with self.assertRaises(ValueError):
+            KFDAVR._writeKeyFrame(KFDAVR.MAX_INSTALLED_KEYS, item)
+        with self.assertRaises(TypeError):
+            KFDAVR._writeKeyFrame(0, [1, 2, 3])
+
+if __name__ == '__main__':
+    unittest.main()
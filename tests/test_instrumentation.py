@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#
+# PyKMM - KMM and keyloading for Python
+# GPLv2 Open Source. Use is subject to license terms.
+# DO NOT ALTER OR REMOVE COPYRIGHT NOTICES OR THIS FILE HEADER.
+#
+# @package PyKMM
+#
+###############################################################################
+#   Copyright (C) 2022 Natalie Moore <natalie@natnat.xyz>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+###############################################################################
+
+import os
+import unittest
+
+from pykmm.deviceprotocol import OPKFD, KFDAVR
+from pykmm.emulator import KFDEmulator
+from pykmm.instrumentation import *
+from pykmm.kmm.items import KeyItem
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        """Test setup."""
+        self._instr = Instrumentation()
+
+    def tearDown(self):
+        """Tear down."""
+        del self._instr
+
+    def test_latency(self):
+        """Test latencies are kept per command opcode and unmatched replies counted"""
+        self._instr.commandSent(OPKFD.CMD_READ_REQ, 2, 2)
+        self._instr.commandSent(OPKFD.CMD_SELF_TEST, 1, 1)
+        self._instr.firstByte(OPKFD.CMD_READ_REQ, 0.003)
+        self._instr.frameReceived(OPKFD.REPLY_READ, 5, 6, OPKFD.CMD_READ_REQ, 0.004)
+        self._instr.frameReceived(OPKFD.REPLY_SELF_TEST, 2, 2, OPKFD.CMD_SELF_TEST, 0.2)
+        self._instr.frameReceived(OPKFD.REPLY_SELF_TEST, 2, 2)
+
+        snapshot = self._instr.snapshot()
+        self.assertEqual(snapshot["commands"], {"0x11": 1, "0x15": 1})
+        self.assertEqual(snapshot["replies"], {"0x21": 1, "0x25": 2})
+        self.assertEqual(snapshot["bytesReceived"], 9)
+        self.assertEqual(snapshot["bytesReceivedEscaped"], 10)
+        self.assertEqual(snapshot["unmatchedReplies"], 1)
+        self.assertEqual(list(snapshot["firstByteLatency"]), ["0x11"])
+        self.assertEqual(snapshot["firstByteLatency"]["0x11"]["buckets"]["0.005"], 1)
+        self.assertEqual(snapshot["frameLatency"]["0x11"]["buckets"]["0.005"], 1)
+        self.assertEqual(snapshot["frameLatency"]["0x15"]["buckets"]["0.25"], 1)
+        self.assertAlmostEqual(snapshot["frameLatency"]["0x15"]["sum"], 0.2)
+
+    def test_prometheus(self):
+        """Test the Prometheus text export"""
+        self._instr.commandSent(OPKFD.CMD_SELF_TEST, 1, 1)
+        self._instr.frameReceived(OPKFD.REPLY_SELF_TEST, 2, 2, OPKFD.CMD_SELF_TEST, 0.01)
+        self._instr.timeout()
+        text = self._instr.prometheus(labels={"port": "ttyUSB0"})
+        self.assertIn('pykmm_kfd_commands_total{port="ttyUSB0",opcode="0x15"} 1', text)
+        self.assertIn('pykmm_kfd_frame_seconds_bucket{port="ttyUSB0",opcode="0x15",le="0.01"} 1', text)
+        self.assertIn('pykmm_kfd_frame_seconds_bucket{port="ttyUSB0",opcode="0x15",le="+Inf"} 1', text)
+        self.assertIn('pykmm_kfd_frame_seconds_count{port="ttyUSB0",opcode="0x15"} 1', text)
+        self.assertIn('pykmm_kfd_timeouts_total{port="ttyUSB0"} 1', text)
+        self.assertIn("# TYPE pykmm_kfd_first_byte_seconds histogram", text)
+
+    def test_empty_frame(self):
+        """Test an empty frame is counted on its own and doesn't break the exports"""
+        self._instr.frameReceived(None, 0, 0)
+        self.assertEqual(self._instr.emptyReplies, 1)
+        self.assertEqual(self._instr.snapshot()["replies"], {})
+        self.assertIn("pykmm_kfd_empty_replies_total 1", self._instr.prometheus())
+
+@unittest.skipUnless(hasattr(os, "openpty"), "emulator needs a pty")
+class TestKFDAVRInstrumentation(unittest.TestCase):
+    def setUp(self):
+        """Test setup, with a KFDAVR talking to the emulator."""
+        self._emulator = KFDEmulator().start()
+        self._kfd = KFDAVR(self._emulator.port)
+
+    def tearDown(self):
+        """Tear down."""
+        self._kfd.close()
+        self._emulator.stop()
+
+    def test_disabled(self):
+        """Test nothing is collected until enabled"""
+        self.assertIsNone(self._kfd.instrumentation)
+        self._kfd.selfTest()
+        instr = self._kfd.enableInstrumentation()
+        self.assertEqual(instr.commands, {})
+        self._kfd.disableInstrumentation()
+        self._kfd.selfTest()
+        self.assertEqual(instr.commands, {})
+
+    def test_traffic(self):
+        """Test counts across single, pipelined and streamed writes"""
+        instr = self._kfd.enableInstrumentation()
+        keyItem = KeyItem()
+        keyItem.sln = 1
+        keyItem.kid = 1
+        keyItem.key = [KFDAVR.SERIAL_ESC] * 32
+        self._kfd.writeInstalledKeys([(0, keyItem), (1, keyItem)])
+        self._kfd.getInstalledKeyInfo()
+        self._kfd.refresh()
+
+        snapshot = instr.snapshot()
+        self.assertEqual(snapshot["commands"], {"0x11": KFDAVR.MAX_INSTALLED_KEYS + len(OPKFD.INFO_READS), "0x12": 2})
+        self.assertEqual(snapshot["replies"]["0x22"], 2)
+        self.assertEqual(sum(snapshot["replies"].values()), sum(snapshot["commands"].values()))
+        # every key byte was an escape, so each one doubled on the wire
+        self.assertEqual(snapshot["bytesSentEscaped"] - snapshot["bytesSent"], 64)
+        self.assertEqual(len(self._kfd._awaiting), 0)
+        self.assertEqual(snapshot["frameLatency"]["0x11"]["count"], snapshot["commands"]["0x11"])
+        self.assertEqual(snapshot["frameLatency"]["0x12"]["count"], 2)
+        self.assertGreater(sum(h["count"] for h in snapshot["firstByteLatency"].values()), 0)
+
+if __name__ == '__main__':
+    unittest.main()
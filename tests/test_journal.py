@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+#
+# PyKMM - KMM and keyloading for Python
+# GPLv2 Open Source. Use is subject to license terms.
+# DO NOT ALTER OR REMOVE COPYRIGHT NOTICES OR THIS FILE HEADER.
+#
+# @package PyKMM
+#
+###############################################################################
+#   Copyright (C) 2022 Natalie Moore <natalie@natnat.xyz>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+###############################################################################
+
+import asyncio
+import os
+import tempfile
+import unittest
+
+from pykmm.journal import *
+
+CAMPAIGN = bytes(range(0, 16))
+
+class TestRekeyJournal(unittest.TestCase):
+    def setUp(self):
+        """Test setup."""
+        self._dir = tempfile.TemporaryDirectory()
+        self._path = os.path.join(self._dir.name, "rekey.journal")
+
+    def tearDown(self):
+        """Tear down."""
+        self._dir.cleanup()
+
+    def _fill(self, journal):
+        journal.record(RekeyJournal.SENT, 100, 1, CAMPAIGN, 0x84)
+        journal.record(RekeyJournal.ACKED, 100, 1, CAMPAIGN, 0x84)
+        journal.record(RekeyJournal.ACKED, 100, 1, CAMPAIGN, 0xAA)
+        journal.record(RekeyJournal.DONE, 100, 1, CAMPAIGN)
+        journal.record(RekeyJournal.SENT, 101, 1, CAMPAIGN, 0x84)
+        journal.record(RekeyJournal.FAILED, 102, 1, CAMPAIGN, status=3)
+        journal.record(RekeyJournal.DONE, 100, 2, CAMPAIGN)
+
+    def test_replay(self):
+        """Test state survives a reopen"""
+        with RekeyJournal(self._path) as journal:
+            self._fill(journal)
+        self.assertEqual(os.path.getsize(self._path), len(JOURNAL_MAGIC) + 7 * RECORD_LENGTH)
+
+        with RekeyJournal(self._path) as journal:
+            state = journal.state(1, CAMPAIGN)
+            self.assertEqual(state.records, 6)
+            self.assertEqual(state.done, {100})
+            self.assertEqual(state.failed, {102: 3})
+            self.assertTrue(state.stepDone(100, 0xAA))
+            self.assertFalse(state.stepDone(101, 0x84))
+            self.assertEqual(journal.state(2, CAMPAIGN).done, {100})
+
+            # a later DONE clears an earlier failure
+            journal.record(RekeyJournal.DONE, 102, 1, CAMPAIGN)
+        with RekeyJournal(self._path) as journal:
+            self.assertEqual(journal.state(1, CAMPAIGN).failed, {})
+            self.assertEqual(journal.state(1, CAMPAIGN).done, {100, 102})
+
+    def test_torn_tail(self):
+        """Test a partial last record is cut off and appending carries on"""
+        with RekeyJournal(self._path) as journal:
+            self._fill(journal)
+        with open(self._path, "ab") as f:
+            f.write(b"\x03\x00\x00")
+
+        with RekeyJournal(self._path) as journal:
+            self.assertEqual(journal.state(1, CAMPAIGN).records, 6)
+            journal.record(RekeyJournal.DONE, 101, 1, CAMPAIGN)
+        with RekeyJournal(self._path) as journal:
+            self.assertEqual(journal.state(1, CAMPAIGN).done, {100, 101})
+
+    def test_corrupt_record(self):
+        """Test replay stops at the first record with a bad CRC"""
+        with RekeyJournal(self._path) as journal:
+            self._fill(journal)
+        with open(self._path, "r+b") as f:
+            f.seek(len(JOURNAL_MAGIC) + 3 * RECORD_LENGTH + 1)
+            f.write(b"\xFF")
+
+        with RekeyJournal(self._path) as journal:
+            self.assertEqual(journal.state(1, CAMPAIGN).records, 3)
+            self.assertEqual(journal.state(1, CAMPAIGN).done, set())
+        self.assertEqual(os.path.getsize(self._path), len(JOURNAL_MAGIC) + 3 * RECORD_LENGTH)
+
+    def test_batched_sync(self):
+        """Test records are fsynced in batches"""
+        journal = RekeyJournal(self._path, syncEvery=4, syncInterval=60)
+        syncs = journal.syncs
+        for i in range(0, 10):
+            journal.record(RekeyJournal.DONE, i, 1, CAMPAIGN)
+        self.assertEqual(journal.syncs - syncs, 2)
+        self.assertEqual(os.path.getsize(self._path), len(JOURNAL_MAGIC) + 8 * RECORD_LENGTH)
+        journal.close()
+        self.assertEqual(os.path.getsize(self._path), len(JOURNAL_MAGIC) + 10 * RECORD_LENGTH)
+
+    def test_not_a_journal(self):
+        """Test refusing to append to some other file"""
+        with open(self._path, "wb") as f:
+            f.write(b"<xml/>")
+        with self.assertRaises(ValueError):
+            RekeyJournal(self._path)
+
+    def test_campaign_key(self):
+        """Test progress for one set of keys isn't applied to another with the same keyset ID"""
+        with RekeyJournal(self._path) as journal:
+            self._fill(journal)
+        with RekeyJournal(self._path) as journal:
+            self.assertEqual(journal.state(1, bytes(16)).done, set())
+            self.assertEqual(journal.state(1, CAMPAIGN).done, {100})
+            with self.assertRaises(ValueError):
+                journal.record(RekeyJournal.DONE, 100, 1, b"short")
+
+class TestRekeyJournalTimer(unittest.IsolatedAsyncioTestCase):
+    async def test_timed_sync(self):
+        """Test the last batch is synced on a timer when no further record arrives"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "rekey.journal")
+            journal = RekeyJournal(path, syncEvery=64, syncInterval=0.05)
+            journal.record(RekeyJournal.DONE, 100, 1, CAMPAIGN)
+            journal.record(RekeyJournal.DONE, 101, 1, CAMPAIGN)
+            self.assertEqual(os.path.getsize(path), len(JOURNAL_MAGIC))
+            await asyncio.sleep(0.1)
+            self.assertEqual(os.path.getsize(path), len(JOURNAL_MAGIC) + 2 * RECORD_LENGTH)
+            journal.close()
+
+if __name__ == '__main__':
+    unittest.main()
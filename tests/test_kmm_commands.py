@@ -27,6 +27,7 @@
 import unittest
 
 from pykmm.kmm.items import *
+from pykmm.kmm.commands import *
 
 class TestKeyItem(unittest.TestCase):
     def setUp(self):
@@ -61,5 +62,248 @@ class TestKeyItem(unittest.TestCase):
         with self.assertRaises(ValueError):
             self._keyitem.sln = 0xFFFFFF
 
+class TestKmmCodec(unittest.TestCase):
+    def setUp(self):
+        """Test setup."""
+        self._encoder = KmmEncoder(size=16)
+
+    def tearDown(self):
+        """Tear down."""
+        del self._encoder
+
+    def _roundtrip(self, message):
+        encoded = bytes(self._encoder.encode(message))
+        self.assertEqual(encoded, bytes(message.to_bytes()))
+        decoded, end = parse_kmm(encoded)
+        self.assertEqual(end, len(encoded))
+        self.assertIs(type(decoded), type(message))
+        return encoded, decoded
+
+    def test_zeroize_frame(self):
+        """Test the frame header of a body-less message"""
+        message = ZeroizeCommand()
+        message.dstRsi = 0xFFFFFF
+        message.srcRsi = 0x000001
+        encoded, decoded = self._roundtrip(message)
+        self.assertEqual(encoded, b'\x21\x00\x07\x80\xFF\xFF\xFF\x00\x00\x01')
+        self.assertEqual(decoded.dstRsi, 0xFFFFFF)
+        self.assertEqual(decoded.srcRsi, 0x000001)
+        self.assertEqual(decoded.responseKind, KmmMessage.RESPONSE_IMMEDIATE)
+        self.assertIsNone(decoded.messageNumber)
+
+    def test_message_number(self):
+        """Test the optional message number"""
+        message = NegativeAcknowledgment()
+        message.messageNumber = 0x1234
+        message.acknowledgedMessageId = ModifyKeyCommand.MESSAGE_ID
+        message.acknowledgedMessageNumber = 0x1234
+        message.status = 0x05
+        encoded, decoded = self._roundtrip(message)
+        self.assertEqual(encoded[3], 0x80 | KmmMessage.FORMAT_MESSAGE_NUMBER)
+        self.assertEqual(decoded.messageNumber, 0x1234)
+        self.assertEqual(decoded.acknowledgedMessageId, 0x13)
+        self.assertEqual(decoded.acknowledgedMessageNumber, 0x1234)
+        self.assertEqual(decoded.status, 0x05)
+
+    def test_modify_key(self):
+        """Test a Modify Key command with several keys"""
+        message = ModifyKeyCommand()
+        message.keysetId = 1
+        message.algId = 0x84
+        for i in range(1, 4):
+            keyItem = KeyItem()
+            keyItem.sln = i
+            keyItem.kid = 0x100 + i
+            keyItem.key = bytes([i]) * 32
+            message.keys.append(keyItem)
+        encoded, decoded = self._roundtrip(message)
+        self.assertEqual(decoded.kekAlgId, ModifyKeyCommand.ALGID_CLEAR)
+        self.assertEqual(decoded.algId, 0x84)
+        self.assertEqual([k.sln for k in decoded.keys], [1, 2, 3])
+        self.assertEqual([k.kid for k in decoded.keys], [0x101, 0x102, 0x103])
+        self.assertEqual(decoded.keys[2].keyBytes, b'\x03' * 32)
+
+        # keys of different lengths can't share a message
+        shortKey = KeyItem()
+        shortKey.sln = 9
+        shortKey.key = [1, 2]
+        message.keys.append(shortKey)
+        with self.assertRaises(ValueError):
+            message.to_bytes()
+
+    def test_inventory(self):
+        """Test inventory command and both response types"""
+        command = InventoryCommand()
+        encoded, decoded = self._roundtrip(command)
+        self.assertEqual(decoded.inventoryType, InventoryCommand.LIST_ACTIVE_KEYS)
+        self.assertEqual(decoded.maxKeysRequested, 0xFFFF)
+
+        response = InventoryResponse(InventoryCommand.LIST_ACTIVE_KSET_IDS)
+        response.keysetIds = [1, 2]
+        encoded, decoded = self._roundtrip(response)
+        self.assertEqual(decoded.keysetIds, [1, 2])
+
+        response = InventoryResponse()
+        keyInfo = KeyInfo()
+        keyInfo.keysetId = 1
+        keyInfo.sln = 0x20
+        keyInfo.algId = 0xAA
+        keyInfo.kid = 0x4567
+        response.keys.append(keyInfo)
+        encoded, decoded = self._roundtrip(response)
+        self.assertEqual(len(decoded.keys), 1)
+        self.assertEqual((decoded.keys[0].sln, decoded.keys[0].algId, decoded.keys[0].kid), (0x20, 0xAA, 0x4567))
+
+    def test_inventory_other_types(self):
+        """Test inventory types without a codec here are carried through undecoded"""
+        response = InventoryResponse(0xF9)
+        response.rawBody = b'\x00\x01\x02\x03\x04'
+        encoded, decoded = self._roundtrip(response)
+        self.assertEqual((decoded.inventoryType, decoded.rawBody), (0xF9, b'\x00\x01\x02\x03\x04'))
+        self.assertEqual([m.inventoryType for m in iter_kmms(encoded + encoded)], [0xF9, 0xF9])
+
+        command = InventoryCommand(0xF8)
+        command.rawBody = b'\x00\x00\x00\xFF\xFF'
+        encoded, decoded = self._roundtrip(command)
+        self.assertEqual((decoded.inventoryType, decoded.rawBody), (0xF8, b'\x00\x00\x00\xFF\xFF'))
+
+    def test_rekey_ack(self):
+        """Test per-key statuses in a Rekey Acknowledgment"""
+        message = RekeyAcknowledgment()
+        message.statuses = [KeyStatus(0x84, 0x101, 0), KeyStatus(0x84, 0x102, 1)]
+        encoded, decoded = self._roundtrip(message)
+        self.assertEqual(decoded.acknowledgedMessageId, RekeyCommand.MESSAGE_ID)
+        self.assertEqual([(s.algId, s.kid, s.status) for s in decoded.statuses], [(0x84, 0x101, 0), (0x84, 0x102, 1)])
+
+    def test_change_rsi(self):
+        """Test the Change RSI pair"""
+        command = ChangeRsiCommand()
+        command.rsiOld = 0x000001
+        command.rsiNew = 0x98967F
+        encoded, decoded = self._roundtrip(command)
+        self.assertEqual((decoded.rsiOld, decoded.rsiNew), (0x000001, 0x98967F))
+
+        response = ChangeRsiResponse()
+        response.rsiNew = 0x98967F
+        response.status = 0x02
+        encoded, decoded = self._roundtrip(response)
+        self.assertEqual((decoded.rsiNew, decoded.status), (0x98967F, 0x02))
+
+    def test_malformed(self):
+        """Test bad lengths and truncated bodies are rejected with ValueError"""
+        # length shorter than the header
+        with self.assertRaises(ValueError):
+            parse_kmm(b'\x21\x00\x01\x80\xFF\xFF\xFF\x00\x00\x01')
+        # a Negative Acknowledgment whose body stops short, followed by another frame it mustn't read into
+        nak = b'\x16\x00\x08\x80\xFF\xFF\xFF\x00\x00\x01\x13'
+        with self.assertRaises(ValueError):
+            parse_kmm(nak + bytes(ZeroizeCommand().to_bytes()))
+        # a body-less message with a body
+        with self.assertRaises(ValueError):
+            parse_kmm(b'\x21\x00\x08\x80\xFF\xFF\xFF\x00\x00\x01\x00')
+
+    def test_opaque_mac_and_encrypted_keys(self):
+        """Test a MAC trailer and encrypted key material are carried through undecoded"""
+        message = ModifyKeyCommand()
+        message.decryptionFormat = 0x40
+        message.kekAlgId = 0x84
+        message.kekKid = 0x0010
+        message.encryptedBody = bytes(range(0, 20))
+        encoded, decoded = self._roundtrip(message)
+        self.assertEqual((decoded.decryptionFormat, decoded.kekAlgId, decoded.kekKid), (0x40, 0x84, 0x0010))
+        self.assertEqual(decoded.encryptedBody, bytes(range(0, 20)))
+        self.assertEqual(decoded.keys, [])
+
+        message = NegativeAcknowledgment()
+        message.status = 0x05
+        message.mac = b'\xAA' * 8 + b'\x08\x84\x00\x10'
+        encoded, decoded = self._roundtrip(message)
+        self.assertTrue(encoded[3] & KmmMessage.FORMAT_MAC)
+        self.assertEqual(decoded.status, 0x05)
+        self.assertEqual(decoded.mac, message.mac)
+
+    def test_stream(self):
+        """Test back-to-back frames and unknown message IDs"""
+        unknown = UnknownMessage(0x7E)
+        unknown.body = b'\x01\x02\x03'
+        stream = self._encoder.encode_many([ZeroizeCommand(), unknown, ZeroizeResponse()])
+        messages = list(iter_kmms(bytes(stream)))
+        self.assertEqual([type(m) for m in messages], [ZeroizeCommand, UnknownMessage, ZeroizeResponse])
+        self.assertEqual(messages[1].MESSAGE_ID, 0x7E)
+        self.assertEqual(messages[1].body, b'\x01\x02\x03')
+
+        # truncated frame
+        with self.assertRaises(ValueError):
+            list(iter_kmms(bytes(stream)[:15]))
+
+class TestKmmStreamParser(unittest.TestCase):
+    def setUp(self):
+        """Test setup."""
+        self._parser = KmmStreamParser()
+        nak = NegativeAcknowledgment()
+        nak.messageNumber = 7
+        nak.status = 3
+        self._messages = [ZeroizeCommand(), nak, InventoryCommand(), ZeroizeResponse()]
+        self._stream = bytes(KmmEncoder().encode_many(self._messages))
+
+    def tearDown(self):
+        """Tear down."""
+        del self._parser
+
+    def test_whole_chunk(self):
+        """Test frames in one chunk are views into it"""
+        messages = self._parser.feed(self._stream)
+        self.assertEqual([m.messageId for m in messages], [m.MESSAGE_ID for m in self._messages])
+        self.assertIs(messages[0].raw.obj, self._stream)
+        self.assertEqual(self._parser.buffered, 0)
+
+        # header fields come straight from the view, body fields decode on demand
+        self.assertEqual(messages[1].messageNumber, 7)
+        self.assertEqual(bytes(messages[1].body), b'\x00\x00\x00\x03')
+        self.assertEqual(messages[1].status, 3)
+        self.assertIsInstance(messages[1].decode(), NegativeAcknowledgment)
+        self.assertEqual(messages[2].inventoryType, InventoryCommand.LIST_ACTIVE_KEYS)
+
+    def test_byte_at_a_time(self):
+        """Test frames split across every possible chunk boundary"""
+        messages = []
+        for i in range(0, len(self._stream)):
+            messages += self._parser.feed(self._stream[i:i + 1])
+        self.assertEqual(b"".join(bytes(m) for m in messages), self._stream)
+        self.assertEqual(self._parser.buffered, 0)
+
+        chunks = [self._stream[i:i + 7] for i in range(0, len(self._stream), 7)]
+        self.assertEqual(len(list(iter_kmm_stream(chunks))), len(self._messages))
+
+        with self.assertRaises(ValueError):
+            list(iter_kmm_stream([self._stream[:-1]]))
+
+    def test_copy(self):
+        """Test copies survive reuse of the source buffer"""
+        buffer = bytearray(self._stream)
+        message = self._parser.feed(buffer)[0]
+        kept = message.copy()
+        buffer[0] = 0x7E
+        self.assertEqual(message.messageId, 0x7E)
+        self.assertEqual(kept.messageId, ZeroizeCommand.MESSAGE_ID)
+
+    def test_invalid_length(self):
+        """Test a nonsense length field"""
+        with self.assertRaises(ValueError):
+            self._parser.feed(b'\x21\x00\x01\x80')
+        self.assertEqual(self._parser.buffered, 0)
+
+    def test_invalid_length_after_frame(self):
+        """Test a good frame ahead of a bad length is still handed out"""
+        zeroize = bytes(ZeroizeCommand().to_bytes())
+        messages = self._parser.feed(zeroize + b'\x21\x00\x01\x80')
+        self.assertEqual([m.MESSAGE_ID for m in messages], [ZeroizeCommand.MESSAGE_ID])
+        with self.assertRaises(ValueError):
+            self._parser.feed(b"")
+        self.assertEqual(len(self._parser.feed(zeroize)), 1)
+
+        with self.assertRaises(ValueError):
+            list(iter_kmm_stream([zeroize + b'\x21\x00\x01\x80']))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
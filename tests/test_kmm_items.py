@@ -123,8 +123,59 @@ class TestKeyItem(unittest.TestCase):
         self._keyitem.kek = False
 
         resultBytes = self._keyitem.to_bytes()
-        testBytes = b'\x00\x00'
+        testBytes = b'\x00\x12\x34\x56\x78\x71\xD4\xC3\x73\xD6'
         self.assertEqual(resultBytes, testBytes)
 
+        self._keyitem.kek = True
+        self._keyitem.erase = True
+        self.assertEqual(self._keyitem.to_bytes()[0], 0xA0)
+
+    def test_key_pack_into(self):
+        """Test packing several KeyItems into one buffer"""
+        self._keyitem.key = [0x71, 0xD4, 0xC3, 0x73, 0xD6]
+        self._keyitem.sln = 0x1234
+        self._keyitem.kid = 0x5678
+
+        buffer = bytearray(2 + 2 * self._keyitem.encoded_length())
+        offset = self._keyitem.pack_into(buffer, 2)
+        offset = self._keyitem.pack_into(buffer, offset)
+        self.assertEqual(offset, len(buffer))
+        self.assertEqual(bytes(buffer[2:12]), bytes(self._keyitem.to_bytes()))
+        self.assertEqual(bytes(buffer[12:]), bytes(self._keyitem.to_bytes()))
+
+    def test_key_parse(self):
+        """Test parsing KeyItems back out of a buffer"""
+        data = b'\xff\x80\x00\x01\x00\x02\xAA\xBB\x20\x00\x03\x00\x04\xCC\xDD'
+        offset = self._keyitem.parse(data, 2, 1)
+        self.assertEqual(offset, 8)
+        self.assertEqual((self._keyitem.sln, self._keyitem.kid, self._keyitem.key), (1, 2, [0xAA, 0xBB]))
+        self.assertTrue(self._keyitem.kek)
+        self.assertFalse(self._keyitem.erase)
+
+        other = KeyItem()
+        self.assertEqual(other.parse(memoryview(data), offset=offset), len(data))
+        self.assertEqual((other.sln, other.kid, other.key), (3, 4, [0xCC, 0xDD]))
+        self.assertTrue(other.erase)
+
+        with self.assertRaises(ValueError):
+            other.parse(data[:4])
+
+        with self.assertRaises(ValueError):
+            other.parse(data, 32, 1)
+
+class TestKeyInfo(unittest.TestCase):
+    def test_round_trip(self):
+        """Test encoding and parsing KeyInfo"""
+        info = KeyInfo()
+        info.keysetId = 1
+        info.sln = 0x1234
+        info.algId = 0x84
+        info.kid = 0x5678
+        self.assertEqual(info.to_bytes(), b'\x01\x12\x34\x84\x56\x78')
+
+        parsed = KeyInfo()
+        self.assertEqual(parsed.parse(b'\x00' + bytes(info.to_bytes()), 1), 7)
+        self.assertEqual((parsed.keysetId, parsed.sln, parsed.algId, parsed.kid), (1, 0x1234, 0x84, 0x5678))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
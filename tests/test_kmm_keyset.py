@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+#
+# PyKMM - KMM and keyloading for Python
+# GPLv2 Open Source. Use is subject to license terms.
+# DO NOT ALTER OR REMOVE COPYRIGHT NOTICES OR THIS FILE HEADER.
+#
+# @package PyKMM
+#
+###############################################################################
+#   Copyright (C) 2022 Natalie Moore <natalie@natnat.xyz>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+###############################################################################
+
+import unittest
+
+from pykmm.kmm.items import KeyItem, KeyInfo
+from pykmm.kmm.keyset import KeySet, KeyIndex
+
+def makeKey(sln, kid, key, kek=False):
+    item = KeyItem()
+    item.sln = sln
+    item.kid = kid
+    item.key = key
+    item.kek = kek
+    return item
+
+class TestKeySet(unittest.TestCase):
+    def setUp(self):
+        """Test setup."""
+        self._keyset = KeySet(1)
+        for i in range(1, 101):
+            self._keyset.add(makeKey(i, 0x1000 + i, bytes([i]) * 32), 0x84)
+
+    def tearDown(self):
+        """Tear down."""
+        del self._keyset
+
+    def test_lookup(self):
+        """Test finding keys by SLN and KID"""
+        self.assertEqual(len(self._keyset), 100)
+        item = self._keyset.findBySln(42)
+        self.assertEqual((item.sln, item.kid, item.keyBytes), (42, 0x102A, bytes([42]) * 32))
+        self.assertEqual([k.sln for k in self._keyset.findByKid(0x1005)], [5])
+        self.assertIsNone(self._keyset.findBySln(500))
+        self.assertEqual(self._keyset.findByKid(0x7777), [])
+        self.assertEqual(bytes(self._keyset.keyMaterial(0)), bytes([1]) * 32)
+
+    def test_replace(self):
+        """Test replacing a key with the same and a different length"""
+        self._keyset.add(makeKey(10, 0x2000, bytes(32), kek=True), 0x84)
+        self._keyset.add(makeKey(11, 0x2001, bytes(8)), 0x81)
+        self.assertEqual(len(self._keyset), 100)
+        self.assertEqual(self._keyset.findByKid(0x100A), [])
+        item = self._keyset.findBySln(10)
+        self.assertTrue(item.kek)
+        self.assertEqual(item.keyBytes, bytes(32))
+        self.assertEqual(self._keyset.findBySln(11).keyBytes, bytes(8))
+
+        self._keyset.compact()
+        self.assertEqual(self._keyset.findBySln(11).keyBytes, bytes(8))
+        self.assertEqual(self._keyset.findBySln(100).keyBytes, bytes([100]) * 32)
+
+    def test_remove(self):
+        """Test removing keys keeps the indexes consistent"""
+        self._keyset.remove(1)
+        self._keyset.remove(100)
+        self.assertEqual(len(self._keyset), 98)
+        self.assertNotIn(1, self._keyset)
+        self.assertEqual(self._keyset.findBySln(99).kid, 0x1063)
+        self.assertEqual(sorted(k.sln for k in self._keyset), list(range(2, 100)))
+
+    def test_material_snapshot(self):
+        """Test key material read back isn't changed by later writes, and a bad add changes nothing"""
+        material = self._keyset.keyMaterial(4)
+        self._keyset.add(makeKey(5, 0x1005, bytes(32)), 0x84)
+        self._keyset.add(makeKey(101, 0x1065, bytes(16)), 0x84)
+        self.assertEqual(material, bytes([5]) * 32)
+
+        with self.assertRaises(ValueError):
+            self._keyset.add(makeKey(102, 0x1066, bytes(32)), 0x184)
+        self.assertEqual(len(self._keyset), 101)
+        self.assertNotIn(102, self._keyset)
+        self.assertEqual(self._keyset.findByKid(0x1066), [])
+
+    def test_content_hash(self):
+        """Test the content hash ignores insertion order but not key material"""
+        other = KeySet(1)
+        for i in range(100, 0, -1):
+            other.add(makeKey(i, 0x1000 + i, bytes([i]) * 32), 0x84)
+        self.assertEqual(other.contentHash(), self._keyset.contentHash())
+        other.add(makeKey(50, 0x1032, bytes(32)), 0x84)
+        self.assertNotEqual(other.contentHash(), self._keyset.contentHash())
+
+class TestKeyIndex(unittest.TestCase):
+    def test_diff(self):
+        """Test added, changed and removed keys between two keysets"""
+        old = KeySet()
+        new = KeySet()
+        for i in range(1, 11):
+            old.add(makeKey(i, 0x1000 + i, bytes([i]) * 32), 0x84)
+            new.add(makeKey(i, 0x1000 + i, bytes([i]) * 32), 0x84)
+        new.add(makeKey(3, 0x1003, bytes(32)), 0x84)
+        new.remove(7)
+        new.add(makeKey(20, 0x2000, bytes(8)), 0x81)
+
+        diff = KeyIndex.fromKeySet(old).diff(KeyIndex.fromKeySet(new))
+        self.assertEqual([(a, k.sln) for a, k in diff.added], [(0x81, 20)])
+        self.assertEqual([(a, k.sln, k.keyBytes) for a, k in diff.changed], [(0x84, 3, bytes(32))])
+        self.assertEqual([(a, k.sln, k.kid, k.erase) for a, k in diff.removed], [(0x84, 7, 0x1007, True)])
+        self.assertEqual(len(diff), 3)
+        self.assertEqual(len(KeyIndex.fromKeySet(new).diff(KeyIndex.fromKeySet(new))), 0)
+
+    def test_diff_reassigned_sln(self):
+        """Test that an SLN moved to a new KID and algorithm is erased before it is loaded again"""
+        old = KeySet()
+        new = KeySet()
+        old.add(makeKey(4, 0x1004, bytes(32)), 0x84)
+        new.add(makeKey(4, 0x2004, bytes(8)), 0x81)
+
+        diff = KeyIndex.fromKeySet(old).diff(KeyIndex.fromKeySet(new))
+        self.assertEqual([(a, k.sln, k.kid, k.erase) for a, k in diff.items()],
+                         [(0x84, 4, 0x1004, True), (0x81, 4, 0x2004, False)])
+
+    def test_diff_inventory(self):
+        """Test diffing a radio inventory against a keyset"""
+        keyset = KeySet()
+        keyset.add(makeKey(1, 0x1001, bytes(32)), 0x84)
+        keyset.add(makeKey(2, 0x1002, bytes(32)), 0x84)
+        inventory = []
+        for sln in (2, 5):
+            info = KeyInfo()
+            info.sln = sln
+            info.kid = 0x1000 + sln
+            info.algId = 0x84
+            inventory.append(info)
+
+        diff = KeyIndex.fromInventory(inventory).diff(KeyIndex.fromKeySet(keyset))
+        self.assertEqual([k.sln for a, k in diff.added], [1])
+        self.assertEqual(diff.changed, [])
+        self.assertEqual([k.sln for a, k in diff.removed], [5])
+
+if __name__ == '__main__':
+    unittest.main()
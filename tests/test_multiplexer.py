@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#
+# PyKMM - KMM and keyloading for Python
+# GPLv2 Open Source. Use is subject to license terms.
+# DO NOT ALTER OR REMOVE COPYRIGHT NOTICES OR THIS FILE HEADER.
+#
+# @package PyKMM
+#
+###############################################################################
+#   Copyright (C) 2022 Natalie Moore <natalie@natnat.xyz>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+###############################################################################
+
+import collections
+import unittest
+
+from pykmm.deviceprotocol import OPKFD, KFDAVR
+from pykmm.multiplexer import *
+
+class TestReplyMultiplexer(unittest.TestCase):
+    def setUp(self):
+        """Test setup, with replies served from a queue and keyed like KFDAVR's."""
+        self._frames = collections.deque()
+        kfd = KFDAVR.__new__(KFDAVR)
+        self._commandKey = kfd._commandKey
+        self._mux = ReplyMultiplexer(self._readFrame, kfd._replyKey)
+
+    def tearDown(self):
+        """Tear down."""
+        del self._mux
+
+    def _readFrame(self):
+        if (not self._frames):
+            raise TimeoutError("no more frames")
+        return self._frames.popleft()
+
+    def _expect(self, command):
+        return self._mux.expect(self._commandKey(command))
+
+    def test_match_by_subop(self):
+        """Test replies reach the right request whatever order they arrive in"""
+        model = self._expect([OPKFD.CMD_READ_REQ, OPKFD.READ_MODEL])
+        selfTest = self._expect([OPKFD.CMD_SELF_TEST])
+        serial = self._expect([OPKFD.CMD_READ_REQ, OPKFD.READ_SN])
+        self._frames.extend([[OPKFD.REPLY_READ, OPKFD.READ_SN, 0], [OPKFD.REPLY_SELF_TEST, 0], [OPKFD.REPLY_READ, OPKFD.READ_MODEL, 3]])
+
+        self.assertEqual(self._mux.wait(model), [OPKFD.REPLY_READ, OPKFD.READ_MODEL, 3])
+        self.assertTrue(serial.done)
+        self.assertTrue(selfTest.done)
+        self.assertEqual(self._mux.wait(serial), [OPKFD.REPLY_READ, OPKFD.READ_SN, 0])
+        self.assertEqual(len(self._mux), 0)
+
+    def test_match_by_slot(self):
+        """Test slot reads are told apart by slot"""
+        slots = [self._expect([OPKFD.CMD_READ_REQ, KFDAVR.READ_KEY_INFO, slot]) for slot in range(0, 3)]
+        for slot in (2, 0, 1):
+            self._frames.append([OPKFD.REPLY_READ, KFDAVR.READ_KEY_INFO, slot, 0, 0, 1, 0, 1])
+        for slot, pending in enumerate(slots):
+            self.assertEqual(self._mux.wait(pending)[2], slot)
+
+    def test_error_goes_to_oldest(self):
+        """Test an error reply is handed to the oldest outstanding request"""
+        first = self._expect([OPKFD.CMD_WRITE_REQ, KFDAVR.WRITE_KEY, 1])
+        second = self._expect([OPKFD.CMD_SELF_TEST])
+        self._frames.extend([[OPKFD.REPLY_SELF_TEST, 0], [OPKFD.REPLY_ERROR, OPKFD.ERROR_WRITE_FAILED]])
+        self.assertEqual(self._mux.wait(second), [OPKFD.REPLY_SELF_TEST, 0])
+        self.assertEqual(self._mux.wait(first), [OPKFD.REPLY_ERROR, OPKFD.ERROR_WRITE_FAILED])
+
+    def test_discard(self):
+        """Test unsolicited replies and replies to cancelled requests are dropped"""
+        pending = self._expect([OPKFD.CMD_SELF_TEST])
+        self._frames.extend([[OPKFD.REPLY_SEND_BYTE], [0x30], [OPKFD.REPLY_SELF_TEST, 0]])
+        self._mux.wait(pending)
+        self.assertEqual(self._mux.discarded, 2)
+
+        pending = self._expect([OPKFD.CMD_SELF_TEST])
+        with self.assertRaises(TimeoutError):
+            self._mux.wait(pending)
+        self.assertEqual(len(self._mux), 0)
+        self.assertIsNone(self._mux.dispatch([OPKFD.REPLY_SELF_TEST, 0]))
+        self.assertEqual(self._mux.discarded, 3)
+
+    def test_failed_dispatch_withdraws(self):
+        """Test a frame the key function chokes on still withdraws the request"""
+        mux = ReplyMultiplexer(lambda: [0x01], lambda resp: resp[5])
+        pending = mux.expect((OPKFD.CMD_SELF_TEST, None, None))
+        with self.assertRaises(IndexError):
+            mux.wait(pending)
+        self.assertEqual(len(mux), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+#
+# PyKMM - KMM and keyloading for Python
+# GPLv2 Open Source. Use is subject to license terms.
+# DO NOT ALTER OR REMOVE COPYRIGHT NOTICES OR THIS FILE HEADER.
+#
+# @package PyKMM
+#
+###############################################################################
+#   Copyright (C) 2022 Natalie Moore <natalie@natnat.xyz>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+###############################################################################
+
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+
+from pykmm.dli import DLITransport
+from pykmm.journal import RekeyJournal
+from pykmm.kmm.commands import *
+from pykmm.kmm.items import KeyItem
+from pykmm.kmm.keyset import KeySet
+from pykmm.RekeyApplication import *
+
+class RekeyEmulator(asyncio.DatagramProtocol):
+    '''Acknowledges rekeys for any radio RSI, NAKing the first few from the RSIs in flaky'''
+    def __init__(self):
+        self.flaky = {}
+        self.rekeys = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        for message in iter_kmms(data):
+            rsi = message.dstRsi
+            if (self.flaky.get(rsi, 0) > 0):
+                self.flaky[rsi] -= 1
+                reply = NegativeAcknowledgment()
+                reply.acknowledgedMessageId = message.MESSAGE_ID
+                reply.status = 0x01
+            else:
+                self.rekeys.setdefault(rsi, []).append(message.algId)
+                reply = RekeyAcknowledgment()
+                reply.statuses = [KeyStatus(message.algId, keyItem.kid, 0) for keyItem in message.keys]
+            reply.messageNumber = message.messageNumber
+            self.transport.sendto(bytes(reply.to_bytes()), addr)
+
+class TestRekeyCampaign(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        """Test setup, with every radio answering from one emulated endpoint."""
+        loop = asyncio.get_running_loop()
+        self._radioTransport, self._radio = await loop.create_datagram_endpoint(RekeyEmulator, local_addr=("127.0.0.1", 0))
+        addr = self._radioTransport.get_extra_info("sockname")
+        self._dli = await DLITransport.open(("127.0.0.1", 0), retransmitInterval=0.05, maxRetransmits=1)
+
+        keyset = KeySet(keysetId=1)
+        for sln, algId in ((1, 0x84), (2, 0x84), (3, 0xAA)):
+            keyItem = KeyItem()
+            keyItem.sln = sln
+            keyItem.kid = sln
+            keyItem.key = [sln] * 8
+            keyset.add(keyItem, algId)
+
+        self._targets = list(range(100, 120))
+        self._keyset = keyset
+        self._app = RekeyApplication(self._dli, keyset, {rsi: addr for rsi in self._targets}, allowClear=True)
+        self._dir = tempfile.TemporaryDirectory()
+        self._checkpoint = os.path.join(self._dir.name, "campaign.json")
+
+    async def asyncTearDown(self):
+        """Tear down."""
+        self._dli.close()
+        self._radioTransport.close()
+        self._dir.cleanup()
+
+    def _campaign(self, **kwargs):
+        return RekeyCampaign(self._app, self._targets, window=4, rateLimit=1000, backoffBase=0.01,
+                             checkpointPath=self._checkpoint, **kwargs)
+
+    async def test_campaign(self):
+        """Test every radio gets one Rekey-Command per algorithm"""
+        acked, failed = await self._campaign().run()
+        self.assertEqual(acked, set(self._targets))
+        self.assertEqual(failed, {})
+        self.assertEqual(sorted(self._radio.rekeys[100]), [0x84, 0xAA])
+        with open(self._checkpoint) as f:
+            self.assertEqual(json.load(f)["acked"], self._targets)
+
+    async def test_backoff_and_failure(self):
+        """Test NAKed radios are retried and eventually given up on"""
+        self._radio.flaky = {101: 2, 102: 100}
+        campaign = self._campaign(maxAttempts=3)
+        acked, failed = await campaign.run()
+        self.assertIn(101, acked)
+        self.assertEqual(campaign.attempts[101], 3)
+        self.assertEqual(list(failed), [102])
+        self.assertEqual(campaign.report()["failed"], 1)
+
+    async def test_resume(self):
+        """Test a restarted campaign skips radios already acknowledged"""
+        self._radio.flaky = {105: 100}
+        await self._campaign(maxAttempts=1).run()
+        self._radio.rekeys.clear()
+        self._radio.flaky.clear()
+
+        acked, failed = await self._campaign().run()
+        self.assertEqual(list(self._radio.rekeys), [105])
+        self.assertEqual(acked, set(self._targets))
+
+        # same keyset ID, different keys
+        keyset = KeySet(keysetId=1)
+        keyItem = KeyItem()
+        keyItem.sln = 1
+        keyItem.kid = 1
+        keyItem.key = [9] * 8
+        keyset.add(keyItem, 0x84)
+        self._app.setKeyset(keyset)
+        with self.assertRaises(ValueError):
+            self._campaign()
+
+    async def test_unexpected_error(self):
+        """Test an error that retrying won't fix fails only that radio"""
+        del self._app.addresses[103]
+        campaign = self._campaign()
+        with self.assertLogs(level="WARNING"):
+            acked, failed = await campaign.run()
+        self.assertEqual(list(failed), [103])
+        self.assertEqual(campaign.attempts[103], 1)
+        self.assertEqual(acked, set(self._targets) - {103})
+        with open(self._checkpoint) as f:
+            self.assertEqual(list(json.load(f)["failed"]), ["103"])
+
+    async def test_journal_resume(self):
+        """Test a journal skips finished radios and acknowledged commands after a crash"""
+        journalPath = os.path.join(self._dir.name, "rekey.journal")
+        with RekeyJournal(journalPath) as journal:
+            # a previous run finished radio 100 and got halfway through 101
+            journal.record(RekeyJournal.DONE, 100, 1, self._app.campaignHash)
+            journal.record(RekeyJournal.ACKED, 101, 1, self._app.campaignHash, 0x84)
+            journal.record(RekeyJournal.SENT, 101, 1, self._app.campaignHash, 0xAA)
+
+        with RekeyJournal(journalPath) as journal:
+            self._app.journal = journal
+            acked, failed = await self._campaign().run()
+            self.assertEqual(acked, set(self._targets))
+            self.assertNotIn(100, self._radio.rekeys)
+            self.assertEqual(self._radio.rekeys[101], [0xAA])
+            self.assertEqual(sorted(self._radio.rekeys[102]), [0x84, 0xAA])
+
+        with RekeyJournal(journalPath) as journal:
+            self.assertEqual(journal.state(1, self._app.campaignHash).done, set(self._targets))
+
+    async def test_kek_required(self):
+        """Test keys are only sent in the clear when allowed, and are otherwise wrapped per radio"""
+        with self.assertRaises(ValueError):
+            RekeyApplication(self._dli, self._keyset)
+        with self.assertRaises(ValueError):
+            RekeyApplication(self._dli, self._keyset, kekAlgId=0x84, kekKid=0x10)
+
+        def wrapKeys(rsi, command):
+            command.decryptionFormat = 0x40
+            command.encryptedBody = rsi.to_bytes(3, "big") + bytes(16)
+        app = RekeyApplication(self._dli, self._keyset, kekAlgId=0x84, kekKid=0x10, wrapKeys=wrapKeys)
+        commands = list(app.rekeyCommands(100))
+        self.assertEqual(len(commands), 2)
+        for command in commands:
+            decoded, end = parse_kmm(command.to_bytes())
+            self.assertEqual((decoded.kekAlgId, decoded.kekKid), (0x84, 0x10))
+            self.assertEqual(decoded.encryptedBody, (100).to_bytes(3, "big") + bytes(16))
+
+class TestTokenBucket(unittest.IsolatedAsyncioTestCase):
+    async def test_rate(self):
+        """Test the bucket spaces acquisitions past the burst"""
+        bucket = TokenBucket(rate=100, burst=5)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for i in range(0, 15):
+            await bucket.acquire()
+        self.assertGreaterEqual(loop.time() - start, 0.09)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -24,6 +24,8 @@
 #   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 ###############################################################################
 
+import os
+import timeit
 import unittest
 
 import pykmm.utility as utility
@@ -51,6 +53,54 @@ class TestUtility(unittest.TestCase):
 
     def test_dataformat_list(self):
         '''Test all data format options for list'''
+        self.assertEqual(utility.dataFormat([]), "")
+        self.assertEqual(utility.dataFormat(b'\x01\xab'), "0x01, 0xab")
+
+        with self.assertRaises(ValueError):
+            utility.dataFormat(0x100)
+
+        with self.assertRaises(ValueError):
+            utility.dataFormat(-1)
+
+    def test_hex_bytes(self):
+        '''Test single key hex conversions'''
+        self.assertEqual(utility.hexToBytes("c0ffee"), b'\xc0\xff\xee')
+        self.assertEqual(utility.bytesToHex(b'\xc0\xff\xee'), "C0FFEE")
+        self.assertEqual(utility.bytesToHex([0xc0, 0xff, 0xee], " "), "C0 FF EE")
+
+        with self.assertRaises(ValueError):
+            utility.hexToBytes("C0F")
+
+        with self.assertRaises(ValueError):
+            utility.stringToByteList("C0FFEZ")
+
+    def test_hex_batch(self):
+        '''Test packing many hex keys into one buffer and back'''
+        keys = ["3773F47225F44972", "DCF8D675984A75F4", "71D4C373D6"]
+        buffer, offsets = utility.hexListToBuffer(keys)
+        self.assertEqual(list(offsets), [0, 8, 16, 21])
+        self.assertEqual(buffer[16:21], b'\x71\xD4\xC3\x73\xD6')
+        self.assertEqual(utility.bufferToHexList(buffer, offsets), keys)
+
+        with self.assertRaises(ValueError):
+            utility.hexListToBuffer(keys, keyLength=8)
+
+        with self.assertRaises(ValueError):
+            utility.hexListToBuffer(["C0F", "FEE"])
+
+        with self.assertRaises(ValueError):
+            utility.hexListToBuffer(["C0 F", "FEE0"])
+
+    def test_hex_batch_speed(self):
+        '''Test the batch conversion beats converting two characters at a time'''
+        keys = [os.urandom(32).hex() for i in range(0, 2000)]
+
+        def perByte():
+            return [[int(k[i:i+2], 16) for i in range(0, len(k), 2)] for k in keys]
+
+        old = min(timeit.repeat(perByte, number=1, repeat=3))
+        new = min(timeit.repeat(lambda: utility.hexListToBuffer(keys), number=1, repeat=3))
+        self.assertLess(new * 5, old)
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file